@@ -1,9 +1,14 @@
 from __future__ import annotations
+import asyncio
+import base64
 import json
 import logging
+import math
 import os
 import sys
+import threading
 import traceback
+from contextlib import asynccontextmanager
 from pathlib import Path
 from typing import Any, Dict, List, Optional
 
@@ -12,7 +17,8 @@ import cv2
 
 try:
     from fastapi import FastAPI, UploadFile, File, Form
-    from fastapi.responses import JSONResponse
+    from fastapi.concurrency import run_in_threadpool
+    from fastapi.responses import JSONResponse, PlainTextResponse, Response
 except ModuleNotFoundError as exc:  # pragma: no cover - import guard
     missing = exc.name or "fastapi"
     raise ModuleNotFoundError(
@@ -28,22 +34,45 @@ if __package__ in (None, ""):
         sys.path.insert(0, str(project_root))
 
     from backend.features import DinoV2Features  # type: ignore[no-redef]
-    from backend.patchcore import PatchCoreMemory  # type: ignore[no-redef]
+    from backend.patchcore import INDEX_TYPES, PROJECTIONS, PatchCoreMemory, Projection, apply_search_params  # type: ignore[no-redef]
     from backend.storage import ModelStore  # type: ignore[no-redef]
-    from backend.infer import InferenceEngine  # type: ignore[no-redef]
-    from backend.calib import choose_threshold  # type: ignore[no-redef]
+    from backend.infer import InferenceEngine, cascade_decision, roi_token_mask  # type: ignore[no-redef]
+    from backend.cache import MemoryCache  # type: ignore[no-redef]
+    from backend.scheduler import InferenceScheduler  # type: ignore[no-redef]
+    from backend.metrics import MetricsMiddleware, MetricsRegistry, roi_scope, stage  # type: ignore[no-redef]
+    from backend.startup import ERROR as STARTUP_ERROR, Startup, parse_roi_list  # type: ignore[no-redef]
+    from backend.roi_crop import crop_roi  # type: ignore[no-redef]
+    from backend.calib import choose_cascade_accept, choose_threshold  # type: ignore[no-redef]
     from backend.utils import ensure_dir, base64_from_bytes  # type: ignore[no-redef]
 else:
     from .features import DinoV2Features
-    from .patchcore import PatchCoreMemory
+    from .patchcore import INDEX_TYPES, PROJECTIONS, PatchCoreMemory, Projection, apply_search_params
     from .storage import ModelStore
-    from .infer import InferenceEngine
-    from .calib import choose_threshold
+    from .infer import InferenceEngine, cascade_decision, roi_token_mask
+    from .cache import MemoryCache
+    from .scheduler import InferenceScheduler
+    from .metrics import MetricsMiddleware, MetricsRegistry, roi_scope, stage
+    from .startup import ERROR as STARTUP_ERROR, Startup, parse_roi_list
+    from .roi_crop import crop_roi
+    from .calib import choose_cascade_accept, choose_threshold
     from .utils import ensure_dir, base64_from_bytes
 
+try:  # respuesta binaria opcional (response_format=msgpack)
+    import msgpack  # type: ignore
+except ImportError:  # pragma: no cover - dependencia opcional
+    msgpack = None
+
 log = logging.getLogger(__name__)
 
-app = FastAPI(title="Anomaly Backend (PatchCore + DINOv2)")
+
+@asynccontextmanager
+async def _lifespan(_app):
+    # El modelo se carga en segundo plano: el servidor acepta /health desde el primer momento
+    start_background()
+    yield
+
+
+app = FastAPI(title="Anomaly Backend (PatchCore + DINOv2)", lifespan=_lifespan)
 
 # Carpeta para artefactos persistentes por (role_id, roi_id)
 def _env_var(name: str, *, legacy: str | None = None, default: str | None = None) -> str | None:
@@ -68,83 +97,703 @@ except Exception:
             "coreset_rate": 0.10,
             "score_percentile": 99,
             "area_mm2_thr": 1.0,
-        }
+            "fit_batch_size": 8,
+            "coreset_method": "exact",
+            "coreset_proj_dim": 128,
+            "index_type": "flat",
+            "infer_batch_size": 8,
+            "projection": "none",
+            "projection_dim": 128,
+            "mask_tokens": True,
+            "post_resolution": "roi",
+            "cascade": False,
+            "cascade_input_size": 224,
+            "cascade_margin": 0.05,
+        },
+        "extractor": {
+            "preprocess": "pil",
+            "precision": "fp32",
+            "backend": "torch",
+            "onnx_path": "models/onnx/dinov2_vits14_448.onnx",
+            "onnx_threads": 0,
+            "token_pruning": False,
+            "polar_unwrap": False,
+            "polar_scale": 1.0,
+        },
+        "cache": {"max_mb": 1024},
+        "storage": {"emb_dtype": "float32"},
+        "scheduler": {"enabled": True, "max_batch": 8, "max_wait_ms": 5.0},
+        "metrics": {"enabled": True, "server_timing": False},
+        "startup": {"weights": "", "background": True, "warmup_runs": 2, "preload": [], "request_wait_s": 30.0,
+                    "retry_s": 30.0},
     }
 ensure_dir(MODELS_DIR)
-store = ModelStore(MODELS_DIR)
-
-# Carga única del extractor (congelado)
-_extractor = DinoV2Features(
-    model_name="vit_small_patch14_dinov2.lvd142m",
-    device="auto",
-    input_size=448,   # múltiplo de 14; si envías 384, el extractor reescala internamente
-    patch_size=14
+
+# Latencia por etapa (decode/preprocess/forward/knn/...) -> GET /metrics (ver backend/metrics.py)
+METRICS_PATHS = ("/fit_ok", "/calibrate_ng", "/infer", "/infer_batch", "/infer_frame")
+metrics_registry = MetricsRegistry()
+_metrics_cfg = SETTINGS.get("metrics", {})
+if _metrics_cfg.get("enabled", True):
+    app.add_middleware(
+        MetricsMiddleware,
+        registry=metrics_registry,
+        paths=METRICS_PATHS,
+        server_timing=bool(_metrics_cfg.get("server_timing", False)),
+    )
+store = ModelStore(MODELS_DIR, emb_dtype=str(SETTINGS.get("storage", {}).get("emb_dtype", "float32")))
+
+# Caché LRU (en proceso) de memorias PatchCore listas para consultar + calibraciones
+memory_cache = MemoryCache(
+    max_bytes=int(float(SETTINGS.get("cache", {}).get("max_mb", 1024)) * 1024 * 1024)
 )
 
+# Extractor (congelado), creado por la fase "loading" del arranque (ver backend/startup.py)
+_extractor: Optional[DinoV2Features] = None
+startup = Startup()
+
+# Micro-batching del extractor entre peticiones concurrentes (ver backend/scheduler.py)
+_scheduler: Optional[InferenceScheduler] = None
+_scheduler_lock = threading.Lock()
+# Sin scheduler, los forwards se serializan con este lock
+_extract_lock = threading.Lock()
+
+# Cascada (inference.cascade): pasada barata con el mismo modelo a cascade_input_size y su propia
+# memoria, guardada junto a la del ROI con la clave roi_id + CASCADE_SUFFIX
+CASCADE_SUFFIX = "::cascade"
+_cascade: Optional[tuple] = None  # (extractor completo, extractor de baja resolución o None)
+_cascade_lock = threading.Lock()
+_cascade_extract_lock = threading.Lock()
+
+
+def _get_scheduler() -> Optional[InferenceScheduler]:
+    """Scheduler ligado al extractor actual; None si está desactivado o el extractor no expone preprocess/forward_preprocessed."""
+    global _scheduler
+    cfg = SETTINGS.get("scheduler", {})
+    if not cfg.get("enabled", True) or not hasattr(_extractor, "forward_preprocessed"):
+        return None
+    with _scheduler_lock:
+        if _scheduler is None or _scheduler.extractor is not _extractor:
+            if _scheduler is not None:
+                _scheduler.stop()
+            _scheduler = InferenceScheduler(
+                _extractor,
+                max_batch=int(cfg.get("max_batch", 8)),
+                max_wait_ms=float(cfg.get("max_wait_ms", 5.0)),
+            )
+        return _scheduler
+
+
+def prepare_for_fork() -> None:
+    """
+    Llamar en el proceso maestro antes de crear workers con fork (backend/serve.py):
+    los pesos del ViT (CPU) pasan a memoria compartida, así los workers no los duplican ni
+    al escribir, y se detiene el hilo del scheduler (los hilos no sobreviven al fork).
+    """
+    global _scheduler
+    # Sólo se cargan los pesos: sin forwards en el maestro, los workers no heredan el pool de hilos
+    # OpenMP/MKL ya creado (el warm-up lo hace cada worker al arrancar, tras fijar sus hilos en post_fork).
+    # Las sesiones de onnxruntime no sobreviven al fork (su pool de hilos): cada worker crea la suya.
+    if not _onnx_backend():
+        _load_extractor()
+    with _scheduler_lock:
+        if _scheduler is not None:
+            _scheduler.stop()
+            _scheduler = None
+    memory_cache.clear()
+    model = getattr(_extractor, "model", None)
+    device = getattr(_extractor, "device", None)
+    if model is not None and getattr(device, "type", "cpu") == "cpu" and hasattr(model, "share_memory"):
+        model.share_memory()
+
+
+def _onnx_backend() -> bool:
+    return str(SETTINGS.get("extractor", {}).get("backend", "torch")).lower() == "onnx"
+
+
+def _build_extractor() -> DinoV2Features:
+    """
+    BDI_DEVICE=cpu fuerza CPU (p.ej. pool multi-proceso, ver serve.py); startup.weights evita el hub.
+    extractor.backend=onnx usa el grafo exportado (onnxruntime, CPU) con el mismo preprocesado.
+    """
+    cfg = SETTINGS.get("extractor", {})
+    if _onnx_backend():
+        if __package__ in (None, ""):
+            from backend.onnx_features import OnnxDinoV2Features  # type: ignore[no-redef]
+        else:
+            from .onnx_features import OnnxDinoV2Features
+        return OnnxDinoV2Features(
+            onnx_path=str(cfg.get("onnx_path") or "models/onnx/dinov2_vits14_448.onnx"),
+            input_size=448,
+            preprocess=str(cfg.get("preprocess", "pil")),
+            intra_op_threads=int(cfg.get("onnx_threads", 0) or 0),
+        )
+    return DinoV2Features(
+        model_name="vit_small_patch14_dinov2.lvd142m",
+        device=_env_var("BDI_DEVICE", legacy="BRAKEDISC_DEVICE", default="auto"),
+        input_size=448,   # múltiplo de 14; si envías 384, el extractor reescala internamente
+        patch_size=14,
+        preprocess=str(cfg.get("preprocess", "pil")),
+        precision=str(cfg.get("precision", "fp32")),
+        token_pruning=bool(cfg.get("token_pruning", False)),
+        # la tira polar tiene su propio grid de tokens (no cuadrado)
+        dynamic_input=bool(cfg.get("polar_unwrap", False)),
+        polar_unwrap=bool(cfg.get("polar_unwrap", False)),
+        polar_scale=float(cfg.get("polar_scale", 1.0)),
+        weights=str(SETTINGS.get("startup", {}).get("weights") or "") or None,
+    )
+
+
+def _load_extractor() -> None:
+    global _extractor
+    if _extractor is None:
+        _extractor = _build_extractor()
+
+
+def _warmup() -> None:
+    """
+    Forwards de prueba al input_size configurado: allocator, kernels y pos_embed cacheado.
+    En GPU también un lote del tamaño del scheduler (los kernels dependen de la forma).
+    """
+    runs = int(SETTINGS.get("startup", {}).get("warmup_runs", 2))
+    if runs <= 0 or _extractor is None:
+        return
+    size = int(getattr(_extractor, "input_size", 448))
+    dummy = np.zeros((size, size, 3), dtype=np.uint8)
+    max_batch = int(SETTINGS.get("scheduler", {}).get("max_batch", 8))
+    for _ in range(runs):
+        _extract_sync([dummy], 1)
+    if max_batch > 1 and getattr(getattr(_extractor, "device", None), "type", "cpu") == "cuda":
+        _extract_sync([dummy] * max_batch, max_batch)
+
+
+def _preload() -> None:
+    """Memorias/calibraciones de startup.preload a la caché LRU (y sus páginas mmap a RAM)."""
+    for role_id, roi_id in parse_roi_list(SETTINGS.get("startup", {}).get("preload")):
+        try:
+            loaded = _load_patchcore(role_id, roi_id)
+            _load_calib(role_id, roi_id)
+        except Exception as exc:
+            log.warning("Precarga de %s/%s fallida: %s", role_id, roi_id, exc)
+            continue
+        if loaded is None:
+            log.warning("Precarga: sin memoria para %s/%s", role_id, roi_id)
+            continue
+        mem = loaded[0]
+        mem.knn_min_dist(np.zeros((1, mem.input_dim), dtype=np.float32))
+        startup.preloaded += 1
+
+
+def _startup_retry_s() -> float:
+    return float(SETTINGS.get("startup", {}).get("retry_s", 30.0))
+
+
+def start_background(background: Optional[bool] = None) -> None:
+    """
+    Lanza (una vez) loading -> warming -> ready -> precarga; por defecto en un hilo. Tras un
+    error vuelve a lanzarlo si ya pasaron startup.retry_s segundos (lo llama cada petición).
+    """
+    if background is None:
+        background = bool(SETTINGS.get("startup", {}).get("background", True))
+    startup.start(
+        [("loading", _load_extractor), ("warming", _warmup)],
+        after_ready=[("preload", _preload)],
+        background=background,
+        retry_after_s=_startup_retry_s(),
+    )
+
+
+async def _not_ready() -> Optional[JSONResponse]:
+    """
+    None si el extractor puede atender; si aún está cargando espera hasta startup.request_wait_s
+    y, si no llega, devuelve 503 con el estado del arranque.
+    """
+    if _extractor is not None and not startup.busy:
+        return None
+    start_background()
+    wait_s = float(SETTINGS.get("startup", {}).get("request_wait_s", 30.0))
+    await run_in_threadpool(startup.wait, wait_s)
+    if _extractor is not None and not startup.busy:
+        return None
+    retry_in = startup.retry_in(_startup_retry_s())
+    return JSONResponse(
+        status_code=503,
+        content={"error": "El modelo aún no está listo", "startup": startup.snapshot()},
+        headers={"Retry-After": str(max(1, math.ceil(retry_in)) if retry_in is not None else 5)},
+    )
+
+
+def _shape_aware(shapes) -> bool:
+    """El extractor necesita la forma del ROI (token_pruning / polar_unwrap)."""
+    return shapes is not None and bool(getattr(_extractor, "uses_shape", False))
+
+
+def _extract_sync(imgs: List[np.ndarray], batch_size: int, shapes: Optional[List[Any]] = None):
+    with _extract_lock:
+        if _shape_aware(shapes):
+            return _extractor.extract_batch(imgs, batch_size=batch_size, shapes=shapes)
+        return _extractor.extract_batch(imgs, batch_size=batch_size)
+
+
+async def _extract_features(imgs: List[np.ndarray], batch_size: int, shapes: Optional[List[Any]] = None):
+    """
+    [(emb, (h_tokens, w_tokens)), ...] de `imgs`. Con scheduler, el preprocesado corre en el
+    threadpool y el forward se comparte con las demás peticiones en curso (micro-batch);
+    la corrutina espera sin ocupar un hilo. `shapes` (forma del ROI por imagen) sólo se usa
+    con extractor.token_pruning / extractor.polar_unwrap.
+    """
+    sched = _get_scheduler()
+    if sched is None:
+        return await run_in_threadpool(_extract_sync, imgs, batch_size, shapes)
+    if _shape_aware(shapes):
+        futures = await run_in_threadpool(sched.submit_many, imgs, shapes)
+    else:
+        futures = await run_in_threadpool(sched.submit_many, imgs)
+    return list(await asyncio.gather(*(asyncio.wrap_future(f) for f in futures)))
+
+
+def _mask_tokens(metadata: Optional[Dict[str, Any]] = None) -> bool:
+    """
+    kNN/coreset sólo con tokens dentro de la forma; siempre con token_pruning (los podados no tienen
+    embedding). Con `metadata` de una memoria se usa el modo con el que se construyó (las anteriores
+    a inference.mask_tokens, sin la clave, se construyeron sin máscara); si no, el de la config.
+    """
+    if getattr(_extractor, "token_pruning", False):
+        return True
+    if metadata is not None:
+        return bool(metadata.get("mask_tokens", False))
+    return bool(SETTINGS.get("inference", {}).get("mask_tokens", True))
+
+
+def _heatmap_mapping(metadata: Optional[Dict[str, Any]] = None) -> str:
+    """
+    Cómo se llevan los tokens al ROI con la memoria de `metadata` (ver InferenceEngine.run): las
+    anteriores a la clave se calibraron estirando el grid completo ("grid"); las nuevas, "content".
+    """
+    if metadata is not None:
+        return str(metadata.get("heatmap_mapping", "grid"))
+    return "content"
+
+
+def _post_resolution() -> str:
+    """Resolución de trabajo del posproceso de InferenceEngine.run (roi | tokens | x2 | x4)."""
+    return str(SETTINGS.get("inference", {}).get("post_resolution", "roi"))
+
+
+def _cascade_key(roi_id: str) -> str:
+    return f"{roi_id}{CASCADE_SUFFIX}"
+
+
+def _get_cascade_extractor():
+    """Extractor de la pasada barata (mismo modelo, inference.cascade_input_size); None si la cascada no aplica."""
+    global _cascade
+    if not SETTINGS.get("inference", {}).get("cascade", False) or _extractor is None:
+        return None
+    with _cascade_lock:
+        if _cascade is None or _cascade[0] is not _extractor:
+            size = int(SETTINGS.get("inference", {}).get("cascade_input_size", 224))
+            try:
+                low = _extractor.with_input_size(size)
+            except (AttributeError, ValueError) as exc:
+                log.warning("Cascada desactivada con este extractor: %s", exc)
+                low = None
+            _cascade = (_extractor, low)
+        return _cascade[1]
+
+
+def _cascade_extract_sync(low, imgs: List[np.ndarray], shapes: Optional[List[Any]] = None):
+    batch_size = int(SETTINGS.get("inference", {}).get("infer_batch_size", 8))
+    with _cascade_extract_lock:
+        if shapes is not None and getattr(low, "uses_shape", False):
+            return low.extract_batch(imgs, batch_size=batch_size, shapes=shapes)
+        return low.extract_batch(imgs, batch_size=batch_size)
+
+
+def _cascade_items_sync(
+    low, imgs: List[np.ndarray], items: List[Any], shapes: List[Optional[Dict[str, Any]]], binary: bool = False
+) -> Dict[int, tuple]:
+    """
+    Pasada barata de la cascada para los ítems cuyo ROI tiene memoria de cascada: un forward por
+    lote a baja resolución y un score por ítem. Devuelve {índice: (cascade_score, respuesta o None)};
+    la respuesta sólo existe si la calibración acepta la pieza (cascade_decision) y ya no hace falta
+    la pasada completa.
+    """
+    cands: Dict[int, tuple] = {}
+    for i, it in enumerate(items):
+        if not isinstance(it, dict):
+            continue
+        role_id, roi_id = str(it.get("role_id", "")), str(it.get("roi_id", ""))
+        loaded = _load_patchcore(role_id, _cascade_key(roi_id))
+        if loaded is not None:
+            cands[i] = (role_id, roi_id, loaded)
+    if not cands:
+        return {}
+    idxs = list(cands)
+    feats = _cascade_extract_sync(low, [imgs[i] for i in idxs], [shapes[i] for i in idxs])
+
+    out: Dict[int, tuple] = {}
+    for i, (emb, token_hw) in zip(idxs, feats):
+        role_id, roi_id, (mem, token_hw_mem, mem_meta) = cands[i]
+        if tuple(map(int, token_hw)) != tuple(map(int, token_hw_mem)):
+            continue  # memoria de cascada de otro tamaño de ROI: decide la pasada completa
+        calib = _load_calib(role_id, roi_id)
+        thr, _, p_score = _infer_params(calib)
+        with roi_scope(role_id, roi_id):
+            score = InferenceEngine(low, mem, token_hw_mem, mm_per_px=1.0).screen(
+                imgs[i], shape=shapes[i], score_percentile=p_score, embeddings=emb, token_hw=token_hw,
+                mask_tokens=_mask_tokens(mem_meta), heatmap_mapping=_heatmap_mapping(mem_meta),
+            )
+        estimate = cascade_decision(score, calib)
+        payload = None
+        if estimate is not None:
+            payload = {
+                "score": float(estimate),  # estimado en la escala de la pasada completa (< threshold)
+                "threshold": float(thr) if thr is not None else None,
+                "token_shape": [int(token_hw[0]), int(token_hw[1])],
+                "heatmap_mode": str(items[i].get("heatmap") or "none"),
+                ("heatmap_png" if binary else "heatmap_png_base64"): None,
+                "regions": [],
+                "stage": "cascade",
+                "cascade_score": float(score),
+                "cascade_accept": float(calib["cascade_accept"]),
+            }
+        out[i] = (float(score), payload)
+    return out
+
+
+async def _infer_items(imgs: List[np.ndarray], items: List[Any], heatmap: str, binary: bool) -> List[Dict[str, Any]]:
+    """
+    /infer_batch e /infer_frame: con inference.cascade, la pasada barata decide primero y sólo los
+    ítems no aceptados pasan por el extractor completo y `_run_infer_items`. Cada resultado indica
+    `stage` ("cascade" | "full") y, si se calculó, `cascade_score`.
+    """
+    shapes = [_shape_or_none(it.get("shape")) if isinstance(it, dict) else None for it in items]
+    low = _get_cascade_extractor()
+    screened = await run_in_threadpool(_cascade_items_sync, low, imgs, items, shapes, binary) if low is not None else {}
+
+    results: List[Optional[Dict[str, Any]]] = [None] * len(items)
+    for i, (_, payload) in screened.items():
+        if payload is not None:
+            payload["heatmap_mode"] = str(items[i].get("heatmap") or heatmap)
+            results[i] = {"index": i, "role_id": str(items[i].get("role_id", "")),
+                          "roi_id": str(items[i].get("roi_id", "")), **payload}
+    todo = [i for i in range(len(items)) if results[i] is None]
+    if todo:
+        sub_imgs = [imgs[i] for i in todo]
+        feats = await _extract_features(
+            sub_imgs, int(SETTINGS.get("inference", {}).get("infer_batch_size", 8)), [shapes[i] for i in todo]
+        )
+        sub = await run_in_threadpool(
+            _run_infer_items, sub_imgs, [items[i] for i in todo], heatmap=heatmap, binary=binary, feats=feats
+        )
+        for i, res in zip(todo, sub):
+            res["index"] = i
+            if "error" not in res:
+                res["stage"] = "full"
+                if i in screened:
+                    res["cascade_score"] = screened[i][0]
+            results[i] = res
+    return results  # type: ignore[return-value]
+
+
+def _shape_or_none(value: Any) -> Optional[Dict[str, Any]]:
+    """Forma del ROI (dict o JSON); None si falta o no es válida (el error se informa al inferir)."""
+    if isinstance(value, str):
+        try:
+            value = json.loads(value) if value else None
+        except ValueError:
+            return None
+    return value if isinstance(value, dict) else None
+
+
 def _read_image_file(file: UploadFile) -> np.ndarray:
-    data = file.file.read()
-    img_array = np.frombuffer(data, dtype=np.uint8)
-    img = cv2.imdecode(img_array, cv2.IMREAD_COLOR)
+    with stage("decode"):
+        data = file.file.read()
+        img_array = np.frombuffer(data, dtype=np.uint8)
+        img = cv2.imdecode(img_array, cv2.IMREAD_COLOR)
     if img is None:
         raise ValueError("No se pudo decodificar la imagen")
     return img
 
+
+def _read_images(files: List[UploadFile]) -> List[np.ndarray]:
+    return [_read_image_file(uf) for uf in files]
+
+
+def _check_preprocess_mode(role_id: str, roi_id: str, built_with: Optional[Dict[str, Any]]) -> None:
+    """Avisa si la memoria se construyó con otro extractor.preprocess: sus embeddings no son comparables."""
+    current = getattr(_extractor, "preprocess_mode", None)
+    if not built_with or current is None:
+        return
+    built = str(built_with.get("preprocess", "pil"))  # bundles anteriores a la opción: ruta PIL
+    if built != current:
+        log.warning(
+            "Memoria %s/%s construida con preprocess=%s y el extractor usa %s: rehaz /fit_ok o "
+            "ajusta extractor.preprocess", role_id, roi_id, built, current,
+        )
+
+
+def _build_patchcore(role_id: str, roi_id: str, mmap: bool = True):
+    """
+    Carga memoria (+FAISS si existe) de disco; devuelve (mem, token_hw, metadata) o None.
+    Embeddings, índice y proyección salen de la misma versión del bundle (`store.load_bundle`).
+    Con `mmap` los embeddings/índice del bundle se mapean (sólo lectura); usa mmap=False
+    si la memoria se va a modificar (p.ej. /fit_ok con append).
+    """
+    loaded = store.load_bundle(role_id, roi_id, mmap=mmap)
+    if loaded is None:
+        return None
+    metadata = loaded["metadata"]
+    token_hw_mem = loaded["token_hw"]
+    _check_preprocess_mode(role_id, roi_id, loaded["extractor"])
+
+    idx = loaded["index"]
+    if idx is not None:
+        apply_search_params(idx, metadata.get("index_params"))
+    arrays = loaded["projection"]
+    projection = (
+        Projection(str(metadata.get("projection", "pca")), arrays["matrix"], arrays.get("mean"))
+        if arrays is not None else None
+    )
+    # Con índice FAISS no se reajusta NearestNeighbors
+    mem = PatchCoreMemory(
+        embeddings=loaded["embeddings"], index=idx, coreset_rate=metadata.get("coreset_rate"), projection=projection
+    )
+    return mem, (int(token_hw_mem[0]), int(token_hw_mem[1])), metadata
+
+
+def _load_patchcore(role_id: str, roi_id: str):
+    """Memoria PatchCore lista para consultar, servida desde la caché LRU si está caliente."""
+    return memory_cache.get_memory(
+        role_id, roi_id, lambda: _build_patchcore(role_id, roi_id), stamp=store.stamp(role_id, roi_id)
+    )
+
+
+def _load_calib(role_id: str, roi_id: str):
+    return memory_cache.get_calib(
+        role_id, roi_id, lambda: store.load_calib(role_id, roi_id, default=None), stamp=store.stamp(role_id, roi_id)
+    )
+
+
 @app.get("/health")
 def health():
     import torch
-    return {
-        "status": "ok",
+    # Arranque fallido: no-200 para que el orquestador reinicie el worker (las peticiones lo reintentan)
+    failed = startup.state == STARTUP_ERROR
+    body = {
+        "status": "error" if failed else "ok",
         "device": "cuda" if torch.cuda.is_available() else "cpu",
         "model": "vit_small_patch14_dinov2.lvd142m",
         "version": "0.1.0",
+        "ready": _extractor is not None and not startup.busy,
+        "startup": startup.snapshot(),
+        "cache": memory_cache.stats(),
+        "scheduler": _scheduler.stats() if _scheduler is not None else None,
     }
+    return JSONResponse(status_code=503, content=body) if failed else body
+
+
+@app.get("/metrics")
+def metrics():
+    """Histogramas de latencia (total y por etapa/ROI) en formato texto de Prometheus, por proceso."""
+    cache = memory_cache.stats()
+    gauges = [
+        ("bdi_cache_bytes", "Bytes en la caché LRU de memorias.", cache.get("bytes", 0)),
+        ("bdi_cache_entries", "Entradas en la caché LRU de memorias.", cache.get("entries", 0)),
+    ]
+    counters = [
+        ("bdi_cache_hits_total", "Aciertos de la caché de memorias.", cache.get("hits", 0)),
+        ("bdi_cache_misses_total", "Fallos de la caché de memorias.", cache.get("misses", 0)),
+        ("bdi_cache_evictions_total", "Entradas expulsadas de la caché por el presupuesto.", cache.get("evictions", 0)),
+        ("bdi_cache_stale_total", "Entradas recargadas porque cambiaron en disco.", cache.get("stale", 0)),
+    ]
+    if _scheduler is not None:
+        sched = _scheduler.stats()
+        gauges += [
+            ("bdi_scheduler_queued", "Imágenes en cola del scheduler.", sched["queued"]),
+            ("bdi_scheduler_avg_batch", "Tamaño medio de lote del scheduler.", sched["avg_batch"]),
+        ]
+    return PlainTextResponse(metrics_registry.render(gauges, counters), media_type="text/plain; version=0.0.4")
 
 @app.post("/fit_ok")
-def fit_ok(
+async def fit_ok(
     role_id: str = Form(...),
     roi_id: str = Form(...),
     mm_per_px: float = Form(...),
     images: List[UploadFile] = File(...),
     memory_fit: bool = Form(False),
+    append: bool = Form(False),
+    index_type: Optional[str] = Form(None),
+    projection: Optional[str] = Form(None),
+    projection_dim: Optional[int] = Form(None),
+    shape: Optional[str] = Form(None),
 ):
     """
     Acumula OKs para construir la memoria PatchCore (coreset + kNN).
     Guarda (role_id, roi_id): memoria (embeddings), token grid y, si hay FAISS, el índice.
+    Con append=true amplía la memoria existente con el coreset de las imágenes nuevas
+    (coste proporcional a lo enviado); si aún no hay memoria, equivale a un fit normal.
+    index_type (flat | ivf_flat | hnsw | ivf_pq | sq8) elige el índice kNN del ROI; los
+    aproximados reportan su recall frente a la búsqueda exacta.
+    projection (none | pca | random) + projection_dim reducen la dimensión de la memoria; la
+    respuesta incluye la varianza retenida y la correlación de distancias/scores sin proyectar.
+    Con append se reutiliza la proyección guardada.
+    shape (JSON rect/circle/annulus, como en /infer): el coreset sólo usa los tokens que la
+    solapan; sin shape se descarta igualmente el padding del letterbox (inference.mask_tokens).
     """
     try:
+        not_ready = await _not_ready()
+        if not_ready is not None:
+            return not_ready
         if not images:
             return JSONResponse(status_code=400, content={"error": "No images provided"})
+        if index_type and index_type.lower() not in INDEX_TYPES:
+            return JSONResponse(
+                status_code=400,
+                content={"error": f"index_type no soportado: {index_type}. Opciones: {list(INDEX_TYPES)}"},
+            )
+        if projection and projection.lower() not in PROJECTIONS:
+            return JSONResponse(
+                status_code=400,
+                content={"error": f"projection no soportada: {projection}. Opciones: {list(PROJECTIONS)}"},
+            )
+        try:
+            shape_obj = json.loads(shape) if shape else None
+        except ValueError:
+            return JSONResponse(status_code=400, content={"error": f"shape no es JSON válido: {shape}"})
 
-        all_emb: List[np.ndarray] = []
-        token_hw: Optional[tuple[int, int]] = None
+        # Forward por lotes (B,3,H,W) en vez de imagen a imagen
+        imgs = await run_in_threadpool(_read_images, images)
+        fit_batch_size = int(SETTINGS.get("inference", {}).get("fit_batch_size", 8))
+        feats = await _extract_features(imgs, fit_batch_size, [shape_obj] * len(imgs))
 
-        for uf in images:
-            img = _read_image_file(uf)
-            emb, hw = _extractor.extract(img)
-            if token_hw is None:
-                token_hw = (int(hw[0]), int(hw[1]))
+        # Coreset + índice + persistencia (CPU) fuera del event loop
+        sizes = [img.shape[:2] for img in imgs]
+        result = await run_in_threadpool(
+            _fit_from_features, role_id, roi_id, feats, memory_fit, append, index_type, projection, projection_dim,
+            shape_obj, sizes,
+        )
+
+        # Cascada: memoria propia de la pasada barata con las mismas imágenes y opciones
+        low = _get_cascade_extractor()
+        if low is not None and isinstance(result, dict):
+            low_feats = await run_in_threadpool(_cascade_extract_sync, low, imgs, [shape_obj] * len(imgs))
+            low_result = await run_in_threadpool(
+                _fit_from_features, role_id, _cascade_key(roi_id), low_feats, memory_fit, append, index_type,
+                projection, projection_dim, shape_obj, sizes, low,
+            )
+            if isinstance(low_result, dict):
+                result["cascade"] = {
+                    "input_size": int(low.input_size),
+                    **{k: low_result[k] for k in ("coreset_size", "token_shape", "n_embeddings_total") if k in low_result},
+                }
             else:
-                if (int(hw[0]), int(hw[1])) != token_hw:
-                    return JSONResponse(
-                        status_code=400,
-                        content={"error": f"Token grid mismatch: got {hw}, expected {token_hw}"},
-                    )
-            all_emb.append(emb)
+                result["cascade"] = {"error": json.loads(low_result.body).get("error")}
+        return result
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"error": str(e), "trace": traceback.format_exc()})
+
+
+def _fit_from_features(
+    role_id: str,
+    roi_id: str,
+    feats,
+    memory_fit: bool,
+    append: bool,
+    index_type: Optional[str],
+    projection: Optional[str] = None,
+    projection_dim: Optional[int] = None,
+    shape: Optional[Dict[str, Any]] = None,
+    img_sizes: Optional[List[tuple]] = None,
+    extractor: Any = None,
+):
+    """`extractor` (por defecto el global) con el que se extrajeron `feats`: p.ej. el de la cascada."""
+    extractor = extractor if extractor is not None else _extractor
+    all_emb: List[np.ndarray] = []
+    token_hw: Optional[tuple[int, int]] = None
+    # Modo incremental: se parte de la memoria guardada (copia fresca, no la de la caché) y de su modo de máscara
+    existing = _build_patchcore(role_id, roi_id, mmap=False) if append else None
+    mask_tokens = _mask_tokens(existing[2] if existing is not None else None) and img_sizes is not None
+    heatmap_mapping = _heatmap_mapping(existing[2] if existing is not None else None)
+    n_tokens = 0
+    for i, (emb, hw) in enumerate(feats):
+        if token_hw is None:
+            token_hw = (int(hw[0]), int(hw[1]))
+        else:
+            if (int(hw[0]), int(hw[1])) != token_hw:
+                return JSONResponse(
+                    status_code=400,
+                    content={"error": f"Token grid mismatch: got {hw}, expected {token_hw}"},
+                )
+        n_tokens += int(emb.shape[0])
+        # Fuera de la forma del ROI (padding, cubo/esquinas del anillo) no hay nada que aprender
+        keep = roi_token_mask(extractor, img_sizes[i], shape, token_hw) if mask_tokens else None
+        all_emb.append(emb[keep] if keep is not None else emb)
 
-        if not all_emb:
-            return JSONResponse(status_code=400, content={"error": "No valid images"})
+    if not all_emb:
+        return JSONResponse(status_code=400, content={"error": "No valid images"})
 
-        E = np.concatenate(all_emb, axis=0)  # (N, D)
+    E = np.concatenate(all_emb, axis=0)  # (N, D)
 
-        # Coreset (puedes ajustar coreset_rate)
-        coreset_rate = float(SETTINGS.get("inference", {}).get("coreset_rate", 0.02))
-        if memory_fit:
-            coreset_rate = 1.0
-        mem = PatchCoreMemory.build(E, coreset_rate=coreset_rate, seed=0)
+    # Coreset (puedes ajustar coreset_rate)
+    coreset_rate = float(SETTINGS.get("inference", {}).get("coreset_rate", 0.02))
+    if memory_fit:
+        coreset_rate = 1.0
+    inference_cfg = SETTINGS.get("inference", {})
+    coreset_kwargs = {
+        "coreset_rate": coreset_rate,
+        "seed": 0,
+        "coreset_method": str(inference_cfg.get("coreset_method", "exact")),
+        "proj_dim": int(inference_cfg.get("coreset_proj_dim", 128)),
+    }
+
+    if existing is not None:
+        mem, token_hw_mem, prev_meta = existing
+        if tuple(token_hw_mem) != tuple(token_hw):
+            return JSONResponse(
+                status_code=400,
+                content={"error": f"Token grid mismatch: got {token_hw}, expected {tuple(token_hw_mem)}"},
+            )
+        n_total = int(prev_meta.get("n_embeddings", mem.emb.shape[0])) + int(E.shape[0])
+        # El coreset se amplía con el método con el que se construyó (las memorias anteriores, exact)
+        coreset_kwargs["coreset_method"] = str(prev_meta.get("coreset_method") or "exact")
+        coreset_kwargs["proj_dim"] = int(prev_meta.get("coreset_proj_dim") or coreset_kwargs["proj_dim"])
+        # El índice (y la proyección) existentes se amplían tal cual: se conservan tipo y parámetros
+        build_stats = {
+            k: prev_meta[k]
+            for k in ("index_type", "index_params", "projection", "projection_dim", "projection_input_dim",
+                      "projection_retained_variance")
+            if k in prev_meta
+        }
+        with stage("coreset"):
+            build_stats.update(mem.extend(E, **coreset_kwargs))
+    else:
+        groups = np.concatenate([np.full(e.shape[0], i, dtype=np.int32) for i, e in enumerate(all_emb)])
+        with stage("coreset"):
+            mem = PatchCoreMemory.build(
+                E,
+                index_type=(index_type or str(inference_cfg.get("index_type", "flat"))),
+                index_params=inference_cfg.get("index_params") or None,
+                projection=(projection or str(inference_cfg.get("projection", "none"))),
+                projection_dim=int(projection_dim or inference_cfg.get("projection_dim", 128)),
+                groups=groups,
+                score_percentile=int(inference_cfg.get("score_percentile", 99)),
+                **coreset_kwargs,
+            )
+        n_total = int(E.shape[0])
+        build_stats = dict(getattr(mem, "build_stats", None) or {})
 
-        # Persistir memoria + token grid
-        applied_rate = float(mem.emb.shape[0]) / float(E.shape[0]) if E.shape[0] > 0 else 0.0
-        store.save_memory(
+    # Persistir memoria + token grid + índice FAISS (si existe) en un único bundle
+    applied_rate = float(mem.emb.shape[0]) / float(n_total) if n_total > 0 else 0.0
+    index_blob = None
+    if mem.index is not None:
+        try:
+            import faiss  # type: ignore
+            index_blob = bytes(faiss.serialize_index(mem.index))
+        except Exception:
+            index_blob = None
+    get_meta = getattr(extractor, "get_metadata", None)
+    with stage("save"):
+        store.save_bundle(
             role_id,
             roi_id,
             mem.emb,
@@ -152,27 +801,28 @@ def fit_ok(
             metadata={
                 "coreset_rate": float(coreset_rate),
                 "applied_rate": float(applied_rate),
+                "n_embeddings": int(n_total),
+                **build_stats,
+                "mask_tokens": bool(mask_tokens),
+                "heatmap_mapping": heatmap_mapping,
             },
+            index_blob=index_blob,
+            extractor=get_meta() if callable(get_meta) else None,
+            projection=mem.projection.arrays() if getattr(mem, "projection", None) is not None else None,
         )
+    memory_cache.invalidate(role_id, roi_id, kind="memory")
 
-        # Persistir índice FAISS si está disponible
-        try:
-            import faiss  # type: ignore
-            if mem.index is not None:
-                buf = faiss.serialize_index(mem.index)
-                store.save_index_blob(role_id, roi_id, bytes(buf))
-        except Exception:
-            pass
-
-        return {
-            "n_embeddings": int(E.shape[0]),
-            "coreset_size": int(mem.emb.shape[0]),
-            "token_shape": [int(token_hw[0]), int(token_hw[1])],
-            "coreset_rate_requested": float(coreset_rate),
-            "coreset_rate_applied": float(applied_rate),
-        }
-    except Exception as e:
-        return JSONResponse(status_code=500, content={"error": str(e), "trace": traceback.format_exc()})
+    return {
+        "n_embeddings": int(E.shape[0]),
+        "coreset_size": int(mem.emb.shape[0]),
+        "token_shape": [int(token_hw[0]), int(token_hw[1])],
+        "coreset_rate_requested": float(coreset_rate),
+        "coreset_rate_applied": float(applied_rate),
+        "appended": existing is not None,
+        "n_embeddings_total": int(n_total),
+        "token_keep_ratio": float(E.shape[0]) / float(max(n_tokens, 1)),
+        **build_stats,
+    }
 
 @app.post("/calibrate_ng")
 async def calibrate_ng(payload: Dict[str, Any]):
@@ -180,6 +830,9 @@ async def calibrate_ng(payload: Dict[str, Any]):
     Fija umbral por ROI/rol con 0–3 NG.
     Si hay NG: umbral entre p99(OK) y p5(NG). Si no: p99(OK).
     Devuelve siempre 'threshold' como float (nunca null).
+    Con `ok_cascade_scores` (y opcionalmente `ng_cascade_scores`), los `cascade_score` de /infer
+    emparejados con ok_scores/ng_scores, ajusta además el margen de aceptación temprana de la cascada
+    (400 si falta algún par: con ng_scores, ng_cascade_scores es obligatorio).
     """
     try:
         role_id = payload["role_id"]
@@ -215,39 +868,190 @@ async def calibrate_ng(payload: Dict[str, Any]):
             "area_mm2_thr": float(area_mm2_thr),
             "score_percentile": int(p_score),
         }
+        if payload.get("ok_cascade_scores") is not None or payload.get("ng_cascade_scores") is not None:
+            try:
+                calib.update(choose_cascade_accept(
+                    ok_scores,
+                    np.asarray(payload.get("ok_cascade_scores") or [], dtype=float),
+                    float(t),
+                    ng_scores,
+                    np.asarray(payload.get("ng_cascade_scores") or [], dtype=float),
+                    margin=float(SETTINGS.get("inference", {}).get("cascade_margin", 0.05)),
+                ))
+            except ValueError as e:
+                return JSONResponse(status_code=400, content={"error": str(e)})
         store.save_calib(role_id, roi_id, calib)
+        memory_cache.invalidate(role_id, roi_id, kind="calib")
         return calib
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e), "trace": traceback.format_exc()})
 
 
+def _heatmap_png_bytes(hm_u8: np.ndarray) -> Optional[bytes]:
+    hm_u8 = np.asarray(hm_u8, dtype=np.uint8)
+    try:
+        ok, png = cv2.imencode(".png", hm_u8)
+        if ok:
+            return png.tobytes()
+        return None
+    except Exception:
+        from PIL import Image
+        import io
+        pil = Image.fromarray(hm_u8, mode="L")
+        buf = io.BytesIO()
+        pil.save(buf, format="PNG")
+        return buf.getvalue()
+
+
+# Modo de heatmap de la API -> modo de InferenceEngine.run
+HEATMAP_RESPONSE_MODES = {"png": "full", "tokens": "tokens", "none": "none", "on_fail": "on_fail"}
+RESPONSE_FORMATS = ("json", "msgpack")
+
+
+def _check_response_opts(heatmap: str, response_format: str) -> Optional[JSONResponse]:
+    """Valida heatmap/response_format; devuelve la respuesta 400 o None si son válidos."""
+    if heatmap not in HEATMAP_RESPONSE_MODES:
+        return JSONResponse(
+            status_code=400,
+            content={"error": f"heatmap debe ser uno de {list(HEATMAP_RESPONSE_MODES)}"},
+        )
+    if response_format not in RESPONSE_FORMATS:
+        return JSONResponse(status_code=400, content={"error": f"response_format debe ser uno de {list(RESPONSE_FORMATS)}"})
+    if response_format == "msgpack" and msgpack is None:
+        return JSONResponse(
+            status_code=400,
+            content={"error": "response_format=msgpack requiere el paquete 'msgpack' (pip install msgpack)"},
+        )
+    return None
+
+
+def _respond(payload: Dict[str, Any], response_format: str):
+    # Serializado aquí (no en FastAPI) para que cuente en la etapa "encode"
+    with stage("encode"):
+        if response_format == "msgpack":
+            return Response(content=msgpack.packb(payload, use_bin_type=True), media_type="application/x-msgpack")
+        return JSONResponse(content=payload)
+
+
+def _infer_params(calib: Optional[Dict[str, Any]]):
+    """(threshold, area_mm2_thr, score_percentile) de la calibración o de SETTINGS."""
+    inference_cfg = SETTINGS.get("inference", {})
+    thr = calib.get("threshold") if calib else None
+    area_mm2_thr = calib.get("area_mm2_thr", inference_cfg.get("area_mm2_thr", 1.0)) if calib else inference_cfg.get("area_mm2_thr", 1.0)
+    p_score = calib.get("score_percentile", inference_cfg.get("score_percentile", 99)) if calib else inference_cfg.get("score_percentile", 99)
+    return thr, float(area_mm2_thr), int(p_score)
+
+
+def _format_infer_result(res, thr, token_hw_mem, heatmap: str = "png", binary: bool = False) -> Dict[str, Any]:
+    """
+    Normaliza la salida de engine.run (dict nuevo o tupla antigua) a la respuesta de /infer.
+
+    heatmap: "png" (PNG del ROI completo), "tokens" (uint8 Ht x Wt sin comprimir, lo reescala
+    el cliente), "none" u "on_fail" (PNG solo si score >= threshold).
+    binary: respuesta msgpack; los bytes van en crudo ("heatmap_png", "heatmap_tokens.data")
+    en lugar de base64.
+    """
+    score: float
+    regions = []
+    hm_u8 = None
+    hm_tokens = None
+    token_shape_out = [int(token_hw_mem[0]), int(token_hw_mem[1])]
+
+    if isinstance(res, dict):
+        score = float(res.get("score", 0.0))
+        regions = res.get("regions") or []
+        token_shape_out = list(res.get("token_shape") or token_shape_out)
+        # heatmap puede venir como uint8 ("heatmap_u8") o como float32 ("heatmap")
+        hm_u8 = res.get("heatmap_u8")
+        if hm_u8 is None:
+            hm = res.get("heatmap")
+            if hm is not None:
+                hm_u8 = np.clip(np.asarray(hm, dtype=np.float32) * 255.0, 0, 255).astype(np.uint8)
+        hm_tokens = res.get("heatmap_tokens_u8")
+    else:
+        # Compat tupla antigua: (score, heatmap_float, regions)
+        score, heatmap_f32, regions = res
+        hm_u8 = np.clip(np.asarray(heatmap_f32, dtype=np.float32) * 255.0, 0, 255).astype(np.uint8)
+
+    send_png = heatmap == "png" or (heatmap == "on_fail" and thr is not None and score >= float(thr))
+    png = None
+    if send_png and hm_u8 is not None:
+        with stage("encode"):
+            png = _heatmap_png_bytes(hm_u8)
+
+    # threshold puede ser None → se serializa como null
+    out: Dict[str, Any] = {
+        "score": float(score),
+        "threshold": (float(thr) if thr is not None else None),
+        "token_shape": [int(token_shape_out[0]), int(token_shape_out[1])],
+        "heatmap_mode": heatmap,
+    }
+    if binary:
+        out["heatmap_png"] = png
+    else:
+        out["heatmap_png_base64"] = base64.b64encode(png).decode("ascii") if png is not None else None
+    if heatmap == "tokens" and hm_tokens is not None:
+        hm_tokens = np.ascontiguousarray(hm_tokens, dtype=np.uint8)
+        data = hm_tokens.tobytes()
+        out["heatmap_tokens"] = {
+            "shape": [int(hm_tokens.shape[0]), int(hm_tokens.shape[1])],
+            "dtype": "uint8",
+            **({"data": data} if binary else {"data_base64": base64.b64encode(data).decode("ascii")}),
+        }
+    out["regions"] = regions or []
+    return out
+
+
 @app.post("/infer")
-def infer(
+async def infer(
     role_id: str = Form(...),
     roi_id: str = Form(...),
     mm_per_px: float = Form(...),
     image: UploadFile = File(...),
     shape: Optional[str] = Form(None),
+    heatmap: str = Form("png"),
+    response_format: str = Form("json"),
 ):
     try:
-        import json, base64, numpy as np
-        try:
-            import cv2  # opcional para PNG rápido
-            _has_cv2 = True
-        except Exception:
-            _has_cv2 = False
-            from PIL import Image
-            import io
+        bad = _check_response_opts(heatmap, response_format) or await _not_ready()
+        if bad is not None:
+            return bad
+
+        # 1) Imagen; con cascada, la pasada barata puede aceptar la pieza sin la completa
+        img = await run_in_threadpool(_read_image_file, image)
+        extra: Dict[str, Any] = {"stage": "full"}
+        low = _get_cascade_extractor()
+        if low is not None:
+            item = {"role_id": role_id, "roi_id": roi_id, "heatmap": heatmap}
+            screened = await run_in_threadpool(
+                _cascade_items_sync, low, [img], [item], [_shape_or_none(shape)], response_format == "msgpack"
+            )
+            if 0 in screened:
+                cascade_score, payload = screened[0]
+                if payload is not None:
+                    return _respond(payload, response_format)
+                extra["cascade_score"] = cascade_score
+
+        # Features (un único forward, compartido vía scheduler; se reutilizan en engine.run)
+        batch_size = int(SETTINGS.get("inference", {}).get("infer_batch_size", 8))
+        (emb, token_hw), = await _extract_features([img], batch_size, [_shape_or_none(shape)])
+
+        # 2..8) kNN + posproceso (CPU) fuera del event loop
+        return await run_in_threadpool(
+            _infer_from_features, role_id, roi_id, mm_per_px, img, emb, token_hw, shape, heatmap, response_format,
+            extra,
+        )
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"error": str(e), "trace": traceback.format_exc()})
 
-        # 1) Imagen y features (sólo para verificar grid)
-        img = _read_image_file(image)
-        emb, token_hw = _extractor.extract(img)
 
-        # 2) Cargar memoria/coreset
-        loaded = store.load_memory(role_id, roi_id)
+def _infer_from_features(role_id, roi_id, mm_per_px, img, emb, token_hw, shape, heatmap, response_format, extra=None):
+    with roi_scope(role_id, roi_id):
+        # 2) Memoria/coreset (+FAISS) desde la caché LRU
+        loaded = _load_patchcore(role_id, roi_id)
         if loaded is None:
             return JSONResponse(status_code=400, content={"error": "Memoria no encontrada. Ejecuta /fit_ok primero."})
-        emb_mem, token_hw_mem, metadata = loaded
+        mem, token_hw_mem, metadata = loaded
 
         # 3) Validación de grid aquí (clara al usuario)
         if tuple(map(int, token_hw)) != tuple(map(int, token_hw_mem)):
@@ -256,35 +1060,23 @@ def infer(
                 content={"error": f"Token grid mismatch: got {tuple(map(int,token_hw))}, expected {tuple(map(int,token_hw_mem))}"},
             )
 
-        # 4) Reconstruir memoria (+FAISS si existe)
-        mem = PatchCoreMemory(embeddings=emb_mem, index=None, coreset_rate=metadata.get("coreset_rate"))
-        try:
-            import faiss  # type: ignore
-            blob = store.load_index_blob(role_id, roi_id)
-            if blob is not None:
-                idx = faiss.deserialize_index(np.frombuffer(blob, dtype=np.uint8))
-                mem.index = idx
-                mem.nn = None
-        except Exception:
-            pass
-
-        # 5) Calibración (puede faltar)
-        calib = store.load_calib(role_id, roi_id, default=None)
-        thr = calib.get("threshold") if calib else None
-        area_mm2_thr = calib.get("area_mm2_thr", SETTINGS.get("inference", {}).get("area_mm2_thr", 1.0)) if calib else SETTINGS.get("inference", {}).get("area_mm2_thr", 1.0)
-        p_score = calib.get("score_percentile", SETTINGS.get("inference", {}).get("score_percentile", 99)) if calib else SETTINGS.get("inference", {}).get("score_percentile", 99)
+        # 4) Calibración (puede faltar)
+        thr, area_mm2_thr, p_score = _infer_params(_load_calib(role_id, roi_id))
 
-        # 6) Shape (máscara) opcional
-        shape_obj = json.loads(shape) if shape else None
+        # 5) Shape (máscara) opcional
+        try:
+            shape_obj = json.loads(shape) if shape else None
+        except ValueError:
+            return JSONResponse(status_code=400, content={"error": f"shape no es JSON válido: {shape}"})
 
-        # 7) Crear engine con lo que tu __init__ soporte
+        # 6) Crear engine con lo que tu __init__ soporte
         try:
             engine = InferenceEngine(_extractor, mem, token_hw_mem, mm_per_px=float(mm_per_px))
         except TypeError:
             # Si tu __init__ no acepta mm_per_px
             engine = InferenceEngine(_extractor, mem, token_hw_mem)
 
-        # 8) Ejecutar run() (probar con token_shape_expected y si no reintentar sin él)
+        # 7) Ejecutar run() (probar con token_shape_expected y si no reintentar sin él)
         try:
             res = engine.run(
                 img,
@@ -293,6 +1085,12 @@ def infer(
                 threshold=thr,
                 area_mm2_thr=float(area_mm2_thr),
                 score_percentile=int(p_score),
+                embeddings=emb,
+                token_hw=token_hw,
+                heatmap=HEATMAP_RESPONSE_MODES[heatmap],
+                mask_tokens=_mask_tokens(metadata),
+                post_resolution=_post_resolution(),
+                heatmap_mapping=_heatmap_mapping(metadata),
             )
         except TypeError:
             res = engine.run(
@@ -303,60 +1101,209 @@ def infer(
                 score_percentile=int(p_score),
             )
 
-        # 9) Normalizar salida (dict nuevo o tupla antigua)
-        score: float
-        regions = []
-        heatmap_png_b64 = None
-        token_shape_out = [int(token_hw_mem[0]), int(token_hw_mem[1])]
-
-        if isinstance(res, dict):
-            score = float(res.get("score", 0.0))
-            regions = res.get("regions") or []
-            token_shape_out = list(res.get("token_shape") or token_shape_out)
-            # heatmap puede venir como uint8 ("heatmap_u8") o como float32 ("heatmap")
-            hm_u8 = res.get("heatmap_u8")
-            if hm_u8 is None:
-                hm = res.get("heatmap")
-                if hm is not None:
-                    hm_u8 = np.clip(np.asarray(hm, dtype=np.float32) * 255.0, 0, 255).astype(np.uint8)
-            if hm_u8 is not None:
-                if _has_cv2:
-                    ok, png = cv2.imencode(".png", np.asarray(hm_u8, dtype=np.uint8))
-                    if ok:
-                        heatmap_png_b64 = base64.b64encode(png.tobytes()).decode("ascii")
-                else:
-                    pil = Image.fromarray(np.asarray(hm_u8, dtype=np.uint8), mode="L")
-                    buf = io.BytesIO()
-                    pil.save(buf, format="PNG")
-                    heatmap_png_b64 = base64.b64encode(buf.getvalue()).decode("ascii")
-        else:
-            # Compat tupla antigua: (score, heatmap_float, regions)
-            score, heatmap_f32, regions = res
-            hm_u8 = np.clip(np.asarray(heatmap_f32, dtype=np.float32) * 255.0, 0, 255).astype(np.uint8)
-            if _has_cv2:
-                ok, png = cv2.imencode(".png", hm_u8)
-                if ok:
-                    heatmap_png_b64 = base64.b64encode(png.tobytes()).decode("ascii")
-            else:
-                pil = Image.fromarray(hm_u8, mode="L")
-                buf = io.BytesIO()
-                pil.save(buf, format="PNG")
-                heatmap_png_b64 = base64.b64encode(buf.getvalue()).decode("ascii")
-
-        # 10) Respuesta (threshold puede ser None → se serializa como null)
-        return {
-            "score": float(score),
-            "threshold": (float(thr) if thr is not None else None),
-            "token_shape": [int(token_shape_out[0]), int(token_shape_out[1])],
-            "heatmap_png_base64": heatmap_png_b64,
-            "regions": regions or [],
+        # 8) Normalizar salida (dict nuevo o tupla antigua)
+        binary = response_format == "msgpack"
+        return _respond({**_format_infer_result(res, thr, token_hw_mem, heatmap, binary), **(extra or {})}, response_format)
+
+
+def _run_infer_items(
+    imgs: List[np.ndarray],
+    items: List[Dict[str, Any]],
+    heatmap: str = "png",
+    binary: bool = False,
+    feats: Optional[List[Any]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Inferencia de N ROIs con un único forward por lote del extractor y una búsqueda kNN
+    por memoria (los tokens de los ítems con el mismo (role_id, roi_id) se consultan juntos).
+    Los errores de un ítem se devuelven en su propio resultado sin abortar el resto.
+    Cada ítem puede sobrescribir el modo `heatmap` de la petición. `feats` son los embeddings
+    ya extraídos (p.ej. vía scheduler); si faltan se extraen aquí.
+    """
+    if feats is None:
+        feats = _extract_sync(
+            imgs, int(SETTINGS.get("inference", {}).get("infer_batch_size", 8)),
+            [_shape_or_none(it.get("shape")) for it in items],
+        )
+
+    results: List[Dict[str, Any]] = [
+        {"index": i, "role_id": str(it.get("role_id", "")), "roi_id": str(it.get("roi_id", ""))}
+        for i, it in enumerate(items)
+    ]
+
+    # 1) Agrupar por memoria, validar grid y forma del ROI
+    groups: Dict[tuple, List[int]] = {}
+    memories: Dict[tuple, Any] = {}
+    shapes: Dict[int, Optional[Dict[str, Any]]] = {}
+    for i, it in enumerate(items):
+        key = (results[i]["role_id"], results[i]["roi_id"])
+        if key not in memories:
+            memories[key] = _load_patchcore(*key)
+        loaded = memories[key]
+        if loaded is None:
+            results[i]["error"] = "Memoria no encontrada. Ejecuta /fit_ok primero."
+            continue
+        token_hw = tuple(map(int, feats[i][1]))
+        if token_hw != tuple(map(int, loaded[1])):
+            results[i]["error"] = f"Token grid mismatch: got {token_hw}, expected {tuple(map(int, loaded[1]))}"
+            continue
+        try:
+            shape_obj = it.get("shape")
+            shapes[i] = json.loads(shape_obj) if isinstance(shape_obj, str) and shape_obj else (shape_obj or None)
+        except ValueError as e:
+            results[i]["error"] = f"shape no es JSON válido: {e}"
+            continue
+        groups.setdefault(key, []).append(i)
+
+    # 2) Una consulta kNN por memoria, sólo con los tokens dentro de la forma de cada ROI
+    distances: Dict[int, np.ndarray] = {}
+    for key, idxs in groups.items():
+        mem = memories[key][0]
+        mask_tokens = _mask_tokens(memories[key][2])
+        keeps = {
+            i: roi_token_mask(_extractor, imgs[i].shape[:2], shapes[i], feats[i][1]) if mask_tokens else None
+            for i in idxs
         }
+        queries = [feats[i][0][keeps[i]] if keeps[i] is not None else feats[i][0] for i in idxs]
+        with roi_scope(*key):
+            d = mem.knn_min_dist(np.concatenate(queries, axis=0))
+        offset = 0
+        for i, q in zip(idxs, queries):
+            n = q.shape[0]
+            if keeps[i] is None:
+                distances[i] = d[offset:offset + n]
+            else:
+                # los tokens excluidos los rellena engine.run (mask_tokens) con su vecino conservado
+                distances[i] = np.zeros(feats[i][0].shape[0], dtype=np.float32)
+                distances[i][keeps[i]] = d[offset:offset + n]
+            offset += n
+
+    # 3) Posproceso por ítem
+    for key, idxs in groups.items():
+        mem, token_hw_mem, metadata = memories[key]
+        thr, area_mm2_thr, p_score = _infer_params(_load_calib(*key))
+        with roi_scope(*key):
+            for i in idxs:
+                it = items[i]
+                try:
+                    hm_mode = str(it.get("heatmap") or heatmap)
+                    if hm_mode not in HEATMAP_RESPONSE_MODES:
+                        raise ValueError(f"heatmap debe ser uno de {list(HEATMAP_RESPONSE_MODES)}")
+                    shape_obj = shapes[i]
+                    engine = InferenceEngine(_extractor, mem, token_hw_mem, mm_per_px=float(it.get("mm_per_px", 0.2)))
+                    res = engine.run(
+                        imgs[i],
+                        token_shape_expected=tuple(map(int, token_hw_mem)),
+                        shape=shape_obj,
+                        threshold=thr,
+                        area_mm2_thr=area_mm2_thr,
+                        score_percentile=p_score,
+                        embeddings=feats[i][0],
+                        token_hw=feats[i][1],
+                        distances=distances[i],
+                        heatmap=HEATMAP_RESPONSE_MODES[hm_mode],
+                        mask_tokens=_mask_tokens(metadata),
+                        post_resolution=_post_resolution(),
+                        heatmap_mapping=_heatmap_mapping(metadata),
+                    )
+                    results[i].update(_format_infer_result(res, thr, token_hw_mem, hm_mode, binary))
+                except Exception as e:
+                    results[i]["error"] = str(e)
+    return results
+
 
+@app.post("/infer_batch")
+async def infer_batch(
+    items: str = Form(...),
+    images: List[UploadFile] = File(...),
+    heatmap: str = Form("png"),
+    response_format: str = Form("json"),
+):
+    """
+    Inferencia de varios ROIs en una petición: `items` es un JSON con una entrada por imagen
+    (mismo orden) {"role_id", "roi_id", "mm_per_px", "shape"?}. Todas las imágenes pasan por
+    DINOv2 en lote; devuelve {"results": [...]} con el formato de /infer (+index/role_id/roi_id)
+    o {"error": ...} por ítem. `heatmap`/`response_format` como en /infer.
+    """
+    try:
+        bad = _check_response_opts(heatmap, response_format) or await _not_ready()
+        if bad is not None:
+            return bad
+        try:
+            items_obj = json.loads(items)
+        except Exception:
+            return JSONResponse(status_code=400, content={"error": "items debe ser una lista JSON"})
+        if not isinstance(items_obj, list) or not items_obj:
+            return JSONResponse(status_code=400, content={"error": "items debe ser una lista JSON no vacía"})
+        if len(items_obj) != len(images):
+            return JSONResponse(
+                status_code=400,
+                content={"error": f"items ({len(items_obj)}) e images ({len(images)}) deben tener la misma longitud"},
+            )
+        bad_item = next((i for i, it in enumerate(items_obj) if not isinstance(it, dict)), None)
+        if bad_item is not None:
+            return JSONResponse(status_code=400, content={"error": f"items[{bad_item}] debe ser un objeto"})
+
+        imgs = await run_in_threadpool(_read_images, images)
+        results = await _infer_items(imgs, items_obj, heatmap, response_format == "msgpack")
+        return _respond({"results": results}, response_format)
     except Exception as e:
-        import traceback
         return JSONResponse(status_code=500, content={"error": str(e), "trace": traceback.format_exc()})
 
 
+@app.post("/infer_frame")
+async def infer_frame(
+    image: UploadFile = File(...),
+    rois: str = Form(...),
+    mm_per_px: float = Form(0.2),
+    heatmap: str = Form("png"),
+    response_format: str = Form("json"),
+):
+    """
+    Inferencia de varios ROIs sobre un frame completo: el frame se decodifica una vez y cada
+    ROI se recorta/gira en el servidor (ver ROI_AND_MATCHING_SPEC.md). `rois` es un JSON
+    [{"role_id", "roi_id", "kind": square|circle|annulus, "cx", "cy", "w"?, "h"?, "r"?,
+      "r_inner"?, "rotation_deg"?, "mm_per_px"?, "shape"?}, ...].
+    La máscara circle/annulus se deriva de la geometría salvo que se pase "shape" explícito.
+    Devuelve {"results": [...]} como /infer_batch (regiones en coords del ROI canónico).
+    """
+    try:
+        bad = _check_response_opts(heatmap, response_format) or await _not_ready()
+        if bad is not None:
+            return bad
+        try:
+            rois_obj = json.loads(rois)
+        except Exception:
+            return JSONResponse(status_code=400, content={"error": "rois debe ser una lista JSON"})
+        if not isinstance(rois_obj, list) or not rois_obj:
+            return JSONResponse(status_code=400, content={"error": "rois debe ser una lista JSON no vacía"})
+
+        frame = await run_in_threadpool(_read_image_file, image)
+        crops: List[np.ndarray] = []
+        items: List[Dict[str, Any]] = []
+        for i, roi in enumerate(rois_obj):
+            if not isinstance(roi, dict):
+                return JSONResponse(status_code=400, content={"error": f"rois[{i}] debe ser un objeto"})
+            try:
+                crop, shape_local = crop_roi(frame, roi)
+            except (ValueError, TypeError, KeyError) as e:
+                return JSONResponse(status_code=400, content={"error": f"ROI {i}: {e}"})
+            crops.append(crop)
+            items.append({
+                "role_id": roi.get("role_id", ""),
+                "roi_id": roi.get("roi_id", ""),
+                "mm_per_px": float(roi.get("mm_per_px", mm_per_px)),
+                "shape": roi.get("shape") or shape_local,
+                "heatmap": roi.get("heatmap"),
+            })
+
+        results = await _infer_items(crops, items, heatmap, response_format == "msgpack")
+        for res, crop in zip(results, crops):
+            res["roi_size"] = [int(crop.shape[1]), int(crop.shape[0])]
+        return _respond({"results": results}, response_format)
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"error": str(e), "trace": traceback.format_exc()})
+
 
 if __name__ == "__main__":
     if not logging.getLogger().handlers:
@@ -0,0 +1,10 @@
+"""
+Micro-benchmarks offline (CPU, sin descargas) del pipeline de inferencia.
+
+    python -m backend.bench --out bench.json
+
+Ver `backend/bench/suite.py` para los casos y el esquema del JSON.
+"""
+from .suite import CASES, SCHEMA_VERSION, BenchConfig, run_suite
+
+__all__ = ["CASES", "SCHEMA_VERSION", "BenchConfig", "run_suite"]
@@ -0,0 +1,75 @@
+"""
+CLI de la suite de benchmarks:
+
+    python -m backend.bench --out bench/HEAD.json
+    python -m backend.bench --quick --skip extract extract_batch
+    python -m backend.bench --out new.json --baseline main.json --tolerance 0.2   # exit 1 si hay regresiones
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import sys
+from pathlib import Path
+from typing import Sequence
+
+from .suite import CASES, BenchConfig, _print, compare, run_suite
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description="Micro-benchmarks offline del pipeline (CPU, pesos aleatorios)")
+    ap.add_argument("--out", type=Path, default=None, help="fichero JSON de resultados (por defecto, stdout)")
+    ap.add_argument("--input-size", type=int, default=448)
+    ap.add_argument("--roi-size", type=int, nargs=2, metavar=("H", "W"), default=(480, 640))
+    ap.add_argument("--batch-size", type=int, default=4)
+    ap.add_argument("--dim", type=int, default=1152)
+    ap.add_argument("--coreset-n", type=int, default=16384)
+    ap.add_argument("--coreset-rate", type=float, default=0.02)
+    ap.add_argument("--bank-sizes", type=int, nargs="+", default=[4096, 16384])
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--warmup", type=int, default=1)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--skip", nargs="+", default=[], choices=CASES, help="casos a omitir (quedan con ok=false)")
+    ap.add_argument("--quick", action="store_true", help="tamaños reducidos para una pasada rápida")
+    ap.add_argument("--baseline", type=Path, default=None, help="JSON previo con el que comparar medianas")
+    ap.add_argument("--tolerance", type=float, default=0.15, help="empeoramiento relativo admitido frente a --baseline")
+    args = ap.parse_args(argv)
+
+    cfg = BenchConfig(
+        input_size=args.input_size,
+        roi_size=tuple(args.roi_size),
+        batch_size=args.batch_size,
+        dim=args.dim,
+        coreset_n=args.coreset_n,
+        coreset_rate=args.coreset_rate,
+        bank_sizes=tuple(args.bank_sizes),
+        repeat=args.repeat,
+        warmup=args.warmup,
+        seed=args.seed,
+        skip=tuple(args.skip),
+    )
+    if args.quick:
+        cfg.input_size, cfg.roi_size, cfg.batch_size = 224, (240, 320), 2
+        cfg.coreset_n, cfg.bank_sizes, cfg.repeat = 4096, (4096,), 3
+
+    report = run_suite(cfg, log=_print)
+    text = json.dumps(report, indent=2)
+    if args.out is None:
+        print(text)
+    else:
+        args.out.parent.mkdir(parents=True, exist_ok=True)
+        args.out.write_text(text, encoding="utf-8")
+        _print(f"-> {args.out}")
+
+    if args.baseline is not None:
+        baseline = json.loads(args.baseline.read_text(encoding="utf-8"))
+        regressions = compare(baseline, report, tolerance=args.tolerance)
+        for r in regressions:
+            _print(f"REGRESIÓN {r['name']} {r['params']}: {r['baseline_ms']:.2f} -> {r['current_ms']:.2f} ms (x{r['ratio']:.2f})")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
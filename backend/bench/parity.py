@@ -0,0 +1,259 @@
+"""
+Paridad de los modos de precisión del extractor frente a fp32.
+
+    python -m backend.bench.parity --images ok_rois/ --role-id Master --roi-id Pattern --modes bf16 int8
+    python -m backend.bench.parity --random-weights --synthetic 8 --input-size 224      # humo, sin red
+
+Con (role_id, roi_id) se usa la memoria y la calibración guardadas en `--models-dir` (construidas
+con fp32) y se comprueba si alguna decisión OK/NG cambia con el umbral de /calibrate_ng: la
+referencia se crea con el extractor del bundle (input_size, preprocesado...) y el score se calcula
+como en /infer (post_resolution de la config, mask_tokens y heatmap_mapping de la memoria). Sin ellas, la memoria se
+construye con las imágenes pares (fp32) y se evalúan las impares.
+Sale con código 1 si algún modo supera la tolerancia o cambia alguna decisión.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import sys
+import tempfile
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from ..patchcore import PatchCoreMemory, Projection, apply_search_params
+from ..storage import ModelStore
+from .suite import _print, _timed, synthetic_rois
+
+IMAGE_SUFFIXES = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff")
+
+
+EXTRACTOR_KEYS = ("model_name", "input_size", "patch_size", "out_indices", "dynamic_input", "imagenet_norm", "pool",
+                  "preprocess")
+
+
+def _extractor_kwargs(meta: Dict[str, Any]) -> Dict[str, Any]:
+    """Argumentos de DinoV2Features a partir de `get_metadata()` (o del bloque `extractor` de un bundle)."""
+    return {k: meta[k] for k in EXTRACTOR_KEYS if meta.get(k) is not None}
+
+
+def _mode_kwargs(reference) -> Dict[str, Any]:
+    return {**_extractor_kwargs(reference.get_metadata()), "device": "cpu"}
+
+
+def _scores(
+    reference, memory: PatchCoreMemory, token_hw, images, distances, score_percentile: int,
+    post_resolution: str = "roi", mask_tokens: bool = False, heatmap_mapping: str = "content",
+) -> List[float]:
+    from ..infer import InferenceEngine
+
+    engine = InferenceEngine(reference, memory, token_hw, mm_per_px=0.2)
+    return [
+        float(engine.run(img, embeddings=np.zeros((d.shape[0], 1), np.float32), token_hw=token_hw, distances=d,
+                         score_percentile=score_percentile, heatmap="none", post_resolution=post_resolution,
+                         mask_tokens=mask_tokens, heatmap_mapping=heatmap_mapping)["score"])
+        for img, d in zip(images, distances)
+    ]
+
+
+def precision_parity(
+    images: Sequence[np.ndarray],
+    modes: Sequence[str] = ("bf16", "int8"),
+    *,
+    reference=None,
+    memory: Optional[Tuple[PatchCoreMemory, Tuple[int, int]]] = None,
+    threshold: Optional[float] = None,
+    score_percentile: int = 99,
+    post_resolution: str = "roi",
+    mask_tokens: bool = False,
+    heatmap_mapping: str = "content",
+    tolerance: float = 0.02,
+    coreset_rate: float = 0.1,
+    repeat: int = 3,
+    extractor_kwargs: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """
+    Compara, para cada modo, las distancias kNN por parche y los scores finales con fp32.
+    `reference`: DinoV2Features fp32 (si no, se crea con `extractor_kwargs`); los modos se
+    crean con la misma clase y sus mismos pesos. `memory`: (PatchCoreMemory, token_hw) construida con fp32.
+    Un modo es "ok" si el error relativo máximo del score <= `tolerance` y, con `threshold`,
+    ninguna imagen cambia de decisión. `post_resolution`/`mask_tokens`/`heatmap_mapping`: los del score con el que
+    se calibró `threshold` (ver /infer). El grid de tokens de `reference` debe ser el de `memory`.
+    """
+    images = list(images)
+    if reference is None:
+        from ..features import DinoV2Features
+
+        reference = DinoV2Features(**{"device": "cpu", **(extractor_kwargs or {}), "precision": "fp32"})
+    if getattr(reference, "precision", "fp32") != "fp32":
+        raise ValueError("La referencia debe ser fp32")
+
+    ref_feats = reference.extract_batch(images)
+    if memory is None:
+        if len(images) < 2:
+            raise ValueError("Sin memoria guardada hacen falta al menos 2 imágenes (pares -> memoria, impares -> evaluación)")
+        mem = PatchCoreMemory.build(np.concatenate([f[0] for f in ref_feats[0::2]]), coreset_rate=coreset_rate)
+        token_hw = tuple(ref_feats[0][1])
+        eval_idx = list(range(1, len(images), 2))
+        memory_source = "split"
+    else:
+        mem, token_hw = memory
+        bad = sorted({tuple(map(int, f[1])) for f in ref_feats} - {tuple(map(int, token_hw))})
+        if bad:
+            raise ValueError(
+                f"Grid de tokens {bad} distinto del de la memoria {tuple(token_hw)}: la referencia debe usar "
+                "el input_size/extractor con el que se construyó"
+            )
+        eval_idx = list(range(len(images)))
+        memory_source = "stored"
+    eval_imgs = [images[i] for i in eval_idx]
+
+    d_ref = [mem.knn_min_dist(ref_feats[i][0]) for i in eval_idx]
+    score_kw = {"post_resolution": post_resolution, "mask_tokens": bool(mask_tokens), "heatmap_mapping": heatmap_mapping}
+    s_ref = np.asarray(_scores(reference, mem, token_hw, eval_imgs, d_ref, score_percentile, **score_kw))
+    ref_ms = float(np.median(_timed(lambda: reference.extract(eval_imgs[0]), repeat, 1)))
+
+    report: Dict[str, Any] = {
+        "n_images": len(images),
+        "n_eval": len(eval_idx),
+        "memory": memory_source,
+        "token_hw": [int(token_hw[0]), int(token_hw[1])],
+        "threshold": threshold,
+        **score_kw,
+        "tolerance": float(tolerance),
+        "reference": {"precision": "fp32", "forward_ms": ref_ms, "scores": s_ref.tolist()},
+        "modes": {},
+    }
+
+    with tempfile.TemporaryDirectory(prefix="bdi_parity_") as tmp:
+        weights = str(Path(tmp) / "reference.safetensors")
+        reference.save_weights(weights)
+        for mode in modes:
+            ext = type(reference)(**_mode_kwargs(reference), weights=weights, precision=mode)
+            feats = ext.extract_batch(eval_imgs)
+            d = [mem.knn_min_dist(f[0]) for f in feats]
+            s = np.asarray(_scores(reference, mem, token_hw, eval_imgs, d, score_percentile, **score_kw))
+
+            d_all, d0_all = np.concatenate(d), np.concatenate(d_ref)
+            diff = np.abs(d_all - d0_all)
+            s_rel = np.abs(s - s_ref) / np.maximum(np.abs(s_ref), 1e-12)
+            flips = int(np.sum((s >= threshold) != (s_ref >= threshold))) if threshold is not None else None
+            ms = float(np.median(_timed(lambda: ext.extract(eval_imgs[0]), repeat, 1)))
+            report["modes"][mode] = {
+                "forward_ms": ms,
+                "speedup": ref_ms / ms if ms > 0 else None,
+                "distance": {
+                    "max_abs": float(diff.max()),
+                    "mean_abs": float(diff.mean()),
+                    "mean_rel": float(diff.mean() / max(float(np.abs(d0_all).mean()), 1e-12)),
+                    "pearson": float(np.corrcoef(d_all, d0_all)[0, 1]) if d_all.size > 1 else 1.0,
+                },
+                "score": {
+                    "max_abs": float(np.abs(s - s_ref).max()),
+                    "max_rel": float(s_rel.max()),
+                    "mean_rel": float(s_rel.mean()),
+                },
+                "decision_flips": flips,
+                "scores": s.tolist(),
+                "ok": bool(float(s_rel.max()) <= tolerance and not flips),
+            }
+    return report
+
+
+def _read_images(folder: Path) -> List[np.ndarray]:
+    import cv2
+
+    paths = sorted(p for p in folder.iterdir() if p.suffix.lower() in IMAGE_SUFFIXES)
+    imgs = [cv2.imread(str(p), cv2.IMREAD_COLOR) for p in paths]
+    return [img for img in imgs if img is not None]
+
+
+def _stored_memory(store: ModelStore, role_id: str, roi_id: str):
+    loaded = store.load_bundle(role_id, roi_id, mmap=True)
+    if loaded is None:
+        raise SystemExit(f"No hay memoria para {role_id}/{roi_id} en {store.root}")
+    metadata, token_hw, index = loaded["metadata"], loaded["token_hw"], loaded["index"]
+    if index is not None:
+        apply_search_params(index, metadata.get("index_params"))
+    arrays = loaded["projection"]
+    projection = (
+        Projection(str(metadata.get("projection", "pca")), arrays["matrix"], arrays.get("mean"))
+        if arrays is not None else None
+    )
+    memory = PatchCoreMemory(embeddings=loaded["embeddings"], index=index, projection=projection)
+    return memory, (int(token_hw[0]), int(token_hw[1])), metadata, loaded["extractor"] or {}
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description="Paridad de precisión del extractor (bf16/int8) frente a fp32")
+    ap.add_argument("--images", type=Path, default=None, help="carpeta con ROIs OK de referencia")
+    ap.add_argument("--synthetic", type=int, default=8, help="nº de ROIs sintéticas si no se pasa --images")
+    ap.add_argument("--modes", nargs="+", default=["bf16", "int8"], choices=["bf16", "int8"])
+    ap.add_argument("--models-dir", type=Path, default=Path("models"))
+    ap.add_argument("--role-id", default=None)
+    ap.add_argument("--roi-id", default=None)
+    ap.add_argument("--weights", default=None, help="pesos locales (.safetensors/.pt) del extractor")
+    ap.add_argument("--random-weights", action="store_true", help="pesos aleatorios (sin descarga; sólo humo)")
+    ap.add_argument("--input-size", type=int, default=448, help="sin memoria guardada (si no, el del bundle)")
+    ap.add_argument("--post-resolution", default=None, help="por defecto inference.post_resolution de la config")
+    ap.add_argument("--tolerance", type=float, default=0.02, help="error relativo máximo admitido en el score")
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--out", type=Path, default=None)
+    args = ap.parse_args(argv)
+
+    from ..config import load_settings
+    from ..features import DinoV2Features
+
+    inference_cfg = load_settings().get("inference", {})
+    post_resolution = args.post_resolution or str(inference_cfg.get("post_resolution", "roi"))
+    mask_tokens = bool(inference_cfg.get("mask_tokens", True))
+    heatmap_mapping = "content"
+    extractor_kwargs: Dict[str, Any] = {"input_size": args.input_size, "patch_size": 14}
+
+    memory = None
+    threshold = None
+    score_percentile = 99
+    if args.role_id and args.roi_id:
+        store = ModelStore(args.models_dir)
+        mem, token_hw, metadata, extractor_meta = _stored_memory(store, args.role_id, args.roi_id)
+        memory = (mem, token_hw)
+        # los modos de la memoria, como /infer
+        mask_tokens = bool(metadata.get("mask_tokens", False))
+        heatmap_mapping = str(metadata.get("heatmap_mapping", "grid"))
+        extractor_kwargs.update(_extractor_kwargs(extractor_meta))
+        calib = store.load_calib(args.role_id, args.roi_id, default=None) or {}
+        threshold = calib.get("threshold")
+        score_percentile = int(calib.get("score_percentile", 99))
+
+    reference = DinoV2Features(
+        **extractor_kwargs, device="cpu", weights=args.weights, pretrained=not args.random_weights,
+    )
+    images = _read_images(args.images) if args.images else synthetic_rois(args.synthetic, (480, 640), np.random.default_rng(0))
+    if not images:
+        raise SystemExit(f"Sin imágenes en {args.images}")
+
+    try:
+        report = precision_parity(
+            images, args.modes, reference=reference, memory=memory, threshold=threshold,
+            score_percentile=score_percentile, post_resolution=post_resolution, mask_tokens=mask_tokens,
+            heatmap_mapping=heatmap_mapping, tolerance=args.tolerance, repeat=args.repeat,
+        )
+    except ValueError as exc:
+        raise SystemExit(str(exc))
+    for mode, r in report["modes"].items():
+        _print(
+            f"{mode:<5} forward {r['forward_ms']:8.1f} ms (x{r['speedup']:.2f} vs {report['reference']['forward_ms']:.1f})  "
+            f"dist mean_rel {r['distance']['mean_rel']:.4f} r={r['distance']['pearson']:.4f}  "
+            f"score max_rel {r['score']['max_rel']:.4f}  flips {r['decision_flips']}  {'OK' if r['ok'] else 'FALLA'}"
+        )
+    text = json.dumps(report, indent=2)
+    if args.out is None:
+        print(text)
+    else:
+        args.out.write_text(text, encoding="utf-8")
+    return 0 if all(r["ok"] for r in report["modes"].values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
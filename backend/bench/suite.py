@@ -0,0 +1,364 @@
+from __future__ import annotations
+
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from ..patchcore import PatchCoreMemory, approx_kcenter_greedy, build_index, kcenter_greedy, l2_normalize
+from ..storage import ModelStore
+
+# Esquema del JSON de resultados (subir SCHEMA_VERSION si cambia la forma):
+# {
+#   "schema_version": 1,
+#   "created_at": "2026-01-01T12:00:00Z",
+#   "git_commit": "abc1234" | null,
+#   "env":    {"python", "platform", "cpu_count", "torch_threads", "numpy", "torch", "timm", "faiss", "sklearn", "cv2"},
+#   "config": BenchConfig,
+#   "results": [
+#     {"name", "params": {...}, "ok": bool, "error": str | null, "repeat": int,
+#      "median_ms", "mean_ms", "min_ms", "p90_ms", "max_ms"}   # null si no ok
+#   ]
+# }
+# Todos los casos aparecen siempre (en el mismo orden); los omitidos o fallidos llevan ok=false y error.
+
+SCHEMA_VERSION = 1
+
+CASES: Tuple[str, ...] = (
+    "preprocess",
+    "extract",
+    "extract_batch",
+    "kcenter_greedy",
+    "approx_kcenter_greedy",
+    "knn_min_dist_faiss",
+    "knn_min_dist_sklearn",
+    "infer_postprocess",
+    "store_save",
+    "store_load",
+)
+
+
+@dataclass
+class BenchConfig:
+    input_size: int = 448               # lado de entrada del ViT (múltiplo de 14)
+    roi_size: Tuple[int, int] = (480, 640)  # (H, W) de las imágenes ROI sintéticas
+    batch_size: int = 4                 # imágenes por llamada en extract_batch
+    model_name: str = "vit_small_patch14_dinov2.lvd142m"
+    dim: int = 1152                     # dim. de los embeddings sintéticos (3 capas x 384)
+    coreset_n: int = 16384              # embeddings de entrada de kcenter_greedy
+    coreset_rate: float = 0.02
+    bank_sizes: Tuple[int, ...] = (4096, 16384)  # tamaños del banco de memoria para kNN/store
+    repeat: int = 5
+    warmup: int = 1
+    seed: int = 0
+    skip: Tuple[str, ...] = field(default_factory=tuple)
+
+    @property
+    def token_hw(self) -> Tuple[int, int]:
+        t = int(self.input_size) // 14
+        return t, t
+
+
+def _timed(fn: Callable[[], Any], repeat: int, warmup: int) -> List[float]:
+    for _ in range(max(0, int(warmup))):
+        fn()
+    times = []
+    for _ in range(max(1, int(repeat))):
+        t0 = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - t0) * 1000.0)
+    return times
+
+
+def _entry(name: str, params: Dict[str, Any], times: Optional[Sequence[float]] = None, error: Optional[str] = None):
+    ok = times is not None and error is None
+    t = np.asarray(times if ok else [], dtype=np.float64)
+    return {
+        "name": name,
+        "params": params,
+        "ok": bool(ok),
+        "error": error,
+        "repeat": int(t.size),
+        "median_ms": float(np.median(t)) if ok else None,
+        "mean_ms": float(t.mean()) if ok else None,
+        "min_ms": float(t.min()) if ok else None,
+        "p90_ms": float(np.percentile(t, 90)) if ok else None,
+        "max_ms": float(t.max()) if ok else None,
+    }
+
+
+def synthetic_rois(n: int, size: Tuple[int, int], rng: np.random.Generator) -> List[np.ndarray]:
+    """ROIs BGR uint8 "de disco": gradiente radial + ruido, más realista que ruido puro para la interpolación."""
+    h, w = size
+    yy, xx = np.mgrid[0:h, 0:w].astype(np.float32)
+    r = np.hypot(yy - h / 2.0, xx - w / 2.0) / max(h, w)
+    base = np.stack([r * 255.0, (1.0 - r) * 200.0, np.full_like(r, 128.0)], axis=-1)
+    return [np.clip(base + rng.normal(0.0, 8.0, size=base.shape), 0, 255).astype(np.uint8) for _ in range(n)]
+
+
+class _Context:
+    """Datos sintéticos y objetos compartidos entre casos (extractor, bancos de memoria, store)."""
+
+    def __init__(self, cfg: BenchConfig, workdir: Path):
+        self.cfg = cfg
+        self.workdir = workdir
+        self.rng = np.random.default_rng(cfg.seed)
+        self._extractor = None
+        self._banks: Dict[int, np.ndarray] = {}
+
+    def roi_images(self, n: int) -> List[np.ndarray]:
+        return synthetic_rois(n, self.cfg.roi_size, self.rng)
+
+    def extractor(self):
+        if self._extractor is None:
+            from ..features import DinoV2Features
+
+            self._extractor = DinoV2Features(
+                model_name=self.cfg.model_name,
+                device="cpu",
+                input_size=self.cfg.input_size,
+                patch_size=14,
+                pretrained=False,
+                preprocess="cv2",  # ruta rápida: mismos casos que los baselines guardados
+            )
+        return self._extractor
+
+    def bank(self, n: int) -> np.ndarray:
+        if n not in self._banks:
+            E = self.rng.standard_normal((n, self.cfg.dim), dtype=np.float32)
+            self._banks[n] = l2_normalize(E)
+        return self._banks[n]
+
+    def query(self) -> np.ndarray:
+        ht, wt = self.cfg.token_hw
+        return self.rng.standard_normal((ht * wt, self.cfg.dim), dtype=np.float32)
+
+
+# ---------------- casos ----------------
+def _bench_preprocess(ctx: _Context):
+    ext = ctx.extractor()
+    img = ctx.roi_images(1)[0]
+    yield {"mode": ext.preprocess_mode, "roi_size": list(ctx.cfg.roi_size)}, lambda: ext.preprocess(img)
+
+
+def _bench_extract(ctx: _Context):
+    ext = ctx.extractor()
+    img = ctx.roi_images(1)[0]
+    yield {"input_size": ctx.cfg.input_size, "roi_size": list(ctx.cfg.roi_size)}, lambda: ext.extract(img)
+
+
+def _bench_extract_batch(ctx: _Context):
+    ext = ctx.extractor()
+    imgs = ctx.roi_images(ctx.cfg.batch_size)
+    bs = ctx.cfg.batch_size
+    yield {"input_size": ctx.cfg.input_size, "batch_size": bs}, lambda: ext.extract_batch(imgs, batch_size=bs)
+
+
+def _bench_kcenter(ctx: _Context):
+    E = ctx.bank(ctx.cfg.coreset_n)
+    m = max(1, int(np.ceil(E.shape[0] * ctx.cfg.coreset_rate)))
+    yield {"n": int(E.shape[0]), "dim": int(E.shape[1]), "m": m}, lambda: kcenter_greedy(E, m, seed=ctx.cfg.seed)
+
+
+def _bench_approx_kcenter(ctx: _Context):
+    E = ctx.bank(ctx.cfg.coreset_n)
+    m = max(1, int(np.ceil(E.shape[0] * ctx.cfg.coreset_rate)))
+    yield (
+        {"n": int(E.shape[0]), "dim": int(E.shape[1]), "m": m, "proj_dim": 128},
+        lambda: approx_kcenter_greedy(E, m, seed=ctx.cfg.seed, proj_dim=128),
+    )
+
+
+def _bench_knn_faiss(ctx: _Context):
+    for n in ctx.cfg.bank_sizes:
+        index, _ = build_index(ctx.bank(n), "flat")
+        if index is None:
+            raise RuntimeError("FAISS no disponible")
+        mem = PatchCoreMemory(embeddings=ctx.bank(n), index=index)
+        q = ctx.query()
+        yield {"bank": int(n), "queries": int(q.shape[0]), "index_type": "flat"}, lambda: mem.knn_min_dist(q)
+
+
+def _bench_knn_sklearn(ctx: _Context):
+    for n in ctx.cfg.bank_sizes:
+        mem = PatchCoreMemory(embeddings=ctx.bank(n), index=None)
+        q = ctx.query()
+        yield {"bank": int(n), "queries": int(q.shape[0])}, lambda: mem.knn_min_dist(q)
+
+
+def _bench_infer_postprocess(ctx: _Context):
+    from types import SimpleNamespace
+
+    from ..infer import InferenceEngine
+
+    ht, wt = ctx.cfg.token_hw
+    h, w = ctx.cfg.roi_size
+    extractor = SimpleNamespace(model_name=ctx.cfg.model_name, input_size=ctx.cfg.input_size, patch=14)
+    engine = InferenceEngine(extractor, SimpleNamespace(coreset_rate=ctx.cfg.coreset_rate), (ht, wt), mm_per_px=0.2)
+    img = ctx.roi_images(1)[0]
+    emb = np.zeros((ht * wt, 1), dtype=np.float32)  # no se usa: las distancias vienen dadas
+    d = ctx.rng.gamma(2.0, 0.1, size=ht * wt).astype(np.float32)
+    d[: wt * 2] += 1.0  # una franja "defectuosa" para que haya regiones
+    shape = {"kind": "annulus", "cx": w / 2.0, "cy": h / 2.0, "r": min(h, w) / 2.0, "r_inner": min(h, w) / 6.0}
+    for post in ("roi", "x4"):
+        for mode in ("full", "tokens"):
+            yield (
+                {"roi_size": [h, w], "token_hw": [ht, wt], "heatmap": mode, "post_resolution": post},
+                lambda mode=mode, post=post: engine.run(
+                    img, embeddings=emb, token_hw=(ht, wt), distances=d, shape=shape,
+                    threshold=0.8, area_mm2_thr=0.5, heatmap=mode, post_resolution=post,
+                ),
+            )
+
+
+def _bench_store_save(ctx: _Context):
+    store = ModelStore(ctx.workdir / "store")
+    for n in ctx.cfg.bank_sizes:
+        E = ctx.bank(n)
+        yield (
+            {"bank": int(n), "dim": int(E.shape[1])},
+            lambda E=E, n=n: store.save_bundle("Bench", f"bank{n}", E, ctx.cfg.token_hw, metadata={"bench": True}),
+        )
+
+
+def _bench_store_load(ctx: _Context):
+    store = ModelStore(ctx.workdir / "store")
+    for n in ctx.cfg.bank_sizes:
+        store.save_bundle("Bench", f"bank{n}", ctx.bank(n), ctx.cfg.token_hw)
+        for mmap in (True, False):
+            # mmap=False lee todo el banco; mmap=True sólo mapea (el coste real aparece en la 1ª consulta)
+            yield (
+                {"bank": int(n), "mmap": mmap},
+                lambda n=n, mmap=mmap: store.load_memory("Bench", f"bank{n}", mmap=mmap),
+            )
+
+
+_RUNNERS: Dict[str, Callable[[_Context], Any]] = {
+    "preprocess": _bench_preprocess,
+    "extract": _bench_extract,
+    "extract_batch": _bench_extract_batch,
+    "kcenter_greedy": _bench_kcenter,
+    "approx_kcenter_greedy": _bench_approx_kcenter,
+    "knn_min_dist_faiss": _bench_knn_faiss,
+    "knn_min_dist_sklearn": _bench_knn_sklearn,
+    "infer_postprocess": _bench_infer_postprocess,
+    "store_save": _bench_store_save,
+    "store_load": _bench_store_load,
+}
+
+
+# ---------------- entorno ----------------
+def _version(module: str) -> Optional[str]:
+    try:
+        mod = __import__(module)
+    except Exception:
+        return None
+    return str(getattr(mod, "__version__", "unknown"))
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=Path(__file__).resolve().parent, capture_output=True, text=True, timeout=5,
+        )
+        if out.returncode != 0:
+            return None
+        return out.stdout.strip() or None
+    except Exception:
+        return None
+
+
+def _environment() -> Dict[str, Any]:
+    try:
+        import torch
+
+        torch_threads = int(torch.get_num_threads())
+    except Exception:
+        torch_threads = None
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "torch_threads": torch_threads,
+        "numpy": _version("numpy"),
+        "torch": _version("torch"),
+        "timm": _version("timm"),
+        "faiss": _version("faiss"),
+        "sklearn": _version("sklearn"),
+        "cv2": _version("cv2"),
+    }
+
+
+def run_suite(cfg: Optional[BenchConfig] = None, log: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
+    """Ejecuta todos los casos de CASES y devuelve el informe (ver esquema arriba)."""
+    cfg = cfg or BenchConfig()
+    results: List[Dict[str, Any]] = []
+    with tempfile.TemporaryDirectory(prefix="bdi_bench_") as tmp:
+        ctx = _Context(cfg, Path(tmp))
+        for name in CASES:
+            if name in cfg.skip:
+                results.append(_entry(name, {}, error="skipped"))
+                continue
+            try:
+                for params, fn in _RUNNERS[name](ctx):
+                    try:
+                        entry = _entry(name, params, _timed(fn, cfg.repeat, cfg.warmup))
+                    except Exception as exc:
+                        entry = _entry(name, params, error=f"{type(exc).__name__}: {exc}")
+                    results.append(entry)
+                    if log is not None:
+                        log(_format_entry(entry))
+            except Exception as exc:  # fallo al preparar el caso (p.ej. sin FAISS)
+                results.append(_entry(name, {}, error=f"{type(exc).__name__}: {exc}"))
+                if log is not None:
+                    log(_format_entry(results[-1]))
+
+    return {
+        "schema_version": SCHEMA_VERSION,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "git_commit": _git_commit(),
+        "env": _environment(),
+        "config": {**asdict(cfg), "roi_size": list(cfg.roi_size), "bank_sizes": list(cfg.bank_sizes), "skip": list(cfg.skip)},
+        "results": results,
+    }
+
+
+def _case_key(entry: Dict[str, Any]) -> Tuple[str, str]:
+    return entry["name"], repr(sorted(entry.get("params", {}).items()))
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], tolerance: float = 0.15) -> List[Dict[str, Any]]:
+    """
+    Casos cuya mediana empeora más de `tolerance` (fracción) respecto a `baseline`.
+    Sólo compara casos ok en ambos informes con el mismo nombre y parámetros.
+    """
+    base = {_case_key(e): e for e in baseline.get("results", []) if e.get("ok")}
+    out = []
+    for e in current.get("results", []):
+        b = base.get(_case_key(e))
+        if not e.get("ok") or b is None or not b["median_ms"]:
+            continue
+        ratio = e["median_ms"] / b["median_ms"]
+        if ratio > 1.0 + tolerance:
+            out.append({"name": e["name"], "params": e["params"], "baseline_ms": b["median_ms"],
+                        "current_ms": e["median_ms"], "ratio": ratio})
+    return out
+
+
+def _format_entry(entry: Dict[str, Any]) -> str:
+    params = " ".join(f"{k}={v}" for k, v in entry["params"].items())
+    if not entry["ok"]:
+        return f"{entry['name']:<24} {params:<48} -- {entry['error']}"
+    return f"{entry['name']:<24} {params:<48} median {entry['median_ms']:9.2f} ms  p90 {entry['p90_ms']:9.2f} ms"
+
+
+def _print(msg: str) -> None:
+    print(msg, file=sys.stderr, flush=True)
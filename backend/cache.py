@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+import numpy as np
+
+# Marca de "no existe en disco" (se cachea con su stamp; ocupa un tamaño nominal en el presupuesto)
+_ABSENT = object()
+_ABSENT_NBYTES = 64
+
+
+def memory_nbytes(mem: Any) -> int:
+    """Estimación (bytes) de lo que ocupa una PatchCoreMemory lista para consultar."""
+    emb = getattr(mem, "emb", None)
+    total = int(emb.nbytes) if isinstance(emb, np.ndarray) else 0
+    index = getattr(mem, "index", None)
+    if index is not None:
+        # IndexFlat* guarda una copia float32 de los vectores; otros tipos ocupan menos
+        ntotal = int(getattr(index, "ntotal", 0))
+        dim = int(getattr(index, "d", 0))
+        total += ntotal * dim * 4
+    projection = getattr(mem, "projection", None)
+    if projection is not None:
+        total += int(projection.matrix.nbytes)
+    return total
+
+
+def calib_nbytes(calib: Optional[Dict[str, Any]]) -> int:
+    if not calib:
+        return 0
+    try:
+        return len(json.dumps(calib))
+    except Exception:
+        return 1024
+
+
+class MemoryCache:
+    """
+    Caché LRU en proceso para artefactos por (role_id, roi_id):
+      - "memory": tupla (PatchCoreMemory, token_hw, metadata) lista para consultar
+      - "calib":  dict de calibración
+
+    Limitada por un presupuesto en bytes (`max_bytes`); al superarlo se expulsan las
+    entradas menos usadas. `max_bytes <= 0` desactiva la caché (siempre carga).
+
+    Con `stamp` (p.ej. `ModelStore.stamp`), una entrada cuya marca ya no coincide se recarga:
+    así los workers de un pool multi-proceso ven los /fit_ok y /calibrate_ng de los demás.
+    Con `stamp` también se cachean las ausencias (ROI sin memoria o sin calibrar): el primer
+    guardado cambia la marca y la entrada se recarga.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = int(max_bytes)
+        self._entries: "OrderedDict[Hashable, Tuple[Any, int, Any]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale = 0
+
+    # ---------------- núcleo LRU ----------------
+    def _get_or_load(
+        self, key: Hashable, loader: Callable[[], Any], sizer: Callable[[Any], int], stamp: Any = None
+    ) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and stamp is not None and entry[2] != stamp:
+                # Modificado en disco (p.ej. por otro worker): se descarta y se recarga
+                self._entries.pop(key)
+                self._bytes -= entry[1]
+                self.stale += 1
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return None if entry[0] is _ABSENT else entry[0]
+            self.misses += 1
+
+        # Cargar fuera del lock: la descompresión/reconstrucción puede tardar
+        value = loader()
+        if self.max_bytes <= 0:
+            return value
+        if value is None:
+            if stamp is None:
+                return None  # sin marca nada invalidaría la ausencia (p.ej. antes del primer /fit_ok)
+            nbytes = _ABSENT_NBYTES
+        else:
+            nbytes = max(0, int(sizer(value)))
+        if nbytes > self.max_bytes:
+            return value  # no cabe: se sirve sin cachear
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._entries[key] = (_ABSENT if value is None else value, nbytes, stamp)
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes and self._entries:
+                _, (_, evicted_bytes, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_bytes
+                self.evictions += 1
+        return value
+
+    # ---------------- API pública ----------------
+    def get_memory(self, role_id: str, roi_id: str, loader: Callable[[], Any], stamp: Any = None) -> Any:
+        return self._get_or_load(("memory", role_id, roi_id), loader, lambda v: memory_nbytes(v[0]), stamp)
+
+    def get_calib(self, role_id: str, roi_id: str, loader: Callable[[], Any], stamp: Any = None) -> Any:
+        return self._get_or_load(("calib", role_id, roi_id), loader, calib_nbytes, stamp)
+
+    def invalidate(self, role_id: str, roi_id: str, kind: Optional[str] = None) -> None:
+        """Elimina las entradas de (role_id, roi_id); `kind` limita a "memory" o "calib"."""
+        kinds = (kind,) if kind else ("memory", "calib")
+        with self._lock:
+            for k in kinds:
+                entry = self._entries.pop((k, role_id, roi_id), None)
+                if entry is not None:
+                    self._bytes -= entry[1]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": int(self._bytes),
+                "max_bytes": int(self.max_bytes),
+                "hits": int(self.hits),
+                "misses": int(self.misses),
+                "evictions": int(self.evictions),
+                "stale": int(self.stale),
+            }
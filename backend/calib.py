@@ -25,3 +25,54 @@ def choose_threshold(ok_scores: np.ndarray, ng_scores: Optional[np.ndarray]=None
         return p_ok * 1.02  # pequeño margen
 
     return (p_ok + p_ng) * 0.5
+
+
+def choose_cascade_accept(
+    ok_full: np.ndarray,
+    ok_cascade: np.ndarray,
+    threshold: float,
+    ng_full: Optional[np.ndarray] = None,
+    ng_cascade: Optional[np.ndarray] = None,
+    margin: float = 0.05,
+    z: float = 3.0,
+) -> dict:
+    """
+    Margen de aceptación temprana de la cascada: por debajo de `cascade_accept` (score de la
+    pasada de baja resolución) la pieza se da por OK sin la pasada completa.
+      - Ajuste lineal score ≈ slope · cascade + intercept con los pares (OK y NG) y su σ residual:
+        se acepta si la predicción + z·σ queda por debajo de threshold · (1 - margin).
+      - Con NG, además por debajo de min(NG cascade) · (1 - margin): ningún NG de la
+        calibración se habría aceptado.
+    Los NG deben venir emparejados (ValueError si sólo hay ng_full o las longitudes difieren).
+    Devuelve {} si no hay al menos 3 pares o la pasada barata no sigue al score completo (slope <= 0).
+    """
+    ok_full = np.asarray(ok_full, dtype=float).reshape(-1)
+    ok_cascade = np.asarray(ok_cascade, dtype=float).reshape(-1)
+    if ok_full.size != ok_cascade.size:
+        raise ValueError("ok_scores y ok_cascade_scores deben tener la misma longitud")
+    ng_full = np.asarray(ng_full if ng_full is not None else [], dtype=float).reshape(-1)
+    ng_cascade = np.asarray(ng_cascade if ng_cascade is not None else [], dtype=float).reshape(-1)
+    if ng_full.size != ng_cascade.size:
+        # sin los pares NG el margen saldría sólo de OKs y podría aceptar NGs
+        raise ValueError("ng_scores y ng_cascade_scores deben tener la misma longitud")
+
+    x = np.concatenate([ok_cascade, ng_cascade])
+    y = np.concatenate([ok_full, ng_full])
+    if x.size < 3 or np.ptp(x) <= 0:
+        return {}
+    slope, intercept = np.polyfit(x, y, 1)
+    if slope <= 0:
+        return {}
+    sigma = float(np.std(y - (slope * x + intercept), ddof=min(2, x.size - 1)))
+
+    accept = (float(threshold) * (1.0 - margin) - intercept - z * sigma) / slope
+    if ng_cascade.size:
+        accept = min(accept, float(ng_cascade.min()) * (1.0 - margin))
+    return {
+        "cascade_accept": float(accept),
+        "cascade_slope": float(slope),
+        "cascade_intercept": float(intercept),
+        "cascade_sigma": sigma,
+        "cascade_accept_rate_ok": float(np.mean(ok_cascade < accept)) if ok_cascade.size else 0.0,
+        "cascade_n": int(x.size),
+    }
@@ -26,6 +26,81 @@ DEFAULTS: Dict[str, Any] = {
         "coreset_rate": float(_env("BDI_CORESET_RATE", "BRAKEDISC_CORESET_RATE", "0.10")),
         "score_percentile": int(_env("BDI_SCORE_PERCENTILE", "BRAKEDISC_SCORE_PERCENTILE", "99")),
         "area_mm2_thr": float(_env("BDI_AREA_MM2_THR", "BRAKEDISC_AREA_MM2_THR", "1.0")),
+        "fit_batch_size": int(_env("BDI_FIT_BATCH_SIZE", "BRAKEDISC_FIT_BATCH_SIZE", "8")),
+        "infer_batch_size": int(_env("BDI_INFER_BATCH_SIZE", "BRAKEDISC_INFER_BATCH_SIZE", "8")),
+        # Coreset: "exact" | "approx" (proyección aleatoria, como PatchCore; más rápido, otro coreset)
+        "coreset_method": _env("BDI_CORESET_METHOD", "BRAKEDISC_CORESET_METHOD", "exact"),
+        "coreset_proj_dim": int(_env("BDI_CORESET_PROJ_DIM", "BRAKEDISC_CORESET_PROJ_DIM", "128")),
+        # Índice kNN por defecto: flat | ivf_flat | hnsw | ivf_pq | sq8 (sobrescribible en /fit_ok)
+        "index_type": _env("BDI_INDEX_TYPE", "BRAKEDISC_INDEX_TYPE", "flat"),
+        "index_params": {},
+        # Proyección de los embeddings guardados: none | pca | random (sobrescribible en /fit_ok)
+        "projection": _env("BDI_PROJECTION", "BRAKEDISC_PROJECTION", "none"),
+        "projection_dim": int(_env("BDI_PROJECTION_DIM", "BRAKEDISC_PROJECTION_DIM", "128")),
+        # kNN/coreset sólo con los tokens que solapan la forma del ROI (sin padding del letterbox);
+        # se guarda en la memoria al hacer /fit_ok e /infer aplica el de la memoria
+        "mask_tokens": _env("BDI_MASK_TOKENS", "BRAKEDISC_MASK_TOKENS", "1").lower() not in ("0", "false", "no"),
+        # Resolución del suavizado/score/islas: roi (píxeles del ROI) | tokens | x2 | x4 (muestras por token)
+        "post_resolution": _env("BDI_POST_RESOLUTION", "BRAKEDISC_POST_RESOLUTION", "roi"),
+        # Cascada: pasada barata a cascade_input_size; si su score queda bajo el margen calibrado
+        # (/calibrate_ng con ok_cascade_scores) la pieza se acepta sin la pasada completa (torch)
+        "cascade": _env("BDI_CASCADE", "BRAKEDISC_CASCADE", "0").lower() not in ("0", "false", "no"),
+        "cascade_input_size": int(_env("BDI_CASCADE_INPUT_SIZE", "BRAKEDISC_CASCADE_INPUT_SIZE", "224")),
+        "cascade_margin": float(_env("BDI_CASCADE_MARGIN", "BRAKEDISC_CASCADE_MARGIN", "0.05")),
+    },
+    "extractor": {
+        # Preprocesado del ROI: "pil" (ruta original) | "cv2" (letterbox sobre el uint8 BGR, sin PIL;
+        # otros embeddings: rehacer /fit_ok, /infer avisa si la memoria se construyó con el otro modo)
+        "preprocess": _env("BDI_PREPROCESS", "BRAKEDISC_PREPROCESS", "pil"),
+        # fp32 | bf16 | int8 (CPU); validar con python -m backend.bench.parity antes de cambiarlo
+        "precision": _env("BDI_PRECISION", "BRAKEDISC_PRECISION", "fp32"),
+        # torch | onnx (onnxruntime CPU; grafo exportado con python -m backend.onnx_features)
+        "backend": _env("BDI_EXTRACTOR_BACKEND", "BRAKEDISC_EXTRACTOR_BACKEND", "torch"),
+        "onnx_path": _env("BDI_ONNX_PATH", "BRAKEDISC_ONNX_PATH", "models/onnx/dinov2_vits14_448.onnx"),
+        # Hilos intra-op de onnxruntime (0 = por defecto de onnxruntime)
+        "onnx_threads": int(_env("BDI_ONNX_THREADS", "BRAKEDISC_ONNX_THREADS", "0")),
+        # Sólo los parches dentro de la forma del ROI pasan por el ViT (requiere re-fit con el mismo modo)
+        "token_pruning": _env("BDI_TOKEN_PRUNING", "BRAKEDISC_TOKEN_PRUNING", "0").lower() not in ("0", "false", "no"),
+        # ROIs annulus desenrollados a una tira polar (cv2.warpPolar) en vez del letterbox (re-fit tras activarlo)
+        "polar_unwrap": _env("BDI_POLAR_UNWRAP", "BRAKEDISC_POLAR_UNWRAP", "0").lower() not in ("0", "false", "no"),
+        # Resolución de la tira respecto al letterbox (1.0 = misma densidad de píxeles)
+        "polar_scale": float(_env("BDI_POLAR_SCALE", "BRAKEDISC_POLAR_SCALE", "1.0")),
+    },
+    "storage": {
+        # dtype de los embeddings en disco (bundle .npy mapeable): float32 | float16
+        "emb_dtype": _env("BDI_EMB_DTYPE", "BRAKEDISC_EMB_DTYPE", "float32"),
+    },
+    "cache": {
+        # Presupuesto de la caché LRU de memorias/calibraciones (MB); 0 la desactiva
+        "max_mb": float(_env("BDI_CACHE_MAX_MB", "BRAKEDISC_CACHE_MAX_MB", "1024")),
+    },
+    "serve": {
+        # Pool multi-proceso (python -m backend.serve); workers=0 -> cores / threads_per_worker
+        "workers": int(_env("BDI_WORKERS", "BRAKEDISC_WORKERS", "0")),
+        "threads_per_worker": int(_env("BDI_THREADS_PER_WORKER", "BRAKEDISC_THREADS_PER_WORKER", "8")),
+        "timeout_s": int(_env("BDI_WORKER_TIMEOUT", "BRAKEDISC_WORKER_TIMEOUT", "120")),
+    },
+    "scheduler": {
+        # Micro-batching del extractor entre peticiones concurrentes
+        "enabled": _env("BDI_SCHEDULER_ENABLED", "BRAKEDISC_SCHEDULER_ENABLED", "1").lower() not in ("0", "false", "no"),
+        "max_batch": int(_env("BDI_SCHEDULER_MAX_BATCH", "BRAKEDISC_SCHEDULER_MAX_BATCH", "8")),
+        "max_wait_ms": float(_env("BDI_SCHEDULER_MAX_WAIT_MS", "BRAKEDISC_SCHEDULER_MAX_WAIT_MS", "5")),
+    },
+    "metrics": {
+        # Latencia por etapa -> GET /metrics; server_timing añade la cabecera Server-Timing
+        "enabled": _env("BDI_METRICS_ENABLED", "BRAKEDISC_METRICS_ENABLED", "1").lower() not in ("0", "false", "no"),
+        "server_timing": _env("BDI_SERVER_TIMING", "BRAKEDISC_SERVER_TIMING", "0").lower() in ("1", "true", "yes"),
+    },
+    "startup": {
+        # Pesos locales (.safetensors/.pt) para no depender del hub; vacío = timm pretrained
+        "weights": _env("BDI_WEIGHTS", "BRAKEDISC_WEIGHTS", ""),
+        "background": _env("BDI_STARTUP_BACKGROUND", "BRAKEDISC_STARTUP_BACKGROUND", "1").lower() not in ("0", "false", "no"),
+        "warmup_runs": int(_env("BDI_WARMUP_RUNS", "BRAKEDISC_WARMUP_RUNS", "2")),
+        # "Master/Pattern,Master/Inner": memorias a precargar en la caché al arrancar
+        "preload": _env("BDI_PRELOAD", "BRAKEDISC_PRELOAD", ""),
+        "request_wait_s": float(_env("BDI_REQUEST_WAIT_S", "BRAKEDISC_REQUEST_WAIT_S", "30")),
+        # tras un fallo de carga, la siguiente petición pasados estos segundos reintenta el arranque
+        "retry_s": float(_env("BDI_STARTUP_RETRY_S", "BRAKEDISC_STARTUP_RETRY_S", "30")),
     },
 }
 
@@ -1,9 +1,14 @@
-# backend/features.py  (Option 2 robust: resize pos_embed manually + reset each call)
+# backend/features.py  (Option 2 robust: resize pos_embed manually, cached per token grid)
 from __future__ import annotations
 
+import copy
 import io
 import inspect
-from typing import Iterable, Optional, Tuple, Union
+import logging
+import threading
+import warnings
+from contextlib import nullcontext
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
 
 import numpy as np
 from PIL import Image
@@ -13,6 +18,33 @@ import torch.nn as nn
 import torch.nn.functional as F
 import timm
 
+try:
+    import cv2  # type: ignore
+except Exception:  # pragma: no cover - OpenCV opcional: se usa el preprocesado PIL
+    cv2 = None
+
+try:
+    from .metrics import stage
+except ImportError:  # cargado como módulo suelto (tests)
+    from backend.metrics import stage
+
+log = logging.getLogger(__name__)
+
+PRECISIONS = ("fp32", "bf16", "int8")
+
+
+def load_state_dict_file(path: str) -> Dict[str, torch.Tensor]:
+    """state_dict desde .safetensors (mmap, sin pickle) o checkpoint de torch (.pt/.pth/.bin)."""
+    if str(path).endswith(".safetensors"):
+        from safetensors.torch import load_file
+
+        return load_file(str(path), device="cpu")
+    state = torch.load(str(path), map_location="cpu", weights_only=True)
+    for key in ("state_dict", "model"):
+        if isinstance(state, dict) and isinstance(state.get(key), dict):
+            state = state[key]
+    return state
+
 
 class DinoV2Features:
     """
@@ -20,11 +52,33 @@ class DinoV2Features:
       - LETTERBOX (mantener aspecto + padding) a input_size
       - Tamaño de entrada controlado (fijo o dinámico múltiplo de patch)
       - *Opción 2*: redimensionado del positional embedding **manual** (sin timm.resize_pos_embed)
-      - *Reset* del pos_embed original en **cada** `extract()` para evitar acumulación
+      - pos_embed redimensionado **cacheado por grid** (Ht, Wt) y sumado en un forward propio,
+        sin modificar los parámetros del modelo (ruta legacy con reset sólo si el modelo no lo permite)
 
     extract(img) -> (embedding_numpy, (h_tokens, w_tokens))
       - pool="none" -> (HW, C)  (todos los tokens)  [recomendado para PatchCore/coreset]
       - pool="mean" -> (1,  C)  (media de tokens)
+
+    extract_batch(imgs, batch_size) -> [(embedding_numpy, (h_tokens, w_tokens)), ...]
+      - mismo resultado que extract() por imagen, con un forward (B,3,H,W) por lote
+
+    weights="models/weights/dinov2_vits14.safetensors" carga los pesos de un fichero local
+    (safetensors o state_dict de torch) sin pasar por el hub; `save_weights()` lo genera.
+
+    token_pruning=True: `extract(img, shape=...)` / `extract_batch(..., shapes=...)` sólo pasan
+    por los bloques del ViT el CLS y los parches que solapan la forma del ROI (`patch_keep_list`,
+    sin padding del letterbox); el resto vuelve al grid (Ht, Wt) con embedding 0. La atención
+    ve menos contexto: la memoria debe construirse con el mismo modo.
+
+    polar_unwrap=True (requiere dynamic_input=True): un ROI con forma `annulus` se desenrolla
+    con cv2.warpPolar en una tira radio x ángulo (`backend.polar`) que entra al ViT sin
+    letterbox, con su propio grid de tokens no cuadrado; `polar_scale` escala su resolución.
+    Las demás formas siguen por el letterbox. `polar_geometry` da la geometría para devolver el
+    heatmap a cartesianas.
+
+    precision (CPU sin GPU): "fp32" | "bf16" (autocast bfloat16 en el forward) | "int8"
+    (cuantización dinámica de las nn.Linear del ViT). Antes de usarlo en línea, compara
+    distancias y scores con fp32 (`python -m backend.bench.parity`).
     """
 
     def __init__(
@@ -38,6 +92,13 @@ class DinoV2Features:
         pool: str = "none",                     # "none" | "mean"
         dynamic_input: bool = False,            # False => fuerza tamaño fijo; True => acepta HxW múltiplos de patch
         patch_size: Optional[int] = None,       # si se pasa, fuerza el valor de patch
+        preprocess: str = "pil",                # "pil" (ruta original) | "cv2" (uint8 BGR directo, más rápido)
+        pretrained: bool = True,                # False: pesos aleatorios sin descarga (benchmarks/tests offline)
+        weights: Optional[str] = None,          # fichero local .safetensors/.pt/.pth (sin descarga)
+        precision: str = "fp32",                # "fp32" | "bf16" | "int8" (ver docstring)
+        token_pruning: bool = False,            # sólo parches dentro de la forma del ROI (ver docstring)
+        polar_unwrap: bool = False,             # anillos desenrollados a una tira polar (ver docstring)
+        polar_scale: float = 1.0,               # resolución de la tira respecto al letterbox
         **_,
     ) -> None:
         self.model_name = model_name
@@ -68,7 +129,21 @@ class DinoV2Features:
             self.device = torch.device(device)
 
         self.half = bool(half) and self.device.type == "cuda"
+
+        precision = (precision or "fp32").lower()
+        if precision not in PRECISIONS:
+            raise ValueError(f"precision debe ser uno de {PRECISIONS}")
+        if precision == "int8" and self.device.type != "cpu":
+            raise ValueError("precision='int8' (cuantización dinámica) sólo está disponible en CPU")
+        self.precision = precision
         self.imagenet_norm = bool(imagenet_norm)
+        self.token_pruning = bool(token_pruning)
+        self.polar_unwrap = bool(polar_unwrap)
+        self.polar_scale = float(polar_scale)
+        if self.polar_unwrap and not self.dynamic_input:
+            raise ValueError("polar_unwrap requiere dynamic_input=True (la tira tiene su propio grid de tokens)")
+        if self.polar_scale <= 0:
+            raise ValueError("polar_scale debe ser > 0")
 
         # validar pool
         pool = (pool or "none").lower()
@@ -76,11 +151,24 @@ class DinoV2Features:
             raise ValueError("pool debe ser 'none' o 'mean'")
         self.pool = pool
 
+        self._init_preprocess(preprocess)
+
         # --- modelo ---
-        self.model: nn.Module = timm.create_model(self.model_name, pretrained=True)
+        self.weights = str(weights) if weights else None
+        self.model: nn.Module = timm.create_model(self.model_name, pretrained=bool(pretrained) and not self.weights)
+        if self.weights:
+            self.model.load_state_dict(load_state_dict_file(self.weights), strict=True)
         self.model.eval().to(self.device)
         if self.half:
             self.model.half()
+        # pos_embed "de fábrica" antes de cuantizar (los parámetros no-Linear no cambian)
+        pe2 = getattr(self.model, "pos_embed", None)
+        self._pos_embed_base: Optional[torch.Tensor] = pe2.detach().clone() if isinstance(pe2, torch.Tensor) else None
+        self._pos_cache: Dict[Tuple[int, int], torch.Tensor] = {}
+        if self.precision == "int8":
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")  # API eager de torch.ao marcada como deprecated
+                self.model = torch.ao.quantization.quantize_dynamic(self.model, {nn.Linear}, dtype=torch.qint8)
 
         # patch size
         pe = getattr(self.model, "patch_embed", None)
@@ -90,6 +178,17 @@ class DinoV2Features:
             ps = getattr(pe, "patch_size", 14)
             self.patch = int(ps[0]) if isinstance(ps, (tuple, list)) else int(ps)
 
+    # ---------------- imagen / preprocesado ----------------
+    def _init_preprocess(self, preprocess: str) -> None:
+        """Modo de preprocesado + normalización; requiere self.device y self.imagenet_norm."""
+        preprocess = (preprocess or "pil").lower()
+        if preprocess not in ("cv2", "pil"):
+            raise ValueError("preprocess debe ser 'cv2' o 'pil'")
+        if preprocess == "cv2" and not hasattr(cv2, "resize"):
+            preprocess = "pil"  # sin OpenCV real
+        self.preprocess_mode = preprocess
+        self._tls = threading.local()  # lienzos de letterbox reutilizables por hilo
+
         # normalización tipo ImageNet
         if self.imagenet_norm:
             self.mean = torch.tensor([0.485, 0.456, 0.406], device=self.device).view(1, 3, 1, 1)
@@ -97,12 +196,10 @@ class DinoV2Features:
         else:
             self.mean = torch.zeros((1, 3, 1, 1), device=self.device)
             self.std  = torch.ones((1, 3, 1, 1), device=self.device)
+        # (x_u8 / 255 - mean) / std == x_u8 * scale + bias  (un único addcmul sobre el uint8)
+        self._norm_scale = (1.0 / (255.0 * self.std)).float()
+        self._norm_bias = (-self.mean / self.std).float()
 
-        # Guardar pos_embed "de fábrica" para poder resetearlo en cada extract()
-        pe2 = getattr(self.model, "pos_embed", None)
-        self._pos_embed_base: Optional[torch.Tensor] = pe2.detach().clone() if isinstance(pe2, torch.Tensor) else None
-
-    # ---------------- imagen / preprocesado ----------------
     @staticmethod
     def _to_pil(img) -> Image.Image:
         if isinstance(img, Image.Image):
@@ -126,19 +223,117 @@ class DinoV2Features:
         Preprocesa aplicando LETTERBOX (mantener aspecto + padding) a input_size x input_size
         si dynamic_input=False. Si dynamic_input=True se hace letterbox igualmente aquí para
         garantizar cuadrado; luego _prepare_input_size decidirá si mantener HxW.
+        Con preprocess="cv2" y un ndarray BGR usa `_preprocess_cv2`; si no, la ruta PIL.
         """
+        if self.preprocess_mode == "cv2" and isinstance(img, np.ndarray) and self.input_size > 0:
+            return self._preprocess_cv2(img)
+        return self._preprocess_pil(img)
+
+    def letterbox_box(self, h: int, w: int) -> Tuple[int, int, int, int]:
+        """
+        Caja (left, top, nw, nh) que ocupa un ROI de h x w dentro del lienzo input_size x input_size
+        del letterbox; el resto es padding negro. La usa InferenceEngine para proyectar la
+        máscara del ROI sobre el grid de tokens y recortar el heatmap al contenido.
+        """
+        target = int(self.input_size)
+        scale = min(target / w, target / h)
+        nw, nh = int(round(w * scale)), int(round(h * scale))
+        return (target - nw) // 2, (target - nh) // 2, nw, nh
+
+    def patch_keep_list(self, img_hw: Tuple[int, int], shape: Optional[dict] = None) -> Optional[np.ndarray]:
+        """
+        Con token_pruning: parches (N,) bool del grid input_size/patch que solapan la forma del
+        ROI (rect/circle/annulus de roi_mask, en píxeles del ROI) dentro del letterbox. None si
+        el modo está desactivado, el grid no es fijo o se conservan todos.
+        """
+        if not self.token_pruning or self.input_size <= 0 or self.input_size % self.patch:
+            return None
+        if self.polar_geometry(img_hw, shape) is not None:
+            return None  # la tira polar es todo anillo
+        try:
+            from .roi_mask import build_mask, token_mask
+        except ImportError:  # cargado como módulo suelto (tests)
+            from backend.roi_mask import build_mask, token_mask
+
+        h, w = int(img_hw[0]), int(img_hw[1])
+        grid = (self.input_size // self.patch, self.input_size // self.patch)
+        keep = token_mask(build_mask(h, w, shape), grid, self.letterbox_box(h, w), self.input_size).reshape(-1)
+        if keep.all() or not keep.any():
+            return None
+        return keep
+
+    def polar_geometry(self, img_hw: Tuple[int, int], shape: Optional[dict] = None):
+        """Con polar_unwrap: `PolarGeometry` de la tira de un ROI `annulus` de img_hw; None si no aplica."""
+        if not self.polar_unwrap or not shape:
+            return None
+        try:
+            from .polar import polar_geometry
+        except ImportError:  # cargado como módulo suelto (tests)
+            from backend.polar import polar_geometry
+
+        return polar_geometry(img_hw, shape, self.patch, self.input_size, scale=self.polar_scale)
+
+    @property
+    def uses_shape(self) -> bool:
+        """El preprocesado o el forward dependen de la forma del ROI (token_pruning / polar_unwrap)."""
+        return bool(self.token_pruning or self.polar_unwrap)
+
+    def _letterbox_canvas(self, target: int, box: Tuple[int, int, int, int]) -> np.ndarray:
+        """Lienzo uint8 (target, target, 3) del hilo actual; sólo se limpia si cambia la caja del ROI."""
+        tls = self._tls
+        canvas = getattr(tls, "canvas", None)
+        if canvas is None or canvas.shape[0] != target:
+            canvas = np.zeros((target, target, 3), dtype=np.uint8)
+            tls.canvas, tls.box = canvas, box
+        elif tls.box != box:
+            canvas.fill(0)
+            tls.box = box
+        return canvas
+
+    def _preprocess_cv2(self, img: np.ndarray) -> torch.Tensor:
+        """
+        Letterbox sobre el uint8 BGR decodificado, sin PIL ni copias intermedias en float:
+        un cv2.resize escribe directamente en el lienzo reutilizable (INTER_AREA al reducir,
+        INTER_CUBIC al ampliar, lo más próximo al BICUBIC de PIL), se transfiere el uint8 y
+        BGR->RGB + /255 + normalización ImageNet se hacen en un único addcmul.
+        """
+        arr = self._as_bgr_u8(img)
+        target = int(self.input_size)
+        h, w = arr.shape[:2]
+        left, top, nw, nh = self.letterbox_box(h, w)
+        scale = min(target / w, target / h)
+
+        canvas = self._letterbox_canvas(target, (left, top, nw, nh))
+        interp = cv2.INTER_AREA if scale < 1.0 else cv2.INTER_CUBIC
+        cv2.resize(arr, (nw, nh), dst=canvas[top:top + nh, left:left + nw], interpolation=interp)
+        return self._normalize_u8(canvas)
+
+    @staticmethod
+    def _as_bgr_u8(img: np.ndarray) -> np.ndarray:
+        arr = img if img.dtype == np.uint8 else img.astype(np.uint8)
+        if arr.ndim == 2:
+            return cv2.cvtColor(arr, cv2.COLOR_GRAY2BGR)
+        if arr.shape[-1] == 4:
+            return cv2.cvtColor(arr, cv2.COLOR_BGRA2BGR)
+        return arr
+
+    def _normalize_u8(self, arr: np.ndarray) -> torch.Tensor:
+        """uint8 BGR (H,W,3) -> (1,3,H,W) RGB normalizado (un addcmul)."""
+        t = torch.from_numpy(arr).to(self.device)            # (H,W,3) uint8 BGR
+        t = t.permute(2, 0, 1).flip(0).unsqueeze(0)           # (1,3,H,W) RGB (copia uint8)
+        x = torch.addcmul(self._norm_bias, t, self._norm_scale)
+        return x.half() if self.half else x
+
+    def _preprocess_pil(self, img) -> torch.Tensor:
         pil = self._to_pil(img)
 
         # --- LETTERBOX (mantener aspecto + padding a cuadrado) ---
         if self.input_size and self.input_size > 0:
             target = int(self.input_size)
             w, h = pil.size
-            scale = min(target / w, target / h)
-            nw, nh = int(round(w * scale)), int(round(h * scale))
+            left, top, nw, nh = self.letterbox_box(h, w)
             pil_resized = pil.resize((nw, nh), Image.BICUBIC)
             canvas = Image.new("RGB", (target, target), (0, 0, 0))
-            left = (target - nw) // 2
-            top = (target - nh) // 2
             canvas.paste(pil_resized, (left, top))
             pil = canvas  # ahora es exactamente target x target
 
@@ -149,12 +344,12 @@ class DinoV2Features:
         return x
 
     # ---------------- tamaño de entrada ----------------
-    def _prepare_input_size(self, model: nn.Module, x: torch.Tensor):
+    def _resize_input(self, x: torch.Tensor):
         """
         - dynamic_input=False -> fuerza siempre (input_size, input_size)
         - dynamic_input=True  -> acepta HxW actuales si son múltiplos de self.patch;
                                  si no, redimensiona a input_size.
-        En ambos casos, sincroniza patch_embed/img_size del ViT y adapta pos_embed.
+        No toca el modelo: sólo ajusta el tensor de entrada.
         """
         target_h = int(self.input_size)
         target_w = int(self.input_size)
@@ -166,11 +361,19 @@ class DinoV2Features:
                 pass  # mantener H, W
             else:
                 x = F.interpolate(x, size=(target_h, target_w), mode="bilinear", align_corners=False)
-                H, W = target_h, target_w
         else:
             if (H, W) != (target_h, target_w):
                 x = F.interpolate(x, size=(target_h, target_w), mode="bilinear", align_corners=False)
-                H, W = target_h, target_w
+
+        return x, ("dynamic" if self.dynamic_input else "resize")
+
+    def _prepare_input_size(self, model: nn.Module, x: torch.Tensor):
+        """
+        Ruta legacy (modelos sin forward manual): ajusta la entrada con `_resize_input`,
+        sincroniza patch_embed/img_size del ViT y fija en el modelo el pos_embed del grid actual.
+        """
+        x, how = self._resize_input(x)
+        H, W = x.shape[-2:]
 
         # Sincronizar ViT/timm
         pe = getattr(model, "patch_embed", None)
@@ -190,39 +393,123 @@ class DinoV2Features:
         # Reset + resize manual del pos_embed al grid actual
         self._reset_and_resize_pos_embed(H // self.patch, W // self.patch)
 
-        return x, ("dynamic" if self.dynamic_input else "resize")
+        return x, how
 
-    # ---- reset + adaptar pos_embed al grid actual (sin timm.resize_pos_embed) ----
-    def _reset_and_resize_pos_embed(self, h_tokens: int, w_tokens: int):
+    # ---- pos_embed redimensionado al grid (sin timm.resize_pos_embed), cacheado por grid ----
+    def _num_pos_prefix_tokens(self) -> int:
+        if getattr(self.model, "no_embed_class", False):
+            return 0
+        return int(getattr(self.model, "num_prefix_tokens", 1))
+
+    def _resized_pos_embed(self, h_tokens: int, w_tokens: int) -> Optional[torch.Tensor]:
+        """
+        pos_embed "de fábrica" interpolado (bicúbico) a (h_tokens, w_tokens): (1, prefijo+HW, C).
+        Se calcula una vez por grid y se reutiliza; el modelo no se modifica.
+        """
         if self._pos_embed_base is None:
-            return
-        with torch.no_grad():
-            # Reset al "de fábrica"
-            base = self._pos_embed_base.to(self.model.pos_embed.device, dtype=self.model.pos_embed.dtype)
-            self.model.pos_embed = nn.Parameter(base.clone(), requires_grad=False)
+            return None
+        key = (int(h_tokens), int(w_tokens))
+        cached = self._pos_cache.get(key)
+        if cached is not None:
+            return cached
 
-            pos = self.model.pos_embed  # (1, 1+HW, C)
-            if not isinstance(pos, torch.Tensor):
-                return
-            cls, grid = pos[:, :1], pos[:, 1:]                   # (1,1,C) y (1,HW,C)
+        with torch.no_grad():
+            base = self._pos_embed_base.float()
+            n_prefix = self._num_pos_prefix_tokens()
+            prefix, grid = base[:, :n_prefix], base[:, n_prefix:]  # (1,P,C) y (1,HW,C)
 
             # grid actual del pos_embed (g_old x g_old)
             g_old = int(grid.shape[1] ** 0.5)
             grid = grid[:, : g_old * g_old, :]                   # seguridad
             B, N, C = grid.shape
 
-            # (1, HW, C) -> (1, C, g_old, g_old)
-            grid_2d = grid.reshape(B, g_old, g_old, C).permute(0, 3, 1, 2).contiguous()
+            if (g_old, g_old) == key:
+                new_grid = grid
+            else:
+                # (1, HW, C) -> (1, C, g_old, g_old) -> interpolar 2D -> (1, HW, C)
+                grid_2d = grid.reshape(B, g_old, g_old, C).permute(0, 3, 1, 2).contiguous()
+                new_2d = F.interpolate(grid_2d, size=key, mode='bicubic', align_corners=False)
+                new_grid = new_2d.permute(0, 2, 3, 1).reshape(B, key[0] * key[1], C)
 
-            # Interpolar en 2D al nuevo tamaño
-            new_2d = F.interpolate(grid_2d, size=(h_tokens, w_tokens), mode='bicubic', align_corners=False)
+            new_pos = torch.cat([prefix, new_grid], dim=1).contiguous()
+            new_pos = new_pos.to(self.device, dtype=self._pos_embed_base.dtype)
 
-            # Volver a (1, HW, C)
-            new_grid = new_2d.permute(0, 2, 3, 1).reshape(B, h_tokens * w_tokens, C).contiguous()
+        # Asignación atómica en el dict: como mucho dos hilos calculan lo mismo a la vez
+        self._pos_cache[key] = new_pos
+        return new_pos
 
-            # Concatenar CLS
-            new_pos = torch.cat([cls, new_grid], dim=1)
-            self.model.pos_embed = nn.Parameter(new_pos, requires_grad=False)
+    def _reset_and_resize_pos_embed(self, h_tokens: int, w_tokens: int):
+        pos = self._resized_pos_embed(h_tokens, w_tokens)
+        if pos is None:
+            return
+        self.model.pos_embed = nn.Parameter(pos, requires_grad=False)
+
+    # ---------------- forward manual con pos_embed cacheado ----------------
+    def _supports_cached_forward(self) -> bool:
+        m = self.model
+        pe = getattr(m, "patch_embed", None)
+        return (
+            self._pos_embed_base is not None
+            and pe is not None
+            and isinstance(getattr(pe, "proj", None), nn.Module)
+            and bool(getattr(pe, "flatten", True))
+            and isinstance(getattr(m, "blocks", None), nn.Sequential)
+            and hasattr(m, "cls_token")
+        )
+
+    def _intermediate_layers_cached(
+        self, x: torch.Tensor, out_indices: Iterable[int], keep_idx: Optional[torch.Tensor] = None
+    ) -> List[torch.Tensor]:
+        """
+        Equivalente a `get_intermediate_layers(x, out_indices)` de timm pero sumando el
+        pos_embed cacheado del grid actual: sin set_input_size ni nn.Parameter nuevos.
+        `keep_idx` (K,): índices de los parches que pasan por los bloques (con su pos_embed);
+        el coste de atención baja de (1+N)² a (1+K)².
+        Devuelve [(B, N, C)] (o [(B, K, C)] con keep_idx) sin tokens de prefijo (CLS/registros).
+        """
+        m = self.model
+        pe = m.patch_embed
+        B = x.shape[0]
+        h_tok, w_tok = x.shape[-2] // self.patch, x.shape[-1] // self.patch
+
+        t = pe.proj(x)                                  # (B,C,Ht,Wt)
+        t = t.flatten(2).transpose(1, 2)                # (B,N,C)
+        t = pe.norm(t) if hasattr(pe, "norm") else t
+
+        pos = self._resized_pos_embed(h_tok, w_tok)
+        to_cat = []
+        if getattr(m, "cls_token", None) is not None:
+            to_cat.append(m.cls_token.expand(B, -1, -1))
+        if getattr(m, "reg_token", None) is not None:
+            to_cat.append(m.reg_token.expand(B, -1, -1))
+        if getattr(m, "no_embed_class", False):
+            t = t + pos
+            if to_cat:
+                t = torch.cat(to_cat + [t], dim=1)
+        else:
+            if to_cat:
+                t = torch.cat(to_cat + [t], dim=1)
+            t = t + pos
+        if keep_idx is not None:
+            n_prefix = len(to_cat)
+            t = torch.cat([t[:, :n_prefix], t[:, n_prefix:].index_select(1, keep_idx)], dim=1)
+
+        for name in ("pos_drop", "patch_drop", "norm_pre"):
+            layer = getattr(m, name, None)
+            if layer is not None:
+                t = layer(t)
+
+        take = set(int(i) for i in out_indices)
+        last = max(take) if take else len(m.blocks) - 1
+        n_prefix = len(to_cat)
+        outputs: List[torch.Tensor] = []
+        for i, blk in enumerate(m.blocks):
+            t = blk(t)
+            if i in take:
+                outputs.append(t[:, n_prefix:])
+            if i >= last:
+                break
+        return outputs
 
     # ---------------- compat capas intermedias ----------------
     def _call_get_intermediate_layers_compat(
@@ -266,9 +553,10 @@ class DinoV2Features:
         want_reshape: bool = False,             # << clave: evitar reshape interno de timm (37x37)
         remove_cls: bool = True,                # quitar CLS si viene
         combine: str = "concat",                # "concat" | "mean" | "stack"
+        keep_idx: Optional[torch.Tensor] = None,  # poda de parches (sólo forward con pos_embed cacheado)
     ) -> torch.Tensor:
         """
-        Devuelve tokens como (N, C_out) con N = Htok*Wtok.
+        Devuelve tokens como (B, N, C_out) con N = Htok*Wtok (con `keep_idx`, (B, K, C_out)).
         """
         def _expected_grid(batched_x: torch.Tensor) -> tuple[int, int, int]:
             H, W = batched_x.shape[-2:]
@@ -294,23 +582,37 @@ class DinoV2Features:
                 )
             return t
 
-        # 1) Asegurar tamaño de entrada (fijo / sincronizado) y adaptar pos_embed
-        x, _ = self._prepare_input_size(self.model, x)
+        # 1) Asegurar tamaño de entrada (fijo / dinámico)
+        cached_forward = self._supports_cached_forward()
+        if cached_forward:
+            x, _ = self._resize_input(x)
+        else:
+            # Ruta legacy: sincroniza el modelo y fija el pos_embed del grid
+            x, _ = self._prepare_input_size(self.model, x)
         htok, wtok, expected_N = _expected_grid(x)
+        if keep_idx is not None:
+            if not cached_forward:
+                raise RuntimeError("token_pruning requiere el forward con pos_embed cacheado")
+            expected_N = int(keep_idx.numel())
 
         # 2) ¿Usamos intermedias?
         if use_intermediate is None:
-            use_intermediate = bool(self.out_indices) and hasattr(self.model, "get_intermediate_layers")
+            use_intermediate = bool(self.out_indices) and (
+                cached_forward or hasattr(self.model, "get_intermediate_layers")
+            )
 
         if use_intermediate:
             try:
-                layers = self._call_get_intermediate_layers_compat(
-                    self.model,
-                    x,
-                    self.out_indices,
-                    want_cls=False,
-                    want_reshape=want_reshape,
-                )
+                if cached_forward:
+                    layers = self._intermediate_layers_cached(x, self.out_indices, keep_idx)
+                else:
+                    layers = self._call_get_intermediate_layers_compat(
+                        self.model,
+                        x,
+                        self.out_indices,
+                        want_cls=False,
+                        want_reshape=want_reshape,
+                    )
                 if layers is not None:
                     # Normalizar todas a (B,N,C)
                     normed: list[torch.Tensor] = []
@@ -335,12 +637,18 @@ class DinoV2Features:
                         raise ValueError("combine debe ser 'concat', 'mean' o 'stack'"
 
                     )
-                    return out[0]  # (N, C_out)
+                    return out  # (B, N, C_out)
             except Exception as ex:
+                if keep_idx is not None:
+                    raise
                 # Fallback limpio a forward_features
-                print(f"[features] fallback intermedias -> forward_features: {ex}")
+                log.warning("[features] fallback intermedias -> forward_features: %s", ex)
+        if keep_idx is not None:
+            raise RuntimeError("token_pruning requiere capas intermedias (out_indices)")
 
-        # 3) forward_features (fallback o seleccionado)
+        # 3) forward_features (fallback o seleccionado): requiere el modelo sincronizado
+        if cached_forward:
+            x, _ = self._prepare_input_size(self.model, x)
         feats = self.model.forward_features(x)
         if isinstance(feats, dict):
             t = feats.get("x") or feats.get("tokens")
@@ -353,15 +661,50 @@ class DinoV2Features:
             t = feats
 
         if t.ndim == 3:          # (B,N,C) posiblemente con CLS
-            t = _as_BxNC(t, expected_N)
-            return t[0]          # (N,C)
+            return _as_BxNC(t, expected_N)
         elif t.ndim == 4:        # (B,C,H,W)
             b, c, h, w = t.shape
-            return t.permute(0, 2, 3, 1).reshape(b, h * w, c)[0]  # (N,C)
+            return t.permute(0, 2, 3, 1).reshape(b, h * w, c)  # (B,N,C)
         else:
             raise RuntimeError(f"Forma inesperada de features: {t.shape}")
 
+    def _autocast(self):
+        if self.precision == "bf16":
+            return torch.autocast(device_type=self.device.type, dtype=torch.bfloat16)
+        return nullcontext()
+
     # ---------------- utilidades públicas ----------------
+    def with_input_size(self, input_size: int) -> "DinoV2Features":
+        """
+        Extractor con otro input_size que comparte el modelo (sin copiar pesos), p.ej. la pasada de
+        baja resolución de la cascada. Requiere el forward con pos_embed cacheado (no toca el
+        modelo, así ambos pueden usarse a la vez desde hilos distintos).
+        """
+        if self.model is None or not self._supports_cached_forward():
+            raise ValueError("with_input_size requiere el modelo torch con forward de pos_embed cacheado")
+        if int(input_size) <= 0 or int(input_size) % self.patch:
+            raise ValueError(f"input_size debe ser múltiplo de {self.patch}")
+        other = copy.copy(self)
+        other.input_size = int(input_size)
+        other._pos_cache = {}
+        other._tls = threading.local()
+        return other
+
+    def save_weights(self, path: str) -> None:
+        """Guarda los pesos del modelo (safetensors si la extensión es .safetensors) para `weights=`."""
+        if self.precision == "int8":
+            raise RuntimeError("save_weights necesita el modelo sin cuantizar (precision='fp32' o 'bf16')")
+        state = {k: v.detach().float().cpu().contiguous() for k, v in self.model.state_dict().items()}
+        if self._pos_embed_base is not None and "pos_embed" in state:
+            # el pos_embed "de fábrica" (la ruta legacy puede haber dejado el del modelo redimensionado)
+            state["pos_embed"] = self._pos_embed_base.detach().float().cpu().contiguous()
+        if str(path).endswith(".safetensors"):
+            from safetensors.torch import save_file
+
+            save_file(state, str(path))
+        else:
+            torch.save(state, str(path))
+
     def get_metadata(self) -> dict:
         return {
             "model_name": self.model_name,
@@ -373,6 +716,11 @@ class DinoV2Features:
             "dynamic_input": bool(self.dynamic_input),
             "out_indices": list(self.out_indices) if self.out_indices else [],
             "pool": self.pool,
+            "preprocess": self.preprocess_mode,
+            "precision": self.precision,
+            "token_pruning": bool(self.token_pruning),
+            "polar_unwrap": bool(self.polar_unwrap),
+            "polar_scale": float(self.polar_scale),
         }
 
     def assert_token_shape(self, expected: Tuple[int, int], got: Tuple[int, int], ctx: str = ""):
@@ -384,24 +732,110 @@ class DinoV2Features:
 
     # ---------------- API pública ----------------
     @torch.inference_mode()
-    def extract(self, img):
-        x = self._preprocess(img)
-        x, how = self._prepare_input_size(self.model, x)
+    def preprocess(self, img, shape: Optional[dict] = None) -> torch.Tensor:
+        """
+        Letterbox + normalización + tamaño final de entrada: tensor (1,3,H,W) listo para
+        `forward_preprocessed`. No toca el modelo (seguro desde cualquier hilo).
+        Con polar_unwrap y `shape` annulus, la tira polar (H,W múltiplos del patch) sin letterbox.
+        """
+        with stage("preprocess"):
+            geom = self.polar_geometry(np.asarray(img).shape[:2], shape) if self.polar_unwrap else None
+            if geom is not None:
+                try:
+                    from .polar import unwrap
+                except ImportError:  # cargado como módulo suelto (tests)
+                    from backend.polar import unwrap
+                return self._normalize_u8(unwrap(self._as_bgr_u8(np.asarray(img)), geom))
+            x = self._preprocess(img)
+            x, _ = self._resize_input(x)
+            return x
+
+    @torch.inference_mode()
+    def forward_preprocessed(self, x, keep: Optional[np.ndarray] = None) -> List[Tuple[np.ndarray, Tuple[int, int]]]:
+        """
+        Forward del ViT sobre entradas ya preprocesadas: un tensor (B,3,H,W) o una lista de
+        tensores (1,3,H,W) del mismo tamaño. Devuelve [(embedding_numpy, (h_tokens, w_tokens)), ...].
+        `keep` (N,) bool (de `patch_keep_list`, común a todo el lote): sólo esos parches pasan
+        por los bloques; los demás vuelven al grid con embedding 0.
+        """
+        with stage("forward"):
+            if isinstance(x, (list, tuple)):
+                x = torch.cat(list(x), dim=0)
+            x, _ = self._resize_input(x)
+            H, W = x.shape[-2:]
+            hw = (int(H // self.patch), int(W // self.patch))
+            keep_idx = None
+            if keep is not None:
+                keep = np.asarray(keep, dtype=bool).reshape(-1)
+                if keep.size != hw[0] * hw[1]:
+                    raise ValueError(f"keep tiene {keep.size} parches; el grid {hw} tiene {hw[0] * hw[1]}")
+                keep_idx = torch.from_numpy(np.flatnonzero(keep)).to(self.device)
+
+            with self._autocast():
+                tokens = self._forward_tokens(x, keep_idx=keep_idx)  # (B, N, C) o (B, K, C)
+            if self.pool == "mean":
+                tokens = tokens.mean(dim=1, keepdim=True)  # (B, 1, C)
+            elif keep_idx is not None:
+                full = tokens.new_zeros((tokens.shape[0], hw[0] * hw[1], tokens.shape[-1]))
+                full[:, keep_idx] = tokens
+                tokens = full
+
+            emb_np = tokens.float().detach().cpu().numpy()
+            return [(emb_np[j], hw) for j in range(emb_np.shape[0])]
+
+    @torch.inference_mode()
+    def extract(self, img, shape: Optional[dict] = None):
+        """`shape` (forma del ROI) sólo se usa con token_pruning / polar_unwrap."""
+        keep = self.patch_keep_list(np.asarray(img).shape[:2], shape) if self.token_pruning else None
+        x = self.preprocess(img, shape)
         H, W = x.shape[-2:]
         h_tokens, w_tokens = H // self.patch, W // self.patch
 
-        # Debug útil
-        pe_n = getattr(self.model, "pos_embed", None)
-        pe_count = int(pe_n.shape[1]) if isinstance(pe_n, torch.Tensor) else -1
-        print(
-            f"[features] after-prep: {H}x{W} ({how}), patch={self.patch}, "
-            f"grid={h_tokens}x{w_tokens}, tokens(N+CLS)={h_tokens*w_tokens+1}, pos_embed_N={pe_count}"
-        )
-
-        tokens = self._forward_tokens(x)  # (N, C)
+        # Debug útil (sólo con nivel DEBUG: evita E/S por petición)
+        if log.isEnabledFor(logging.DEBUG):
+            pe_n = self._resized_pos_embed(h_tokens, w_tokens)
+            pe_count = int(pe_n.shape[1]) if isinstance(pe_n, torch.Tensor) else -1
+            log.debug(
+                "[features] after-prep: %dx%d (%s), patch=%d, grid=%dx%d, tokens(N+CLS)=%d, pos_embed_N=%d",
+                H, W, "dynamic" if self.dynamic_input else "resize", self.patch,
+                h_tokens, w_tokens, h_tokens * w_tokens + 1, pe_count,
+            )
 
-        if self.pool == "mean":
-            tokens = tokens.mean(dim=0, keepdim=True)  # (1, C)
+        return self.forward_preprocessed(x, keep)[0] if keep is not None else self.forward_preprocessed(x)[0]
 
-        emb_np = tokens.float().detach().cpu().numpy()
-        return emb_np, (int(h_tokens), int(w_tokens))
+    @torch.inference_mode()
+    def extract_batch(
+        self, images: Sequence, batch_size: int = 8, shapes: Optional[Sequence[Optional[dict]]] = None
+    ) -> List[Tuple[np.ndarray, Tuple[int, int]]]:
+        """
+        Extrae tokens de varias imágenes apilándolas en tensores (B,3,H,W): un único
+        forward por lote en vez de uno por imagen. Con token_pruning, `shapes` (una forma o
+        None por imagen) fija los parches conservados y el lote se agrupa por keep-list; con
+        polar_unwrap, los anillos entran como tira polar (agrupadas por tamaño).
+        Devuelve [(embedding_numpy, (h_tokens, w_tokens)), ...] en el orden de `images`.
+        """
+        imgs = list(images)
+        results: List[Optional[Tuple[np.ndarray, Tuple[int, int]]]] = [None] * len(imgs)
+        bs = max(1, int(batch_size))
+
+        for start in range(0, len(imgs), bs):
+            # Agrupar por tamaño tras el letterbox (con dynamic_input pueden diferir)
+            groups: Dict[tuple, List[Tuple[int, torch.Tensor]]] = {}
+            keeps: Dict[tuple, Optional[np.ndarray]] = {}
+            for i in range(start, min(start + bs, len(imgs))):
+                keep = None
+                if self.token_pruning:
+                    keep = self.patch_keep_list(np.asarray(imgs[i]).shape[:2], shapes[i] if shapes else None)
+                x = self.preprocess(imgs[i], shapes[i] if shapes else None)
+                key = (tuple(x.shape[-2:]), keep.tobytes() if keep is not None else None)
+                keeps[key] = keep
+                groups.setdefault(key, []).append((i, x))
+
+            for key, items in groups.items():
+                keep = keeps[key]
+                xs = [x for _, x in items]
+                outs = self.forward_preprocessed(xs, keep) if keep is not None else self.forward_preprocessed(xs)
+                for (i, _), out in zip(items, outs):
+                    results[i] = out
+
+        return results  # type: ignore[return-value]
@@ -5,8 +5,189 @@ from typing import Tuple, Optional, Dict, Any, List
 
 from .features import DinoV2Features
 from .patchcore import PatchCoreMemory
-from .roi_mask import build_mask
-from .utils import percentile, mm2_to_px2, px2_to_mm2
+from .polar import strip_to_roi
+from .roi_mask import build_mask, scale_shape, token_mask
+from .utils import percentiles, mm2_to_px2, px2_to_mm2
+from .metrics import Laps
+
+# Qué heatmap calcula InferenceEngine.run (ver docstring)
+HEATMAP_MODES = ("full", "tokens", "none", "on_fail")
+# Resolución del posproceso (suavizado, score, islas): la del ROI o 1/2/4 muestras por token
+POST_RESOLUTIONS = ("roi", "tokens", "x2", "x4")
+_POST_FACTORS = {"tokens": 1, "x2": 2, "x4": 4}
+# Tokens -> ROI: sólo la zona del lienzo con contenido o el grid completo (padding incluido, memorias
+# anteriores: sus umbrales se calibraron así)
+HEATMAP_MAPPINGS = ("content", "grid")
+
+
+def letterbox_geometry(extractor, img_hw: Tuple[int, int], token_hw: Tuple[int, int]):
+    """
+    (box, target) del letterbox del extractor para un ROI de img_hw, o None si el extractor
+    no hace letterbox o su grid no corresponde al lienzo (p.ej. stubs o dynamic_input).
+    """
+    box_fn = getattr(extractor, "letterbox_box", None)
+    target = int(getattr(extractor, "input_size", 0) or 0)
+    patch = int(getattr(extractor, "patch", 0) or 0)
+    if not callable(box_fn) or target <= 0 or patch <= 0:
+        return None
+    if (int(token_hw[0]) * patch, int(token_hw[1]) * patch) != (target, target):
+        return None
+    return tuple(box_fn(int(img_hw[0]), int(img_hw[1]))), target
+
+
+def roi_polar_geometry(extractor, img_hw: Tuple[int, int], shape: Optional[Dict[str, Any]], token_hw: Tuple[int, int]):
+    """
+    `PolarGeometry` si el ROI entró al extractor como tira polar (polar_unwrap + annulus) con
+    este grid de tokens; None en caso contrario.
+    """
+    fn = getattr(extractor, "polar_geometry", None)
+    if not callable(fn) or not shape:
+        return None
+    geom = fn((int(img_hw[0]), int(img_hw[1])), shape)
+    if geom is None or tuple(geom.token_hw) != (int(token_hw[0]), int(token_hw[1])):
+        return None
+    return geom
+
+
+def roi_token_mask(
+    extractor,
+    img_hw: Tuple[int, int],
+    shape: Optional[Dict[str, Any]],
+    token_hw: Tuple[int, int],
+    mask: Optional[np.ndarray] = None,
+) -> Optional[np.ndarray]:
+    """
+    Tokens (N,) bool que solapan la forma del ROI (rect/circle/annulus) teniendo en cuenta el
+    offset del letterbox: excluye el padding y, p.ej., el cubo y las esquinas de un anillo.
+    None si no se puede proyectar o si se conservan todos (no hay nada que ahorrar), y
+    con la tira polar (todo anillo).
+    """
+    if roi_polar_geometry(extractor, img_hw, shape, token_hw) is not None:
+        return None
+    geom = letterbox_geometry(extractor, img_hw, token_hw)
+    if geom is None:
+        return None
+    box, target = geom
+    if mask is None:
+        # directamente al tamaño que ocupa en el lienzo (no depende del tamaño del ROI)
+        H, W = int(img_hw[0]), int(img_hw[1])
+        nw, nh = int(box[2]), int(box[3])
+        mask = build_mask(nh, nw, scale_shape(shape, nw / W, nh / H))
+    keep = token_mask(mask, token_hw, box, target).reshape(-1)
+    if keep.all() or not keep.any():
+        return None
+    return keep
+
+
+def _fill_excluded(heat: np.ndarray, keep: np.ndarray) -> np.ndarray:
+    """Rellena los tokens excluidos con el valor del token conservado más próximo (sin bordes artificiales)."""
+    outside = (~keep.reshape(heat.shape)).astype(np.uint8)
+    _, labels = cv2.distanceTransformWithLabels(outside, cv2.DIST_L2, 3, labelType=cv2.DIST_LABEL_PIXEL)
+    # DIST_LABEL_PIXEL numera los píxeles conservados (valor 0) en orden de barrido
+    kept_values = heat[outside == 0]
+    return kept_values[labels - 1].astype(np.float32)
+
+
+def _linear_weights(n_out: int, n_in: int, scale: float, offset: float) -> np.ndarray:
+    """Matriz (n_out, n_in) de interpolación lineal 1D para src = dst * scale + offset (bordes replicados)."""
+    src = np.clip(np.arange(n_out, dtype=np.float64) * scale + offset, 0.0, n_in - 1)
+    i0 = np.floor(src).astype(np.int64)
+    i1 = np.minimum(i0 + 1, n_in - 1)
+    w1 = (src - i0).astype(np.float32)
+    R = np.zeros((n_out, n_in), dtype=np.float32)
+    rows = np.arange(n_out)
+    np.add.at(R, (rows, i0), 1.0 - w1)
+    np.add.at(R, (rows, i1), w1)
+    return R
+
+
+def tokens_to_roi(heat: np.ndarray, img_hw: Tuple[int, int], geometry=None) -> np.ndarray:
+    """
+    Reescala el mapa de tokens (Ht, Wt) al ROI (H, W) con interpolación bilineal. Con la
+    geometría del letterbox sólo se usa la zona del lienzo que ocupa el ROI (el padding queda
+    fuera); si el ROI llena el lienzo (o sin geometría) es un cv2.resize del grid completo.
+    """
+    H, W = int(img_hw[0]), int(img_hw[1])
+    heat = heat.astype(np.float32, copy=False)
+    if geometry is None or tuple(geometry[0]) == (0, 0, geometry[1], geometry[1]):
+        return cv2.resize(heat, (W, H), interpolation=cv2.INTER_LINEAR).astype(np.float32)
+    (left, top, nw, nh), target = geometry
+    Ht, Wt = heat.shape
+    # píxel del ROI -> lienzo -> coordenada de token (centros de píxel, como cv2.resize);
+    # separable: Ry (H, Ht) @ heat @ Rx (W, Wt).T, dos GEMM pequeñas
+    px, py = target / Wt, target / Ht
+    sx, sy = nw / W, nh / H
+    Rx = _linear_weights(W, Wt, sx / px, (left + 0.5 * sx) / px - 0.5)
+    Ry = _linear_weights(H, Ht, sy / py, (top + 0.5 * sy) / py - 0.5)
+    return np.ascontiguousarray((Ry @ heat) @ Rx.T)
+
+
+def work_scale(
+    post_resolution: str, img_hw: Tuple[int, int], token_hw: Tuple[int, int], polar=None
+) -> float:
+    """
+    Píxeles del mapa de trabajo del posproceso por píxel del ROI: 1.0 con "roi"; con "tokens",
+    "x2" o "x4", 1/2/4 muestras por token a lo largo del ROI (nunca más que el propio ROI).
+    """
+    mode = str(post_resolution or "roi").lower()
+    if mode not in POST_RESOLUTIONS:
+        raise ValueError(f"post_resolution debe ser uno de {POST_RESOLUTIONS}, no {post_resolution!r}")
+    if mode == "roi":
+        return 1.0
+    side = max(int(img_hw[0]), int(img_hw[1]))
+    if polar is not None:
+        # densidad de la tira: tokens radiales por píxel de anillo
+        tokens = side * polar.token_hw[0] / max(polar.r_outer - polar.r_inner, 1e-6)
+    else:
+        tokens = max(int(token_hw[0]), int(token_hw[1]))  # el lado mayor del ROI llena el grid
+    return min(1.0, _POST_FACTORS[mode] * tokens / side)
+
+
+def _regions(
+    heat: np.ndarray, mask: np.ndarray, thr: float, min_area_px: float, roi_hw: Tuple[int, int], mm_per_px: float
+) -> List[Dict[str, Any]]:
+    """
+    Regiones >= thr dentro de la máscara del mapa de trabajo (h, w): contornos externos filtrados
+    por área (cv2.contourArea en px² del ROI, como siempre) y un connectedComponentsWithStats para
+    bbox y nº de píxeles de cada isla (`pixel_count`, px² del ROI). Sólo bbox y contornos se llevan
+    a píxeles del ROI (roi_hw).
+    """
+    h, w = heat.shape
+    H, W = int(roi_hw[0]), int(roi_hw[1])
+    kx, ky = w / W, h / H
+    bin_img = (mask & (heat >= thr)).view(np.uint8)
+    n, labels, stats, _ = cv2.connectedComponentsWithStats(bin_img, connectivity=8)
+    if n <= 1:
+        return []
+    cnts, _ = cv2.findContours(bin_img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    to_roi = 1.0 / (kx * ky)   # px² del mapa de trabajo -> px² del ROI
+    scale = np.array([1.0 / kx, 1.0 / ky])
+    hi = np.array([W - 1, H - 1])
+    regions: List[Dict[str, Any]] = []
+    for c in cnts:
+        area_px = float(cv2.contourArea(c)) * to_roi
+        if area_px < float(min_area_px):
+            continue
+        x0, y0 = c[0, 0]
+        lbl = int(labels[y0, x0])  # un contorno externo por componente 8-conexa
+        x, y, bw, bh = (int(v) for v in stats[lbl, :4])
+        if (h, w) != (H, W):
+            pts = np.clip(np.rint((c.reshape(-1, 2) + 0.5) * scale - 0.5), 0, hi).astype(np.int32)
+            bx0, by0 = int(np.floor(x / kx)), int(np.floor(y / ky))
+            bx1, by1 = min(W, int(np.ceil((x + bw) / kx))), min(H, int(np.ceil((y + bh) / ky)))
+            x, y, bw, bh = bx0, by0, bx1 - bx0, by1 - by0
+        else:
+            pts = c
+        regions.append({
+            "bbox": [x, y, bw, bh],
+            "area_px": area_px,
+            "area_mm2": float(px2_to_mm2(area_px, mm_per_px)),
+            "pixel_count": float(stats[lbl, cv2.CC_STAT_AREA]) * to_roi,
+            "contour": contour_to_list(pts),
+        })
+    regions.sort(key=lambda r: r["area_px"], reverse=True)
+    return regions
 
 
 class InferenceEngine:
@@ -39,7 +220,14 @@ class InferenceEngine:
             blur_sigma: float = 1.0,
             area_mm2_thr: float = 1.0,
             threshold: Optional[float] = None,
-            score_percentile: Optional[int] = None) -> Dict[str, Any]:
+            score_percentile: Optional[int] = None,
+            embeddings: Optional[np.ndarray] = None,
+            token_hw: Optional[Tuple[int, int]] = None,
+            distances: Optional[np.ndarray] = None,
+            heatmap: str = "full",
+            mask_tokens: bool = True,
+            post_resolution: str = "roi",
+            heatmap_mapping: str = "content") -> Dict[str, Any]:
         """
         Ejecuta una pasada de inferencia.
 
@@ -51,18 +239,51 @@ class InferenceEngine:
             area_mm2_thr: área mínima de defectos en mm² para eliminar islas pequeñas.
             threshold: si se pasa, se segmenta el heatmap y se devuelven regiones.
             score_percentile: si se pasa, sobrescribe el percentil usado para el score global.
+            embeddings: tokens (N, C) ya extraídos de `img_bgr`; evita repetir el forward del ViT.
+            token_hw: (Ht, Wt) de `embeddings`; obligatorio si se pasan embeddings.
+            distances: min-dist kNN por token (N,) ya calculadas (p.ej. consulta agrupada de /infer_batch).
+            heatmap: "full" (ROI completo), "tokens" (solo grid Ht x Wt), "none" u "on_fail"
+                (completo solo si hay threshold y score >= threshold). Evita el trabajo de visualización
+                cuando no se va a enviar.
+            mask_tokens: consulta el kNN sólo con los tokens que solapan la forma del ROI (sin padding
+                del letterbox ni, p.ej., el cubo de un anillo); los excluidos toman el valor del token
+                conservado más próximo. Con `distances` precalculadas sólo se aplica el relleno.
+            Con un extractor polar_unwrap y `shape` annulus, el grid es el de la tira polar y el
+            heatmap se devuelve a cartesianas (`backend.polar.strip_to_roi`) antes del posproceso;
+            con heatmap="tokens" se devuelve el grid de la tira.
+            post_resolution: resolución del suavizado, score e islas: "roi" (píxeles del ROI) o
+                "tokens"/"x2"/"x4" (1/2/4 muestras por token a lo largo del ROI): el coste deja de
+                depender del tamaño del ROI; sólo bbox/contornos (y el heatmap completo, si se pide)
+                se llevan a píxeles del ROI. `area_px` es el nº de píxeles de la región (en px del ROI).
+            heatmap_mapping: "content" reescala al ROI sólo la zona del letterbox que ocupa; "grid"
+                estira el grid completo con el padding (cambia score y áreas en ROIs no cuadrados:
+                usar el modo con el que se calibró la memoria).
 
         Returns:
             dict con:
               - score: float
               - threshold: Optional[float]
-              - heatmap_u8: np.uint8[H,W] (0..255, ya enmascarado)
+              - heatmap_u8: np.uint8[H,W] (0..255, ya enmascarado) o None según `heatmap`
+              - heatmap_tokens_u8: np.uint8[Ht,Wt] (solo con heatmap="tokens")
               - regions: lista de regiones (si threshold no es None)
               - token_shape: [Ht, Wt]
               - params: metadatos de ejecución
         """
-        # 1) Embeddings del ROI canónico
-        emb, (Ht, Wt) = self.extractor.extract(img_bgr)
+        mode = str(heatmap or "full").lower()
+        if mode not in HEATMAP_MODES:
+            raise ValueError(f"heatmap debe ser uno de {HEATMAP_MODES}, no {heatmap!r}")
+        if heatmap_mapping not in HEATMAP_MAPPINGS:
+            raise ValueError(f"heatmap_mapping debe ser uno de {HEATMAP_MAPPINGS}, no {heatmap_mapping!r}")
+
+        # 1) Embeddings del ROI canónico (reutiliza los precomputados si vienen)
+        if embeddings is not None:
+            if token_hw is None:
+                raise ValueError("token_hw es obligatorio cuando se pasan embeddings precomputados")
+            emb, (Ht, Wt) = embeddings, (int(token_hw[0]), int(token_hw[1]))
+        elif getattr(self.extractor, "uses_shape", False):
+            emb, (Ht, Wt) = self.extractor.extract(img_bgr, shape)
+        else:
+            emb, (Ht, Wt) = self.extractor.extract(img_bgr)
 
         # Validación de grid si se solicita
         if token_shape_expected is not None:
@@ -71,70 +292,92 @@ class InferenceEngine:
             if got != exp:
                 raise ValueError(f"Token grid mismatch: got {got}, expected {exp}")
 
-        # 2) Distancias kNN por parche (min-dist al coreset)
-        d = self.memory.knn_min_dist(emb)  # (N,)
+        # 2) Tokens que solapan la forma del ROI (rect/circle/annulus) y mapa de trabajo del
+        #    posproceso: (h, w) = ROI escalado por work_scale, con su máscara
+        H, W = img_bgr.shape[:2]
+        polar = roi_polar_geometry(self.extractor, (H, W), shape, (Ht, Wt))
+        geometry = (
+            letterbox_geometry(self.extractor, (H, W), (Ht, Wt))
+            if polar is None and heatmap_mapping == "content" else None
+        )
+        keep = roi_token_mask(self.extractor, (H, W), shape, (Ht, Wt)) if mask_tokens else None
+        k = work_scale(post_resolution, (H, W), (Ht, Wt), polar)
+        h, w = (H, W) if k >= 1.0 else (max(1, int(round(H * k))), max(1, int(round(W * k))))
+        kx, ky = w / W, h / H
+        at_roi = (h, w) == (H, W)
+        mask = build_mask(h, w, shape if at_roi else scale_shape(shape, kx, ky))
+        mask_bool = mask > 0
+
+        # 3) Distancias kNN por parche (min-dist al coreset), sólo de los tokens conservados
+        if distances is not None:
+            d = np.asarray(distances, dtype=np.float32)  # (N,)
+        elif keep is not None:
+            d = np.zeros(Ht * Wt, dtype=np.float32)
+            d[keep] = self.memory.knn_min_dist(np.asarray(emb)[keep])
+        else:
+            d = self.memory.knn_min_dist(emb)
         heat = d.reshape(Ht, Wt).astype(np.float32)
+        if keep is not None:
+            heat = _fill_excluded(heat, keep)
+        clock = Laps()
 
-        # 3) Reescalar a tamaño del ROI (para overlay)
-        H, W = img_bgr.shape[:2]
-        heat_up = cv2.resize(heat, (W, H), interpolation=cv2.INTER_LINEAR).astype(np.float32)
+        # 4) Tokens -> mapa de trabajo: sólo la zona del lienzo con contenido, o la tira polar de
+        #    vuelta a cartesianas
+        if polar is not None:
+            heat_up = strip_to_roi(heat, polar if at_roi else polar.scaled(kx, ky), (h, w))
+        else:
+            heat_up = tokens_to_roi(heat, (h, w), geometry)
 
-        # 4) Suavizado opcional
-        if blur_sigma and blur_sigma > 0:
-            ksize = int(max(3, round(blur_sigma * 3) * 2 + 1))
-            heat_proc = cv2.GaussianBlur(heat_up, (ksize, ksize), blur_sigma)
+        # 5) Suavizado opcional (blur_sigma en píxeles del ROI)
+        sigma = float(blur_sigma or 0.0) * (kx + ky) / 2.0
+        if sigma > 0:
+            ksize = int(max(3, round(sigma * 3) * 2 + 1))
+            heat_proc = cv2.GaussianBlur(heat_up, (ksize, ksize), sigma)
         else:
             heat_proc = heat_up
+        clock.lap("upsample")
 
-        # 5) Máscara del ROI (rect/circle/annulus) si viene descrita
-        mask = build_mask(H, W, shape)
-        mask_bool = mask > 0
-
-        # 6) Score global sobre el heatmap suavizado y enmascarado
+        # 6) Score global y rango de la visualización (p1/p99) con un único partition
         p_use = int(score_percentile) if score_percentile is not None else self.score_p
         valid = heat_proc[mask_bool]
-        sc = percentile(valid, p_use) if valid.size else 0.0
-
-        # 7) Generar heatmap 0..255 para visualización
-        heat_vis = np.zeros_like(heat_proc, dtype=np.float32)
-        if valid.size:
-            mn, mx = np.percentile(valid, [1, 99])
-            if mx > mn:
-                heat_vis[mask_bool] = np.clip((heat_proc[mask_bool] - mn) / (mx - mn), 0.0, 1.0)
+        sc, mn, mx = percentiles(valid, (p_use, 1, 99), overwrite=True) if valid.size else (0.0, 0.0, 0.0)
+        clock.lap("score")
+
+        # 7) Generar heatmap 0..255 para visualización (solo lo que se vaya a devolver); el mapa
+        #    completo es el único paso al tamaño del ROI
+        thr_value = float(threshold) if threshold is not None else None
+        want_full = mode == "full" or (mode == "on_fail" and thr_value is not None and sc >= thr_value)
+        heat_u8_masked = None
+        heat_tokens_u8 = None
+        if want_full or mode == "tokens":
+            scale = 1.0 / (mx - mn) if mx > mn else 0.0
+            if want_full:
+                heat_vis = np.clip((heat_proc - mn) * scale, 0.0, 1.0)
+                full_mask = mask
+                if not at_roi:
+                    heat_vis = cv2.resize(heat_vis, (W, H), interpolation=cv2.INTER_LINEAR)
+                    full_mask = build_mask(H, W, shape)
+                heat_u8 = (heat_vis * 255.0 + 0.5).astype(np.uint8)
+                heat_u8_masked = cv2.bitwise_and(heat_u8, heat_u8, mask=full_mask)
             else:
-                heat_vis[mask_bool] = 0.0
-        heat_u8 = (heat_vis * 255.0 + 0.5).astype(np.uint8)
-        heat_u8_masked = cv2.bitwise_and(heat_u8, heat_u8, mask=mask)
+                # Misma normalización que el heatmap completo, pero sobre el grid de tokens
+                heat_tokens_u8 = (np.clip((heat - mn) * scale, 0.0, 1.0) * 255.0 + 0.5).astype(np.uint8)
 
-        # 8) Umbral + eliminación de islas pequeñas + contornos
+        clock.lap("heatmap")
+
+        # 8) Umbral + eliminación de islas < área mínima (mm² -> px² del ROI) + contornos
         regions: List[Dict[str, Any]] = []
-        thr_value = float(threshold) if threshold is not None else None
         if thr_value is not None:
-            bin_img = np.zeros((H, W), dtype=np.uint8)
-            bin_img[mask_bool & (heat_proc >= thr_value)] = 255
-            # Elimina regiones con área < área mínima (en mm² → px²)
-            px_thr = mm2_to_px2(area_mm2_thr, self.mm_per_px)
-            cnts, _ = cv2.findContours(bin_img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            for c in cnts:
-                area_px = cv2.contourArea(c)
-                if area_px < px_thr:
-                    cv2.drawContours(bin_img, [c], -1, 0, thickness=-1)
-            cnts, _ = cv2.findContours(bin_img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            for c in cnts:
-                x, y, w, h = cv2.boundingRect(c)
-                area_px = cv2.contourArea(c)
-                regions.append({
-                    "bbox": [int(x), int(y), int(w), int(h)],
-                    "area_px": float(area_px),
-                    "area_mm2": float(px2_to_mm2(area_px, self.mm_per_px)),
-                    "contour": contour_to_list(c),
-                })
-            regions.sort(key=lambda r: r["area_px"], reverse=True)
+            regions = _regions(
+                heat_proc, mask_bool, thr_value, mm2_to_px2(area_mm2_thr, self.mm_per_px), (H, W), self.mm_per_px
+            )
+        clock.lap("contours")
 
         return {
             "score": float(sc),
             "threshold": float(thr_value) if thr_value is not None else None,
             "heatmap_u8": heat_u8_masked,   # la API lo convertirá a PNG base64
+            "heatmap_tokens_u8": heat_tokens_u8,
             "regions": regions,
             "token_shape": [int(Ht), int(Wt)],
             "params": {
@@ -147,11 +390,49 @@ class InferenceEngine:
                 "score_percentile": int(p_use),
                 "blur_sigma": float(blur_sigma),
                 "mm_per_px": float(self.mm_per_px),
+                "tokens_queried": int(keep.sum()) if keep is not None else int(Ht * Wt),
+                "polar": polar is not None,
+                "post_resolution": str(post_resolution or "roi").lower(),
+                "heatmap_mapping": "content" if geometry is not None else "grid",
+                "work_hw": [int(h), int(w)],
             },
         }
 
+    def screen(self,
+               img_bgr: np.ndarray,
+               *,
+               shape: Optional[Dict[str, Any]] = None,
+               score_percentile: Optional[int] = None,
+               embeddings: Optional[np.ndarray] = None,
+               token_hw: Optional[Tuple[int, int]] = None,
+               mask_tokens: bool = True,
+               post_resolution: str = "tokens",
+               heatmap_mapping: str = "content") -> float:
+        """
+        Pasada barata de la cascada: sólo el score (sin heatmap, umbral ni regiones), con el
+        extractor y la memoria de baja resolución de este engine. Ver `cascade_decision`.
+        """
+        res = self.run(
+            img_bgr, shape=shape, score_percentile=score_percentile, embeddings=embeddings, token_hw=token_hw,
+            token_shape_expected=self.token_hw, heatmap="none", mask_tokens=mask_tokens,
+            post_resolution=post_resolution, heatmap_mapping=heatmap_mapping,
+        )
+        return float(res["score"])
+
+
+def cascade_decision(cascade_score: float, calib: Optional[Dict[str, Any]]) -> Optional[float]:
+    """
+    Aceptación temprana: si el score de la pasada barata queda por debajo de `cascade_accept`
+    (ajustado por /calibrate_ng, ver calib.choose_cascade_accept) devuelve el score estimado en la
+    escala de la pasada completa (ajuste lineal, < threshold); None si hace falta la pasada completa.
+    """
+    accept = calib.get("cascade_accept") if calib else None
+    if accept is None or not float(cascade_score) < float(accept):
+        return None
+    return float(calib.get("cascade_slope", 1.0)) * float(cascade_score) + float(calib.get("cascade_intercept", 0.0))
+
 
 def contour_to_list(contour: np.ndarray) -> List[List[int]]:
-    pts = contour.reshape(-1, 2)
-    return [[int(x), int(y)] for x, y in pts]
+    # tolist() convierte a int de Python en C, sin bucle por punto
+    return contour.reshape(-1, 2).tolist()
 
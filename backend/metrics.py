@@ -0,0 +1,258 @@
+from __future__ import annotations
+
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+# Tiempos por etapa del camino caliente (decode, preprocess, forward, knn, postprocess, ...).
+#
+# Cada petición instrumentada lleva un StageTimer en un ContextVar (lo fija MetricsMiddleware);
+# `stage("knn")` en features/patchcore/infer suma en él sin cambiar firmas y es un no-op fuera
+# de una petición. run_in_threadpool copia el contexto, así que también funciona en el threadpool;
+# el worker del scheduler no lo tiene y atribuye "queue"/"forward" explícitamente (timer_add).
+# `roi_scope(role_id, roi_id)` etiqueta las etapas de un ROI para los histogramas por ROI.
+
+DEFAULT_BUCKETS: Tuple[float, ...] = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+RoiKey = Optional[Tuple[str, str]]
+
+
+class StageTimer:
+    """Acumulador de segundos por (etapa, ROI) de una petición."""
+
+    def __init__(self) -> None:
+        self.entries: Dict[Tuple[str, RoiKey], float] = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float, roi: RoiKey = None) -> None:
+        key = (name, roi)
+        with self._lock:
+            self.entries[key] = self.entries.get(key, 0.0) + float(seconds)
+
+    def by_stage(self) -> Dict[str, float]:
+        out: Dict[str, float] = {}
+        with self._lock:
+            for (name, _), secs in self.entries.items():
+                out[name] = out.get(name, 0.0) + secs
+        return out
+
+    def server_timing(self, total: Optional[float] = None) -> str:
+        parts = [f"{name};dur={secs * 1000.0:.2f}" for name, secs in self.by_stage().items()]
+        if total is not None:
+            parts.append(f"total;dur={total * 1000.0:.2f}")
+        return ", ".join(parts)
+
+
+_current_timer: ContextVar[Optional[StageTimer]] = ContextVar("bdi_stage_timer", default=None)
+_current_roi: ContextVar[RoiKey] = ContextVar("bdi_stage_roi", default=None)
+
+
+def current_timer() -> Optional[StageTimer]:
+    return _current_timer.get()
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    timer = _current_timer.get()
+    if timer is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(name, time.perf_counter() - t0, _current_roi.get())
+
+
+@contextmanager
+def roi_scope(role_id: str, roi_id: str) -> Iterator[None]:
+    token = _current_roi.set((str(role_id), str(roi_id)))
+    try:
+        yield
+    finally:
+        _current_roi.reset(token)
+
+
+class Laps:
+    """Cronómetro por vueltas para secuencias de etapas: `lap("blur")` suma lo transcurrido desde la anterior."""
+
+    __slots__ = ("timer", "roi", "t")
+
+    def __init__(self) -> None:
+        self.timer = _current_timer.get()
+        self.roi = _current_roi.get()
+        self.t = time.perf_counter()
+
+    def lap(self, name: str) -> None:
+        if self.timer is None:
+            return
+        now = time.perf_counter()
+        self.timer.add(name, now - self.t, self.roi)
+        self.t = now
+
+
+def timer_add(timer: Optional[StageTimer], name: str, seconds: float) -> None:
+    if timer is not None:
+        timer.add(name, seconds)
+
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # último = +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class MetricsRegistry:
+    """
+    Histogramas en proceso, exportados en formato texto de Prometheus:
+      - bdi_request_seconds{endpoint}
+      - bdi_requests_total{endpoint,code}
+      - bdi_stage_seconds{endpoint,stage}
+      - bdi_roi_stage_seconds{role_id,roi_id,stage}
+    """
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._request: Dict[Tuple[str, ...], Histogram] = {}
+        self._stage: Dict[Tuple[str, ...], Histogram] = {}
+        self._roi_stage: Dict[Tuple[str, ...], Histogram] = {}
+        self._requests_total: Dict[Tuple[str, ...], int] = {}
+
+    def _hist(self, family: Dict[Tuple[str, ...], Histogram], key: Tuple[str, ...]) -> Histogram:
+        h = family.get(key)
+        if h is None:
+            h = family[key] = Histogram(self.buckets)
+        return h
+
+    def observe_request(self, endpoint: str, timer: StageTimer, total: float, status: int) -> None:
+        roi_totals: Dict[Tuple[str, str, str], float] = {}
+        with timer._lock:
+            for (name, roi), secs in timer.entries.items():
+                if roi is not None:
+                    key = (roi[0], roi[1], name)
+                    roi_totals[key] = roi_totals.get(key, 0.0) + secs
+        stages = timer.by_stage()
+        with self._lock:
+            self._hist(self._request, (endpoint,)).observe(total)
+            code = (endpoint, str(int(status)))
+            self._requests_total[code] = self._requests_total.get(code, 0) + 1
+            for name, secs in stages.items():
+                self._hist(self._stage, (endpoint, name)).observe(secs)
+            for key, secs in roi_totals.items():
+                self._hist(self._roi_stage, key).observe(secs)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._request.clear()
+            self._stage.clear()
+            self._roi_stage.clear()
+            self._requests_total.clear()
+
+    def _render_histograms(
+        self, out: List[str], name: str, help_text: str, label_names: Sequence[str], family: Dict[Tuple[str, ...], Histogram]
+    ) -> None:
+        out.append(f"# HELP {name} {help_text}")
+        out.append(f"# TYPE {name} histogram")
+        for key in sorted(family):
+            h = family[key]
+            cum = 0
+            for bound, c in zip(self.buckets, h.counts):
+                cum += c
+                le = 'le="%g"' % bound
+                out.append(f"{name}_bucket{_labels(label_names, key, le)} {cum}")
+            le = 'le="+Inf"'
+            out.append(f"{name}_bucket{_labels(label_names, key, le)} {h.count}")
+            out.append(f"{name}_sum{_labels(label_names, key)} {h.sum:.6f}")
+            out.append(f"{name}_count{_labels(label_names, key)} {h.count}")
+
+    def render(
+        self,
+        gauges: Optional[Iterable[Tuple[str, str, float]]] = None,
+        counters: Optional[Iterable[Tuple[str, str, float]]] = None,
+    ) -> str:
+        """
+        Texto Prometheus (version 0.0.4). `gauges` / `counters`: [(nombre, ayuda, valor), ...]
+        adicionales; los contadores (monótonos, nombre `*_total`) se declaran `counter`.
+        """
+        out: List[str] = []
+        with self._lock:
+            self._render_histograms(out, "bdi_request_seconds", "Latencia total por endpoint.", ("endpoint",), self._request)
+            out.append("# HELP bdi_requests_total Peticiones por endpoint y código HTTP.")
+            out.append("# TYPE bdi_requests_total counter")
+            for key in sorted(self._requests_total):
+                out.append(f"bdi_requests_total{_labels(('endpoint', 'code'), key)} {self._requests_total[key]}")
+            self._render_histograms(
+                out, "bdi_stage_seconds", "Tiempo por etapa y endpoint (suma por petición).", ("endpoint", "stage"), self._stage
+            )
+            self._render_histograms(
+                out, "bdi_roi_stage_seconds", "Tiempo por etapa y ROI.", ("role_id", "roi_id", "stage"), self._roi_stage
+            )
+        for kind, values in (("counter", counters), ("gauge", gauges)):
+            for name, help_text, value in values or ():
+                out.append(f"# HELP {name} {help_text}")
+                out.append(f"# TYPE {name} {kind}")
+                out.append(f"{name} {float(value):g}")
+        return "\n".join(out) + "\n"
+
+
+class MetricsMiddleware:
+    """
+    Middleware ASGI: crea el StageTimer de cada petición a `paths`, registra la latencia total y
+    las etapas en `registry` y, con `server_timing`, añade la cabecera `Server-Timing`.
+    """
+
+    def __init__(self, app: Any, registry: MetricsRegistry, paths: Iterable[str], server_timing: bool = False):
+        self.app = app
+        self.registry = registry
+        self.paths = frozenset(paths)
+        self.server_timing = bool(server_timing)
+
+    async def __call__(self, scope, receive, send):
+        if scope.get("type") != "http" or scope.get("path") not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        timer = StageTimer()
+        token = _current_timer.set(timer)
+        t0 = time.perf_counter()
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = int(message.get("status", 500))
+                if self.server_timing:
+                    header = timer.server_timing(time.perf_counter() - t0).encode("latin-1")
+                    message = {**message, "headers": [*message.get("headers", []), (b"server-timing", header)]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current_timer.reset(token)
+            self.registry.observe_request(scope["path"], timer, time.perf_counter() - t0, status[0])
@@ -0,0 +1,251 @@
+"""
+Backend ONNX Runtime del extractor DINOv2.
+
+Exportación (una vez; congela input_size con el pos_embed ya redimensionado y devuelve las
+capas intermedias out_indices concatenadas, (B, Ht*Wt, C*len(out_indices))):
+
+    python -m backend.onnx_features --out models/onnx/dinov2_vits14_448.onnx --input-size 448
+
+Junto al .onnx se escribe `<nombre>.json` con los metadatos del extractor; tras exportar se
+comprueba la paridad con la ruta eager (sale con código 1 si no se cumple).
+
+`OnnxDinoV2Features` es intercambiable con `DinoV2Features` (preprocess / forward_preprocessed /
+extract / extract_batch / get_metadata): mismo letterbox y normalización, forward con
+onnxruntime en CPU. Se elige con `extractor.backend: onnx` en configs/app.yaml.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import sys
+import time
+import warnings
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+try:
+    from .features import DinoV2Features
+    from .metrics import stage
+except ImportError:  # ejecutado como script
+    sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+    from backend.features import DinoV2Features  # type: ignore[no-redef]
+    from backend.metrics import stage  # type: ignore[no-redef]
+
+log = logging.getLogger(__name__)
+
+ONNX_INPUT = "pixel_values"
+ONNX_OUTPUT = "tokens"
+
+
+def metadata_path(onnx_path: str | Path) -> Path:
+    return Path(onnx_path).with_suffix(".json")
+
+
+class _FrozenIntermediateLayers(nn.Module):
+    """Grafo exportable: `_intermediate_layers_cached` al grid fijo, capas concatenadas."""
+
+    def __init__(self, extractor: DinoV2Features):
+        super().__init__()
+        self.extractor = extractor
+        self.model = extractor.model  # registra los pesos como submódulo
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        layers = self.extractor._intermediate_layers_cached(x, self.extractor.out_indices)
+        return torch.cat(layers, dim=-1)
+
+
+def export_onnx(extractor: DinoV2Features, path: str | Path, opset: int = 17) -> Dict[str, Any]:
+    """
+    Exporta `extractor` (fp32, input_size fijo) a ONNX con batch dinámico y escribe los
+    metadatos junto al fichero. Devuelve los metadatos.
+    """
+    if extractor.dynamic_input:
+        raise ValueError("La exportación ONNX requiere dynamic_input=False (input_size fijo)")
+    if extractor.precision != "fp32" or extractor.half:
+        raise ValueError("Exporta desde un extractor fp32")
+    if not extractor._supports_cached_forward() or not extractor.out_indices:
+        raise ValueError("El modelo no admite el forward de capas intermedias con pos_embed cacheado")
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    size = int(extractor.input_size)
+    hw = (size // extractor.patch, size // extractor.patch)
+    extractor._resized_pos_embed(*hw)  # constante del grafo
+
+    module = _FrozenIntermediateLayers(extractor).eval()
+    dummy = torch.zeros((1, 3, size, size), dtype=torch.float32, device=extractor.device)
+    with torch.inference_mode(False), torch.no_grad(), warnings.catch_warnings():
+        # El grid de tokens es constante en el grafo a propósito (input_size fijo)
+        warnings.simplefilter("ignore", torch.jit.TracerWarning)
+        warnings.simplefilter("ignore", DeprecationWarning)
+        torch.onnx.export(
+            module,
+            (dummy,),
+            str(path),
+            input_names=[ONNX_INPUT],
+            output_names=[ONNX_OUTPUT],
+            dynamic_axes={ONNX_INPUT: {0: "batch"}, ONNX_OUTPUT: {0: "batch"}},
+            opset_version=int(opset),
+            do_constant_folding=True,
+            dynamo=False,
+        )
+
+    meta = {**extractor.get_metadata(), "token_hw": [int(hw[0]), int(hw[1])], "opset": int(opset), "backend": "onnx"}
+    metadata_path(path).write_text(json.dumps(meta, indent=2), encoding="utf-8")
+    return meta
+
+
+class OnnxDinoV2Features(DinoV2Features):
+    """
+    Extractor compatible con DinoV2Features que ejecuta el grafo exportado con onnxruntime
+    (CPUExecutionProvider). Sólo input_size fijo: el del grafo.
+    """
+
+    def __init__(
+        self,
+        onnx_path: str,
+        input_size: Optional[int] = None,
+        preprocess: str = "pil",
+        intra_op_threads: int = 0,      # 0 = valor por defecto de onnxruntime
+        inter_op_threads: int = 1,
+        optimization: str = "all",      # "disable" | "basic" | "extended" | "all"
+        **_,
+    ) -> None:
+        import onnxruntime as ort  # type: ignore
+
+        self.onnx_path = str(onnx_path)
+        meta_file = metadata_path(self.onnx_path)
+        if not meta_file.exists():
+            raise FileNotFoundError(f"Faltan los metadatos del grafo ONNX: {meta_file}")
+        meta = json.loads(meta_file.read_text(encoding="utf-8"))
+        if input_size is not None and int(input_size) != int(meta["input_size"]):
+            raise ValueError(
+                f"El grafo ONNX se exportó con input_size={meta['input_size']}, no {input_size}: reexporta"
+            )
+
+        self.model_name = str(meta["model_name"])
+        self.input_size = int(meta["input_size"])
+        self.patch = int(meta["patch_size"])
+        self.out_indices = list(meta.get("out_indices") or [])
+        self.dynamic_input = False
+        self.device = torch.device("cpu")
+        self.half = False
+        self.precision = "fp32"
+        self.token_pruning = False  # grafo con grid fijo: sin poda de parches
+        self.polar_unwrap = False   # ni tira polar
+        self.polar_scale = 1.0
+        self.imagenet_norm = bool(meta.get("imagenet_norm", True))
+        self.pool = str(meta.get("pool", "none"))
+        self.weights = None
+        self.model = None  # sin módulo torch (prepare_for_fork lo ignora)
+        self._pos_embed_base = None
+        self._pos_cache = {}
+        self._init_preprocess(preprocess)
+
+        levels = {
+            "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+            "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+            "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+            "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+        }
+        if optimization not in levels:
+            raise ValueError(f"optimization debe ser uno de {list(levels)}")
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = levels[optimization]
+        opts.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        opts.intra_op_num_threads = max(0, int(intra_op_threads))
+        opts.inter_op_num_threads = max(0, int(inter_op_threads))
+        self.session = ort.InferenceSession(self.onnx_path, sess_options=opts, providers=["CPUExecutionProvider"])
+
+    @torch.inference_mode()
+    def forward_preprocessed(self, x) -> List[Tuple[np.ndarray, Tuple[int, int]]]:
+        with stage("forward"):
+            if isinstance(x, (list, tuple)):
+                x = torch.cat(list(x), dim=0)
+            x, _ = self._resize_input(x)
+            hw = (int(x.shape[-2] // self.patch), int(x.shape[-1] // self.patch))
+            arr = np.ascontiguousarray(x.float().cpu().numpy())
+            tokens = self.session.run([ONNX_OUTPUT], {ONNX_INPUT: arr})[0]  # (B, N, C)
+            if self.pool == "mean":
+                tokens = tokens.mean(axis=1, keepdims=True)
+            tokens = tokens.astype(np.float32, copy=False)
+            return [(tokens[j], hw) for j in range(tokens.shape[0])]
+
+    def save_weights(self, path: str) -> None:
+        raise RuntimeError("El backend ONNX no tiene pesos torch: exporta desde DinoV2Features")
+
+    def get_metadata(self) -> dict:
+        return {**super().get_metadata(), "backend": "onnx"}
+
+
+def check_parity(
+    reference: DinoV2Features, onnx_extractor: DinoV2Features, images: Sequence[np.ndarray]
+) -> Dict[str, Any]:
+    """
+    Diferencias de embeddings eager vs ONNX sobre `images` (max/mean abs y coseno mínimo por
+    token) y mediana del tiempo de `extract` de cada uno.
+    """
+    max_abs, mean_abs, cos_min = 0.0, [], 1.0
+    torch_s, onnx_s = [], []
+    for img in images:
+        t0 = time.perf_counter()
+        ref, hw_ref = reference.extract(img)
+        t1 = time.perf_counter()
+        out, hw = onnx_extractor.extract(img)
+        onnx_s.append(time.perf_counter() - t1)
+        torch_s.append(t1 - t0)
+        if tuple(hw) != tuple(hw_ref) or out.shape != ref.shape:
+            raise ValueError(f"Forma distinta: {out.shape}/{hw} vs {ref.shape}/{hw_ref}")
+        diff = np.abs(out - ref)
+        max_abs = max(max_abs, float(diff.max()))
+        mean_abs.append(float(diff.mean()))
+        cos = (out * ref).sum(1) / (np.linalg.norm(out, axis=1) * np.linalg.norm(ref, axis=1) + 1e-12)
+        cos_min = min(cos_min, float(cos.min()))
+    return {
+        "n_images": len(images),
+        "max_abs": max_abs,
+        "mean_abs": float(np.mean(mean_abs)),
+        "cos_min": cos_min,
+        "torch_ms": float(np.median(torch_s) * 1000.0),
+        "onnx_ms": float(np.median(onnx_s) * 1000.0),
+    }
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description="Exporta el extractor DINOv2 a ONNX y valida la paridad con PyTorch")
+    ap.add_argument("--out", type=Path, required=True)
+    ap.add_argument("--input-size", type=int, default=448)
+    ap.add_argument("--model-name", default="vit_small_patch14_dinov2.lvd142m")
+    ap.add_argument("--weights", default=None, help="pesos locales (.safetensors/.pt)")
+    ap.add_argument("--random-weights", action="store_true", help="pesos aleatorios (sin descarga; sólo pruebas)")
+    ap.add_argument("--opset", type=int, default=17)
+    ap.add_argument("--tolerance", type=float, default=1e-3, help="máx. |diff| admitido en la validación")
+    ap.add_argument("--no-check", action="store_true", help="no validar con onnxruntime tras exportar")
+    args = ap.parse_args(argv)
+
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO)
+
+    ref = DinoV2Features(
+        model_name=args.model_name, device="cpu", input_size=args.input_size, patch_size=14,
+        weights=args.weights, pretrained=not args.random_weights,
+    )
+    export_onnx(ref, args.out, opset=args.opset)
+    log.info("Grafo ONNX escrito en %s (+ %s)", args.out, metadata_path(args.out).name)
+    if args.no_check:
+        return 0
+
+    rng = np.random.default_rng(0)
+    images = [rng.integers(0, 256, size=(h, w, 3), dtype=np.uint8) for h, w in ((480, 640), (300, 300), (640, 200))]
+    report = check_parity(ref, OnnxDinoV2Features(str(args.out), input_size=args.input_size), images)
+    log.info("Paridad eager vs ONNX: %s", report)
+    return 0 if report["max_abs"] <= args.tolerance else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,7 @@
 from __future__ import annotations
+import time
+from typing import Any, Dict, Optional, Tuple
+
 import numpy as np
 
 try:
@@ -9,57 +12,488 @@ except Exception:
 
 from sklearn.neighbors import NearestNeighbors
 
+from .metrics import stage
+
 def l2_normalize(x: np.ndarray, eps: float = 1e-8) -> np.ndarray:
     n = np.linalg.norm(x, axis=1, keepdims=True) + eps
     return x / n
 
+def _kcenter_greedy_core(
+    E: np.ndarray,
+    m: int,
+    seed: int = 0,
+    chunk_size: int = 16384,
+    init_dist: Optional[np.ndarray] = None,
+) -> Tuple[np.ndarray, float]:
+    """
+    k-center greedy con actualización de distancias por bloques y en sitio:
+    ||e - c||² = ||e||² + ||c||² - 2·e·c  (GEMV de BLAS multihilo, sin temporales N×D).
+    `init_dist` (N,): distancias de cada candidato a centros ya existentes (modo incremental);
+    la selección arranca por el candidato peor cubierto en vez de uno aleatorio.
+    Devuelve (índices, radio de cobertura = max_i min_c ||e_i - c||).
+    """
+    rng = np.random.default_rng(seed)
+    n = E.shape[0]
+    if m >= n:
+        return np.arange(n, dtype=np.int64), 0.0
+
+    E = np.ascontiguousarray(E, dtype=np.float32)
+    sqn = np.einsum("ij,ij->i", E, E)                  # (N,) normas²
+    if init_dist is not None:
+        d = np.square(np.asarray(init_dist, dtype=np.float32).reshape(n))  # min-dist² a los centros
+    else:
+        d = np.full(n, np.inf, dtype=np.float32)       # min-dist² al conjunto de centros
+    chunk = max(1, min(int(chunk_size), n))
+    buf = np.empty(chunk, dtype=np.float32)
+    centers = np.empty(m, dtype=np.int64)
+
+    c = int(np.argmax(d)) if init_dist is not None else int(rng.integers(0, n))
+    for j in range(m):
+        centers[j] = c
+        ec = E[c]
+        sq_c = sqn[c]
+        for s in range(0, n, chunk):
+            e = min(s + chunk, n)
+            b = buf[: e - s]
+            np.dot(E[s:e], ec, out=b)
+            b *= -2.0
+            b += sqn[s:e]
+            b += sq_c
+            np.minimum(d[s:e], b, out=d[s:e])
+        c = int(np.argmax(d))
+
+    radius = float(np.sqrt(max(float(d.max()), 0.0)))
+    return centers, radius
+
+
 def kcenter_greedy(E: np.ndarray, m: int, seed: int = 0) -> np.ndarray:
     """Coreset k-center greedy sobre embeddings ya normalizados."""
+    idx, _ = _kcenter_greedy_core(E, m, seed=seed)
+    return idx
+
+
+def approx_kcenter_greedy(
+    E: np.ndarray,
+    m: int,
+    seed: int = 0,
+    proj_dim: int = 128,
+    chunk_size: int = 16384,
+    init_dist: Optional[np.ndarray] = None,
+) -> Tuple[np.ndarray, float]:
+    """
+    k-center greedy aproximado (como en PatchCore): las distancias se calculan sobre una
+    proyección aleatoria gaussiana (Johnson–Lindenstrauss) a `proj_dim` dimensiones.
+    Devuelve (índices, radio de cobertura en el espacio proyectado).
+    """
+    n, dim = E.shape
+    if m >= n:
+        return np.arange(n, dtype=np.int64), 0.0
+    if proj_dim <= 0 or proj_dim >= dim:
+        return _kcenter_greedy_core(E, m, seed=seed, chunk_size=chunk_size, init_dist=init_dist)
+
     rng = np.random.default_rng(seed)
+    R = rng.standard_normal((dim, int(proj_dim)), dtype=np.float32)
+    R /= np.sqrt(np.float32(proj_dim))
+    P = E.astype(np.float32, copy=False) @ R          # (N, proj_dim), GEMM multihilo
+    return _kcenter_greedy_core(P, m, seed=seed, chunk_size=chunk_size, init_dist=init_dist)
+
+
+# ---------------- proyección de embeddings ----------------
+PROJECTIONS = ("none", "pca", "random")
+
+
+class Projection:
+    """
+    Proyección lineal de los embeddings (ya L2-normalizados) a `dim` dimensiones: y = (x - mean) @ W.
+    Se ajusta por ROI en /fit_ok, se guarda con la memoria y se aplica a los tokens de consulta
+    en `PatchCoreMemory.knn_min_dist`. Ambas variantes conservan (aprox.) las distancias L2.
+    """
+
+    def __init__(self, method: str, matrix: np.ndarray, mean: Optional[np.ndarray] = None):
+        self.method = method
+        self.matrix = np.ascontiguousarray(matrix, dtype=np.float32)  # (D, dim)
+        self.mean = None if mean is None else np.asarray(mean, dtype=np.float32).reshape(-1)
+        # (x - mean) @ W == x @ W - mean @ W: una única GEMM por consulta
+        self._bias = None if self.mean is None else (self.mean @ self.matrix).astype(np.float32)
+
+    @property
+    def in_dim(self) -> int:
+        return int(self.matrix.shape[0])
+
+    @property
+    def dim(self) -> int:
+        return int(self.matrix.shape[1])
+
+    def apply(self, X: np.ndarray) -> np.ndarray:
+        Y = np.asarray(X, dtype=np.float32) @ self.matrix
+        if self._bias is not None:
+            Y -= self._bias
+        return np.ascontiguousarray(Y)
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        out = {"matrix": self.matrix}
+        if self.mean is not None:
+            out["mean"] = self.mean
+        return out
+
+    @staticmethod
+    def fit(
+        E: np.ndarray, method: str = "pca", dim: int = 128, seed: int = 0, max_fit_rows: int = 50000
+    ) -> Tuple["Projection", Dict[str, Any]]:
+        """
+        pca: componentes principales (covarianza D×D sobre hasta `max_fit_rows` filas).
+        random: proyección aleatoria dispersa (densidad 1/sqrt(D), entradas ±sqrt(sqrt(D)/dim)).
+        Devuelve (proyección, stats) con la varianza retenida.
+        """
+        method = (method or "pca").lower()
+        if method not in ("pca", "random"):
+            raise ValueError("projection debe ser 'pca' o 'random'")
+        n, D = E.shape
+        dim = int(dim)
+        if not 0 < dim < D:
+            raise ValueError(f"projection_dim debe estar en [1, {D - 1}]")
+        rng = np.random.default_rng(seed)
+        X = E if n <= max_fit_rows else E[rng.choice(n, size=int(max_fit_rows), replace=False)]
+        X = np.asarray(X, dtype=np.float32)
+        mean = X.mean(axis=0)
+        Xc = X - mean
+        total_var = float(np.einsum("ij,ij->", Xc, Xc)) / max(X.shape[0], 1)
+
+        t0 = time.perf_counter()
+        if method == "pca":
+            cov = (Xc.T @ Xc).astype(np.float64) / max(X.shape[0], 1)
+            evals, evecs = np.linalg.eigh(cov)          # ascendente
+            order = np.argsort(evals)[::-1][:dim]
+            proj = Projection("pca", evecs[:, order].astype(np.float32), mean)
+            retained = float(np.maximum(evals[order], 0.0).sum() / max(float(evals.sum()), 1e-12))
+        else:
+            density = 1.0 / np.sqrt(D)
+            mask = rng.random((D, dim)) < density
+            signs = np.where(rng.random((D, dim)) < 0.5, -1.0, 1.0)
+            W = (mask * signs / np.sqrt(density * dim)).astype(np.float32)
+            proj = Projection("random", W)
+            Y = Xc @ W
+            retained = float(np.einsum("ij,ij->", Y, Y)) / max(X.shape[0], 1) / max(total_var, 1e-12)
+        stats = {
+            "projection": proj.method,
+            "projection_dim": int(dim),
+            "projection_input_dim": int(D),
+            "projection_retained_variance": retained,
+            "projection_fit_ms": float((time.perf_counter() - t0) * 1000.0),
+        }
+        return proj, stats
+
+
+def _nn_min_dist(C: np.ndarray, Q: np.ndarray) -> np.ndarray:
+    """Distancia L2 exacta de cada fila de Q a su vecino más próximo en C."""
+    if _HAS_FAISS:
+        index = faiss.IndexFlatL2(C.shape[1])
+        index.add(np.ascontiguousarray(C, dtype=np.float32))
+        D, _ = index.search(np.ascontiguousarray(Q, dtype=np.float32), 1)
+        return np.sqrt(np.maximum(D[:, 0], 0.0))
+    nn = NearestNeighbors(n_neighbors=1, metric="euclidean").fit(C)
+    return nn.kneighbors(Q, n_neighbors=1, return_distance=True)[0][:, 0]
+
+
+def projection_quality(
+    E: np.ndarray,
+    P: np.ndarray,
+    centers: np.ndarray,
+    groups: Optional[np.ndarray] = None,
+    score_percentile: int = 99,
+    max_queries: int = 2000,
+    seed: int = 0,
+) -> Dict[str, Any]:
+    """
+    Compara la distancia kNN al coreset sin proyectar (E) y proyectada (P = proyección de E)
+    en hasta `max_queries` parches que no son centros: correlación y error relativo medio.
+    Con `groups` (imagen de cada fila) y >= 3 imágenes muestreadas, correlación del score por
+    imagen (percentil `score_percentile` de sus distancias), que es lo que decide OK/NG.
+    """
     n = E.shape[0]
-    if m >= n:
-        return np.arange(n, dtype=np.int64)
-    c0 = int(rng.integers(0, n))
-    centers = [c0]
-    d = np.linalg.norm(E - E[c0], axis=1)
-    for _ in range(1, m):
-        i = int(np.argmax(d))
-        centers.append(i)
-        di = np.linalg.norm(E - E[i], axis=1)
-        d = np.minimum(d, di)
-    return np.array(centers, dtype=np.int64)
+    candidates = np.setdiff1d(np.arange(n), centers, assume_unique=False)
+    if candidates.size < 2:
+        return {}
+    rng = np.random.default_rng(seed)
+    q = np.sort(rng.choice(candidates, size=min(candidates.size, int(max_queries)), replace=False))
+    d_full = _nn_min_dist(E[centers], E[q])
+    d_proj = _nn_min_dist(P[centers], P[q])
+    out: Dict[str, Any] = {
+        "projection_dist_pearson": float(np.corrcoef(d_full, d_proj)[0, 1]),
+        "projection_dist_rel_err": float(np.mean(np.abs(d_proj - d_full) / np.maximum(d_full, 1e-6))),
+    }
+    if groups is not None:
+        g = np.asarray(groups)[q]
+        ids = np.unique(g)
+        if ids.size >= 3:
+            s_full = [np.percentile(d_full[g == i], score_percentile) for i in ids]
+            s_proj = [np.percentile(d_proj[g == i], score_percentile) for i in ids]
+            out["projection_score_pearson"] = float(np.corrcoef(s_full, s_proj)[0, 1])
+    return out
+
+
+# ---------------- índices kNN (FAISS) ----------------
+INDEX_TYPES = ("flat", "ivf_flat", "hnsw", "ivf_pq", "sq8")
+
+
+def _default_nlist(n: int) -> int:
+    # ~4·sqrt(n) listas, con >= 39 puntos de entrenamiento por lista (recomendación FAISS)
+    return int(max(1, min(int(4 * np.sqrt(max(n, 1))), n // 39 if n >= 39 else 1)))
+
+
+def _default_pq_m(dim: int) -> int:
+    # mayor divisor de dim con subvectores de >= 8 dimensiones
+    for m in range(max(1, dim // 8), 0, -1):
+        if dim % m == 0:
+            return m
+    return 1
+
+
+def resolve_index_params(index_type: str, n: int, dim: int, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Completa los parámetros de entrenamiento/búsqueda del índice con valores por defecto."""
+    p = dict(params or {})
+    if index_type in ("ivf_flat", "ivf_pq"):
+        p["nlist"] = int(max(1, min(int(p.get("nlist") or _default_nlist(n)), n)))
+        p["nprobe"] = int(max(1, min(int(p.get("nprobe") or 8), p["nlist"])))
+    if index_type == "ivf_pq":
+        p["pq_m"] = int(p.get("pq_m") or _default_pq_m(dim))
+        if dim % p["pq_m"] != 0:
+            raise ValueError(f"pq_m={p['pq_m']} debe dividir la dimensión {dim}")
+        # con pocos vectores no hay datos para 256 centroides por subcuantizador
+        p["pq_nbits"] = int(p.get("pq_nbits") or max(1, min(8, int(np.log2(max(n, 2))) - 1)))
+    if index_type == "hnsw":
+        p["hnsw_m"] = int(p.get("hnsw_m") or 32)
+        p["ef_construction"] = int(p.get("ef_construction") or 80)
+        p["ef_search"] = int(p.get("ef_search") or 64)
+    return p
+
+
+def apply_search_params(index, params: Optional[Dict[str, Any]]) -> None:
+    """Fija nprobe/efSearch guardados (o sobrescritos) en un índice ya cargado."""
+    if index is None or not params or not _HAS_FAISS:
+        return
+    import faiss  # type: ignore
+    if "nprobe" in params:
+        try:
+            faiss.extract_index_ivf(index).nprobe = int(params["nprobe"])
+        except Exception:
+            pass
+    if "ef_search" in params and hasattr(index, "hnsw"):
+        index.hnsw.efSearch = int(params["ef_search"])
+
+
+def build_index(C: np.ndarray, index_type: str = "flat", params: Optional[Dict[str, Any]] = None):
+    """
+    Crea (y entrena si procede) un índice FAISS L2 sobre el coreset C:
+      flat | ivf_flat | hnsw | ivf_pq | sq8
+    Devuelve (index, params_resueltos). Sin FAISS devuelve (None, {}) -> sklearn.
+    """
+    index_type = (index_type or "flat").lower()
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"index_type debe ser uno de {INDEX_TYPES}")
+    if not _HAS_FAISS:
+        return None, {}
+    import faiss  # type: ignore
+
+    C = np.ascontiguousarray(C, dtype=np.float32)
+    n, dim = C.shape
+    p = resolve_index_params(index_type, n, dim, params)
+
+    if index_type == "flat":
+        index = faiss.IndexFlatL2(dim)
+    elif index_type == "ivf_flat":
+        index = faiss.IndexIVFFlat(faiss.IndexFlatL2(dim), dim, p["nlist"], faiss.METRIC_L2)
+    elif index_type == "ivf_pq":
+        index = faiss.IndexIVFPQ(faiss.IndexFlatL2(dim), dim, p["nlist"], p["pq_m"], p["pq_nbits"])
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, p["hnsw_m"])
+        index.hnsw.efConstruction = p["ef_construction"]
+    else:  # sq8
+        index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_L2)
+
+    if not index.is_trained:
+        index.train(C)
+    index.add(C)
+    apply_search_params(index, p)
+    return index, p
+
+
+def index_recall(index, C: np.ndarray, queries: np.ndarray) -> Dict[str, float]:
+    """
+    Compara el índice aproximado con la búsqueda exacta sobre C:
+    recall@1 (mismo vecino) y error relativo medio de la distancia mínima (lo que usa el score).
+    """
+    import faiss  # type: ignore
+
+    Q = np.ascontiguousarray(queries, dtype=np.float32)
+    exact = faiss.IndexFlatL2(C.shape[1])
+    exact.add(np.ascontiguousarray(C, dtype=np.float32))
+    d_ref, i_ref = exact.search(Q, 1)
+    d_apx, i_apx = index.search(Q, 1)
+    d_ref = np.sqrt(np.maximum(d_ref[:, 0], 0.0))
+    d_apx = np.sqrt(np.maximum(d_apx[:, 0], 0.0))
+    rel = np.abs(d_apx - d_ref) / np.maximum(d_ref, 1e-6)
+    return {
+        "index_recall_at_1": float(np.mean(i_apx[:, 0] == i_ref[:, 0])),
+        "index_dist_rel_err": float(np.mean(rel)),
+    }
+
 
 class PatchCoreMemory:
-    def __init__(self, embeddings: np.ndarray, index=None, coreset_rate: float | None = None):
+    def __init__(
+        self,
+        embeddings: np.ndarray,
+        index=None,
+        coreset_rate: float | None = None,
+        projection: Optional[Projection] = None,
+    ):
         self.emb = embeddings.astype(np.float32, copy=False)
         self.index = index
         self.nn = None
         self.coreset_rate = coreset_rate
+        self.projection = projection  # si existe, `emb` está en el espacio proyectado
+        self.build_stats: Dict[str, Any] = {}
         if index is None:
             self.nn = NearestNeighbors(n_neighbors=1, algorithm="auto", metric="euclidean")
             self.nn.fit(self.emb)
 
-    @staticmethod
-    def build(embeddings: np.ndarray, coreset_rate: float = 0.02, seed: int = 0) -> "PatchCoreMemory":
+    @property
+    def input_dim(self) -> int:
+        """Dimensión de los embeddings de consulta (antes de la proyección)."""
+        return self.projection.in_dim if self.projection is not None else int(self.emb.shape[1])
+
+    def _prepare(self, embeddings: np.ndarray) -> np.ndarray:
+        """L2 normalize (+ proyección) de embeddings del extractor al espacio de la memoria."""
         E = l2_normalize(embeddings.astype(np.float32, copy=False))
+        return self.projection.apply(E) if self.projection is not None else E
+
+    @staticmethod
+    def build(
+        embeddings: np.ndarray,
+        coreset_rate: float = 0.02,
+        seed: int = 0,
+        coreset_method: str = "exact",
+        proj_dim: int = 128,
+        index_type: str = "flat",
+        index_params: Optional[Dict[str, Any]] = None,
+        recall_queries: int = 2000,
+        projection: Optional[str] = None,
+        projection_dim: int = 128,
+        groups: Optional[np.ndarray] = None,
+        score_percentile: int = 99,
+    ) -> "PatchCoreMemory":
+        """
+        Construye la memoria: L2 normalize -> [proyección] -> coreset k-center -> índice kNN.
+        coreset_method: "exact" (dimensiones completas) | "approx" (proyección aleatoria a `proj_dim`).
+        index_type: flat | ivf_flat | hnsw | ivf_pq | sq8 (FAISS; sin FAISS -> sklearn exacto).
+        projection: none | pca | random (a `projection_dim`); coreset, índice y consultas
+        trabajan en el espacio reducido. `groups` (imagen de cada fila) permite medir la
+        correlación del score por imagen frente a la memoria sin proyectar.
+        Deja en `build_stats` el método, el tiempo de selección, el radio de cobertura, el
+        índice con sus parámetros, si es aproximado su recall frente a la búsqueda exacta
+        medido con hasta `recall_queries` embeddings de entrada y, con proyección, la varianza
+        retenida y la correlación de distancias/scores.
+        """
+        E_full = l2_normalize(embeddings.astype(np.float32, copy=False))
+        proj, proj_stats = None, {}
+        method_p = (projection or "none").lower()
+        if method_p not in PROJECTIONS:
+            raise ValueError(f"projection debe ser uno de {PROJECTIONS}")
+        if method_p != "none":
+            proj, proj_stats = Projection.fit(E_full, method_p, projection_dim, seed=seed)
+            E = proj.apply(E_full)
+        else:
+            E = E_full
         n = E.shape[0]
         m = max(1, int(np.ceil(n * coreset_rate)))
-        idx = kcenter_greedy(E, m, seed=seed)
-        C = E[idx]
-        if _HAS_FAISS:
-            import faiss  # type: ignore
-            index = faiss.IndexFlatL2(C.shape[1])
-            index.add(C)
-            return PatchCoreMemory(C, index=index, coreset_rate=coreset_rate)
+
+        method = (coreset_method or "exact").lower()
+        if method not in ("approx", "exact"):
+            raise ValueError("coreset_method debe ser 'approx' o 'exact'")
+        t0 = time.perf_counter()
+        if method == "approx":
+            idx, radius = approx_kcenter_greedy(E, m, seed=seed, proj_dim=proj_dim)
         else:
-            return PatchCoreMemory(C, index=None, coreset_rate=coreset_rate)
+            idx, radius = _kcenter_greedy_core(E, m, seed=seed)
+        selection_ms = (time.perf_counter() - t0) * 1000.0
 
-    def knn_min_dist(self, query: np.ndarray) -> np.ndarray:
-        Q = l2_normalize(query.astype(np.float32, copy=False))
+        C = np.ascontiguousarray(E[idx])
+        index, params = build_index(C, index_type=index_type, params=index_params)
+        mem = PatchCoreMemory(C, index=index, coreset_rate=coreset_rate, projection=proj)
+        mem.build_stats = {
+            "coreset_method": method,
+            "coreset_proj_dim": int(proj_dim) if method == "approx" else None,
+            "coreset_selection_ms": float(selection_ms),
+            "coverage_radius": float(radius),
+            "index_type": (index_type or "flat").lower() if index is not None else "sklearn",
+            "index_params": params,
+        }
+        if index is not None and mem.build_stats["index_type"] != "flat" and recall_queries > 0:
+            rng = np.random.default_rng(seed)
+            q_idx = rng.choice(n, size=min(n, int(recall_queries)), replace=False)
+            mem.build_stats.update(index_recall(index, C, E[q_idx]))
+        if proj is not None:
+            proj_stats.update(
+                projection_quality(E_full, E, idx, groups=groups, score_percentile=score_percentile,
+                                   max_queries=max(int(recall_queries), 1), seed=seed)
+            )
+            mem.build_stats.update(proj_stats)
+        return mem
+
+    def extend(
+        self,
+        embeddings: np.ndarray,
+        coreset_rate: float = 0.02,
+        seed: int = 0,
+        coreset_method: str = "exact",
+        proj_dim: int = 128,
+    ) -> Dict[str, Any]:
+        """
+        Añade a la memoria un coreset de `embeddings` nuevos (modo incremental):
+        sólo los candidatos nuevos se puntúan contra los centros existentes (kNN actual)
+        y el k-center greedy continúa desde esas distancias. El índice FAISS se amplía con
+        `index.add`; sin FAISS se reajusta NearestNeighbors. Con proyección se reutiliza la
+        guardada (no se reajusta). Devuelve las estadísticas.
+        """
+        E = self._prepare(embeddings)
+        n = E.shape[0]
+        m = max(1, int(np.ceil(n * coreset_rate)))
+
+        method = (coreset_method or "exact").lower()
+        if method not in ("approx", "exact"):
+            raise ValueError("coreset_method debe ser 'approx' o 'exact'")
+        t0 = time.perf_counter()
+        d0 = self._search(E)  # distancia de cada candidato a la memoria actual
+        if method == "approx":
+            idx, radius = approx_kcenter_greedy(E, m, seed=seed, proj_dim=proj_dim, init_dist=d0)
+        else:
+            idx, radius = _kcenter_greedy_core(E, m, seed=seed, init_dist=d0)
+        selection_ms = (time.perf_counter() - t0) * 1000.0
+
+        C = np.ascontiguousarray(E[idx])
+        self.emb = np.concatenate([self.emb, C], axis=0)
+        if self.index is not None:
+            self.index.add(C)
+        else:
+            self.nn = NearestNeighbors(n_neighbors=1, algorithm="auto", metric="euclidean")
+            self.nn.fit(self.emb)
+
+        self.build_stats = {
+            "coreset_method": method,
+            "coreset_proj_dim": int(proj_dim) if method == "approx" else None,
+            "coreset_selection_ms": float(selection_ms),
+            "coverage_radius": float(radius),
+            "coreset_added": int(C.shape[0]),
+        }
+        return self.build_stats
+
+    def _search(self, Q: np.ndarray) -> np.ndarray:
         if self.index is not None:
-            import faiss  # type: ignore
             D, I = self.index.search(Q, 1)
             return np.sqrt(np.maximum(D[:, 0], 0.0))
-        else:
-            d, i = self.nn.kneighbors(Q, n_neighbors=1, return_distance=True)
-            return d[:, 0]
+        d, i = self.nn.kneighbors(Q, n_neighbors=1, return_distance=True)
+        return d[:, 0]
+
+    def knn_min_dist(self, query: np.ndarray) -> np.ndarray:
+        with stage("knn"):
+            return self._search(self._prepare(query))
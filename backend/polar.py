@@ -0,0 +1,135 @@
+"""
+Desenrollado polar de ROIs en anillo (pista de fricción del disco).
+
+Con letterbox, el cuadrado que contiene el anillo se lleva entero al lienzo input_size x input_size:
+el cubo y las esquinas se llevan la mayoría de píxeles y tokens. `polar_geometry` deriva de la forma
+`annulus` (los mismos parámetros que `roi_mask.build_mask`) una tira rectangular (radio x ángulo)
+con la densidad de píxeles del letterbox y lados múltiplos del patch; `unwrap` la genera con
+cv2.warpPolar y `strip_to_roi` devuelve el mapa de tokens de la tira a coordenadas cartesianas
+del ROI (heatmap, score y contornos siguen en píxeles del ROI para la GUI).
+
+Tira: filas = radio (interior -> exterior), columnas = ángulo (0 en +x, sentido de las agujas del
+reloj en la imagen, como warpPolar). Se añaden `pad` píxeles de la propia tira a cada lado de la
+costura (0/2π) para que los tokens del borde vean su contexto real.
+"""
+from __future__ import annotations
+
+import math
+from dataclasses import dataclass, replace
+from functools import lru_cache
+from typing import Any, Dict, Optional, Tuple
+
+import cv2
+import numpy as np
+
+
+@dataclass(frozen=True)
+class PolarGeometry:
+    cx: float
+    cy: float
+    r_outer: float
+    r_inner: float     # radio de la primera fila de la tira (≈ r_inner de la forma)
+    radial: int        # columnas de radio de warpPolar para [0, r_outer) (se recortan las del cubo)
+    strip_h: int       # filas de la tira (radio), múltiplo del patch
+    strip_w: int       # columnas de la tira sin la costura (ángulo), múltiplo del patch
+    pad: int           # columnas repetidas a cada lado de la costura
+    patch: int
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        """(alto, ancho) en píxeles de la tira que entra al ViT."""
+        return self.strip_h, self.strip_w + 2 * self.pad
+
+    @property
+    def token_hw(self) -> Tuple[int, int]:
+        h, w = self.size
+        return h // self.patch, w // self.patch
+
+    def scaled(self, kx: float, ky: float) -> "PolarGeometry":
+        """Misma tira vista desde el ROI reescalado (kx, ky): sólo cambian centro y radios."""
+        k = (kx + ky) / 2.0
+        return replace(
+            self, cx=(self.cx + 0.5) * kx - 0.5, cy=(self.cy + 0.5) * ky - 0.5,  # centros de píxel
+            r_outer=self.r_outer * k, r_inner=self.r_inner * k,
+        )
+
+
+def polar_geometry(
+    img_hw: Tuple[int, int],
+    shape: Optional[Dict[str, Any]],
+    patch: int,
+    input_size: int,
+    scale: float = 1.0,
+    pad_tokens: int = 1,
+) -> Optional[PolarGeometry]:
+    """
+    Geometría de la tira para un ROI de img_hw con forma `annulus`; None para otras formas o
+    un anillo degenerado. La escala de píxeles es la del letterbox (input_size / lado mayor del
+    ROI) por `scale`: a scale=1 la tira tiene aprox. los mismos tokens que el anillo en el lienzo,
+    sin cubo ni esquinas; scale > 1 da más resolución radial/angular por el mismo coste por token.
+    """
+    if not shape or str(shape.get("kind", "rect")).lower() != "annulus":
+        return None
+    h, w = int(img_hw[0]), int(img_hw[1])
+    patch = int(patch)
+    cx = float(shape.get("cx", w / 2))
+    cy = float(shape.get("cy", h / 2))
+    r = float(shape.get("r", min(h, w) / 2))
+    r_in = max(0.0, float(shape.get("r_inner", 0)))
+    if patch <= 0 or r <= 0 or r_in >= r:
+        return None
+
+    s = float(scale) * float(input_size) / max(h, w)
+    strip_h = max(1, int(round((r - r_in) * s / patch))) * patch
+    strip_w = max(1, int(round(math.pi * (r + r_in) * s / patch))) * patch  # 2π · radio medio
+    # warpPolar muestrea [0, r) en `radial` columnas; las strip_h últimas son el anillo
+    radial = max(strip_h, int(round(strip_h * r / (r - r_in))))
+    return PolarGeometry(
+        cx=cx, cy=cy, r_outer=r, r_inner=r * (radial - strip_h) / radial,
+        radial=radial, strip_h=strip_h, strip_w=strip_w,
+        pad=min(max(0, int(pad_tokens)) * patch, strip_w), patch=patch,
+    )
+
+
+def unwrap(img: np.ndarray, geom: PolarGeometry) -> np.ndarray:
+    """Tira (strip_h, strip_w + 2·pad[, C]) del anillo con cv2.warpPolar (lineal, bilineal)."""
+    polar = cv2.warpPolar(
+        img, (geom.radial, geom.strip_w), (geom.cx, geom.cy), geom.r_outer,
+        cv2.INTER_LINEAR | cv2.WARP_POLAR_LINEAR | cv2.WARP_FILL_OUTLIERS,
+    )  # filas = ángulo, columnas = radio
+    strip = np.swapaxes(polar[:, geom.radial - geom.strip_h:], 0, 1)
+    if geom.pad:
+        strip = np.concatenate([strip[:, -geom.pad:], strip, strip[:, :geom.pad]], axis=1)
+    return np.ascontiguousarray(strip)
+
+
+@lru_cache(maxsize=32)
+def _roi_maps(geom: PolarGeometry, H: int, W: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Coordenadas de token (x, y) de cada píxel del ROI para cv2.remap; los ROIs se repiten."""
+    ys, xs = np.mgrid[0:H, 0:W].astype(np.float32)
+    dx, dy = xs - np.float32(geom.cx), ys - np.float32(geom.cy)
+    rho = np.sqrt(dx * dx + dy * dy)
+    theta = np.arctan2(dy, dx)
+    theta[theta < 0] += np.float32(2 * np.pi)
+    # píxel de la tira (centros, como warpPolar) -> coordenada de token (centros)
+    row = rho * np.float32(geom.radial / geom.r_outer) - np.float32(geom.radial - geom.strip_h)
+    col = theta * np.float32(geom.strip_w / (2 * np.pi)) + np.float32(geom.pad)
+    p = np.float32(geom.patch)
+    map_x = (col + 0.5) / p - 0.5
+    map_y = (row + 0.5) / p - 0.5
+    map_x.flags.writeable = False
+    map_y.flags.writeable = False
+    return map_x, map_y
+
+
+def strip_to_roi(heat: np.ndarray, geom: PolarGeometry, img_hw: Tuple[int, int]) -> np.ndarray:
+    """
+    Mapa de tokens de la tira (Ht, Wt) -> ROI (H, W) en cartesianas (bilineal). Fuera del anillo
+    se replica el borde de la tira: la máscara del ROI lo descarta después.
+    """
+    H, W = int(img_hw[0]), int(img_hw[1])
+    map_x, map_y = _roi_maps(geom, H, W)
+    return cv2.remap(
+        np.ascontiguousarray(heat, dtype=np.float32), map_x, map_y,
+        interpolation=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE,
+    )
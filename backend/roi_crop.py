@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+import cv2
+
+# Recorte de ROI canónico en el servidor, equivalente a RoiCropUtils (GUI):
+#   - square/rect: centro (cx, cy), tamaño (w, h), rotation_deg
+#   - circle:      centro (cx, cy), r (caja 2r x 2r salvo que se pasen w/h), rotation_deg
+#   - annulus:     como circle + r_inner
+# La imagen se gira alrededor del pivote (por defecto el centro) con +rotation_deg (convención
+# de la GUI: WPF horario -> OpenCV antihorario) y se recorta centrado con el tamaño del ROI.
+# Como TryGetRotatedCrop, un ROI que se sale del frame se recorta a los límites de la imagen
+# (crop más pequeño, sin relleno) y la máscara se centra en el crop (BuildRoiMask).
+# `shape` no es un alias de `kind` (en /infer_frame es el dict de máscara) ni `x`/`y` del centro
+# (en la GUI son la esquina superior izquierda).
+
+_KIND_ALIASES = {"square": "rect", "rectangle": "rect", "rect": "rect", "circle": "circle", "annulus": "annulus"}
+
+
+def _num(roi: Dict[str, Any], *keys: str, default: Optional[float] = None) -> Optional[float]:
+    for k in keys:
+        v = roi.get(k)
+        if v is not None:
+            return float(v)
+    return default
+
+
+def roi_geometry(roi: Dict[str, Any]) -> Dict[str, float]:
+    """Normaliza la definición JSON del ROI: kind, cx, cy, w, h, r, r_inner, angle, pivot_x, pivot_y."""
+    kind = _KIND_ALIASES.get(str(roi.get("kind", "rect")).lower())
+    if kind is None:
+        raise ValueError(f"Forma de ROI no soportada: {roi.get('kind')}")
+
+    center = roi.get("center")
+    cx = float(center[0]) if center is not None else _num(roi, "cx")
+    cy = float(center[1]) if center is not None else _num(roi, "cy")
+    if cx is None or cy is None:
+        raise ValueError("El ROI necesita centro (cx, cy)")
+
+    size = roi.get("size")
+    w = float(size[0]) if size is not None else _num(roi, "w", "width", default=0.0)
+    h = float(size[1]) if size is not None else _num(roi, "h", "height", default=0.0)
+    r = _num(roi, "r", "radius", default=0.0)
+    r_inner = _num(roi, "r_inner", "inner_radius", default=0.0)
+
+    if kind == "rect":
+        if w <= 0 or h <= 0:
+            raise ValueError("El ROI rectangular necesita w y h > 0")
+    else:
+        r = max(r, 0.5)
+        w = max(w, 2.0 * r)
+        h = max(h, 2.0 * r)
+        r_inner = min(max(r_inner, 0.0), r)
+
+    return {
+        "kind": kind,
+        "cx": cx,
+        "cy": cy,
+        "w": max(1.0, w),
+        "h": max(1.0, h),
+        "r": r,
+        "r_inner": r_inner,
+        "angle": _num(roi, "rotation_deg", "angle_deg", default=0.0),
+        "pivot_x": _num(roi, "pivot_x", default=cx),
+        "pivot_y": _num(roi, "pivot_y", default=cy),
+    }
+
+
+def crop_roi(frame: np.ndarray, roi: Dict[str, Any]) -> Tuple[np.ndarray, Optional[Dict[str, Any]]]:
+    """
+    Devuelve (crop BGR del ROI canónico, shape de máscara en coords del crop o None).
+    Sin rotación el crop es una vista NumPy (sin copia); con rotación, un único warpAffine
+    directamente al tamaño del crop (sin girar el frame completo). Fuera del frame se recorta a
+    los límites de la imagen, igual que la GUI.
+    """
+    g = roi_geometry(roi)
+    out_w = int(round(g["w"]))
+    out_h = int(round(g["h"]))
+    angle = g["angle"] % 360.0
+    H, W = frame.shape[:2]
+
+    if angle == 0.0:
+        M = np.float64([[1, 0, 0], [0, 1, 0]])
+    else:
+        M = cv2.getRotationMatrix2D((g["pivot_x"], g["pivot_y"]), angle, 1.0)
+    x, y, w, h = _crop_rect(M, g, out_w, out_h, W, H)
+
+    if angle == 0.0:
+        crop = frame[y:y + h, x:x + w]  # vista, sin copia
+    else:
+        M = M.copy()
+        M[0, 2] -= x
+        M[1, 2] -= y
+        crop = cv2.warpAffine(
+            frame, M, (w, h), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0
+        )
+    return crop, _local_shape(g, w, h, out_w, out_h)
+
+
+def _crop_rect(M: np.ndarray, g: Dict[str, float], out_w: int, out_h: int, W: int, H: int) -> Tuple[int, int, int, int]:
+    """(x, y, w, h) del crop en la imagen girada: centro del ROI tras M, mismo redondeo y recorte a límites que la GUI."""
+    ccx = M[0, 0] * g["cx"] + M[0, 1] * g["cy"] + M[0, 2]
+    ccy = M[1, 0] * g["cx"] + M[1, 1] * g["cy"] + M[1, 2]
+    x = min(max(int(round(ccx - out_w * 0.5)), 0), W - 1)
+    y = min(max(int(round(ccy - out_h * 0.5)), 0), H - 1)
+    return x, y, min(max(out_w, 1), W - x), min(max(out_h, 1), H - y)
+
+
+def _local_shape(g: Dict[str, float], w: int, h: int, out_w: int, out_h: int) -> Optional[Dict[str, Any]]:
+    if g["kind"] == "rect":
+        return None
+    # Como BuildRoiMask: centrada en el crop y con el radio escalado si el crop se recortó
+    k = min(w / out_w, h / out_h)
+    r = min(g["r"] * k, min(w, h) / 2.0)
+    shape = {"kind": g["kind"], "cx": w / 2.0, "cy": h / 2.0, "r": r}
+    if g["kind"] == "annulus":
+        shape["r_inner"] = min(g["r_inner"] * k, r)
+    return shape
@@ -34,3 +34,39 @@ def build_mask(h: int, w: int, shape: dict | None):
         return mask_annulus(h, w, float(shape.get("cx", w/2)), float(shape.get("cy", h/2)),
                             float(shape.get("r", min(h, w)/2)), float(shape.get("r_inner", 0)))
     return np.full((h, w), 255, np.uint8)
+
+def scale_shape(shape: dict | None, kx: float, ky: float | None = None) -> dict | None:
+    """
+    Forma del ROI para el mismo ROI reescalado (kx, ky): bordes del rect escalados, centros de
+    circle/annulus con el convenio de centros de píxel de cv2.resize y radios por la media.
+    """
+    if not shape:
+        return shape
+    ky = kx if ky is None else ky
+    out = dict(shape)
+    for key, k in (("x", kx), ("w", kx), ("y", ky), ("h", ky)):
+        if key in out:
+            out[key] = float(out[key]) * k
+    for key, k in (("cx", kx), ("cy", ky)):
+        if key in out:
+            out[key] = (float(out[key]) + 0.5) * k - 0.5
+    for key in ("r", "r_inner"):
+        if key in out:
+            out[key] = float(out[key]) * (kx + ky) / 2.0
+    return out
+
+
+def token_mask(mask: np.ndarray, token_hw, box, target: int, min_coverage: float = 0.0) -> np.ndarray:
+    """
+    Proyecta la máscara del ROI (h, w) sobre el grid de tokens (Ht, Wt) del lienzo letterbox
+    target x target, con el ROI en `box` = (left, top, nw, nh). Devuelve bool (Ht, Wt): True
+    en los tokens cuya fracción de píxeles dentro de la máscara supera `min_coverage`
+    (el padding del letterbox nunca cuenta).
+    """
+    Ht, Wt = int(token_hw[0]), int(token_hw[1])
+    left, top, nw, nh = (int(v) for v in box)
+    canvas = np.zeros((int(target), int(target)), np.float32)
+    roi = (mask > 0).astype(np.float32)
+    canvas[top:top + nh, left:left + nw] = cv2.resize(roi, (nw, nh), interpolation=cv2.INTER_AREA)
+    coverage = cv2.resize(canvas, (Wt, Ht), interpolation=cv2.INTER_AREA)  # media por parche
+    return coverage > max(float(min_coverage), 1e-6)
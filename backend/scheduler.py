@@ -0,0 +1,164 @@
+from __future__ import annotations
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from .metrics import current_timer, timer_add
+
+# Trabajo encolado: (tensor preprocesado, future, StageTimer de la petición, instante de encolado,
+# keep-list de parches o None)
+_Job = Tuple[Any, Future, Any, float, Any]
+
+
+class InferenceScheduler:
+    """
+    Micro-batching del extractor compartido entre peticiones concurrentes.
+
+    Cada petición preprocesa sus imágenes en su propio hilo (`extractor.preprocess`) y
+    encola los tensores; un único hilo worker los agrupa en lotes de hasta `max_batch`
+    esperando como mucho `max_wait_ms` desde el primero, hace un forward por grupo de
+    tamaño (`extractor.forward_preprocessed`) y resuelve el Future de cada imagen con
+    (embedding, (h_tokens, w_tokens)).
+
+    Sólo el worker toca el modelo: los forwards quedan serializados (sin carreras) y las
+    estaciones que llegan a la vez comparten lote.
+
+    Cada trabajo guarda el StageTimer de su petición (backend/metrics.py): el worker le atribuye
+    la espera en cola ("queue") y el forward del lote en el que viajó ("forward").
+    """
+
+    def __init__(self, extractor: Any, max_batch: int = 8, max_wait_ms: float = 5.0):
+        self.extractor = extractor
+        self.max_batch = max(1, int(max_batch))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self._queue: "queue.Queue[Optional[_Job]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.items = 0
+        self.max_batch_seen = 0
+
+    # ---------------- ciclo de vida ----------------
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._worker, name="bdi-infer-scheduler", daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """Procesa lo ya encolado y detiene el worker."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join(timeout)
+
+    # ---------------- API pública ----------------
+    def submit(self, img: Any, shape: Optional[Dict[str, Any]] = None) -> Future:
+        """
+        Preprocesa `img` en el hilo llamante y la encola; devuelve un Future con (emb, hw).
+        Con un extractor en modo token_pruning, `shape` fija los parches que pasan por el ViT;
+        con polar_unwrap, los anillos se preprocesan como tira polar (se agrupan por tamaño).
+        """
+        keep = None
+        if getattr(self.extractor, "token_pruning", False):
+            keep = self.extractor.patch_keep_list(img.shape[:2], shape)
+        if getattr(self.extractor, "polar_unwrap", False):
+            x = self.extractor.preprocess(img, shape)
+        else:
+            x = self.extractor.preprocess(img)
+        fut: Future = Future()
+        self.start()
+        self._queue.put((x, fut, current_timer(), time.perf_counter(), keep))
+        return fut
+
+    def submit_many(self, images: Sequence[Any], shapes: Optional[Sequence[Any]] = None) -> List[Future]:
+        return [self.submit(img, shapes[i] if shapes else None) for i, img in enumerate(images)]
+
+    def extract(self, img: Any):
+        return self.submit(img).result()
+
+    def extract_batch(self, images: Sequence[Any], batch_size: Optional[int] = None):
+        """Compatible con `DinoV2Features.extract_batch` (el tamaño de lote lo fija el scheduler)."""
+        return [f.result() for f in self.submit_many(images)]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_batch": int(self.max_batch),
+            "max_wait_ms": float(self.max_wait * 1000.0),
+            "queued": int(self._queue.qsize()),
+            "batches": int(self.batches),
+            "items": int(self.items),
+            "avg_batch": float(self.items) / float(self.batches) if self.batches else 0.0,
+            "max_batch_seen": int(self.max_batch_seen),
+        }
+
+    # ---------------- worker ----------------
+    def _collect(self, first: _Job) -> Tuple[List[_Job], bool]:
+        jobs = [first]
+        stop = False
+        deadline = time.monotonic() + self.max_wait
+        while len(jobs) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                job = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if job is None:
+                stop = True
+                break
+            jobs.append(job)
+        return jobs, stop
+
+    def _run(self, jobs: List[_Job]) -> None:
+        # Descarta peticiones canceladas y agrupa por tamaño de entrada (dynamic_input) y keep-list
+        groups: Dict[Tuple[Any, ...], List[_Job]] = {}
+        t_start = time.perf_counter()
+        waits: Dict[int, Tuple[Any, float]] = {}
+        for job in jobs:
+            x, fut, timer, t_enq, keep = job
+            if fut.set_running_or_notify_cancel():
+                key = (tuple(x.shape[-2:]), keep.tobytes() if keep is not None else None)
+                groups.setdefault(key, []).append(job)
+                if timer is not None:
+                    prev = waits.get(id(timer), (timer, 0.0))[1]
+                    waits[id(timer)] = (timer, max(prev, t_start - t_enq))
+        for timer, wait in waits.values():
+            timer_add(timer, "queue", wait)
+
+        for group in groups.values():
+            t0 = time.perf_counter()
+            try:
+                xs, keep = [job[0] for job in group], group[0][4]
+                outs = (
+                    self.extractor.forward_preprocessed(xs, keep) if keep is not None
+                    else self.extractor.forward_preprocessed(xs)
+                )
+            except Exception as exc:
+                for job in group:
+                    job[1].set_exception(exc)
+                continue
+            dt = time.perf_counter() - t0
+            # Un forward por petición aunque aporte varias imágenes al lote
+            for timer in {id(job[2]): job[2] for job in group}.values():
+                timer_add(timer, "forward", dt)
+            for job, out in zip(group, outs):
+                job[1].set_result(out)
+
+        n = sum(len(g) for g in groups.values())
+        self.batches += 1
+        self.items += n
+        self.max_batch_seen = max(self.max_batch_seen, n)
+
+    def _worker(self) -> None:
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            jobs, stop = self._collect(job)
+            self._run(jobs)
+            if stop:
+                return
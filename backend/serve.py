@@ -0,0 +1,165 @@
+"""
+Modo servidor multi-proceso (Linux): gunicorn + workers uvicorn con el modelo precargado.
+
+    python -m backend.serve --workers 4 --threads-per-worker 8
+
+- preload: `backend.app` (y con él el ViT) se importa una sola vez en el maestro y los workers
+  se crean con fork; `app.prepare_for_fork()` pasa los pesos a memoria compartida, así que
+  N workers no multiplican la RAM del modelo. El maestro no ejecuta forwards: el warm-up lo hace
+  cada worker al arrancar, con sus hilos ya fijados (un pool OpenMP heredado del fork no es fiable).
+- Memorias PatchCore: `ModelStore` las abre con mmap (bundle .npy / índice FAISS), por lo que las
+  páginas del page cache se comparten entre workers.
+- Afinidad: el worker del hueco i se fija a los cores [i*k, (i+1)*k) (k = threads por worker) y
+  ajusta torch/FAISS a k hilos. Un worker que se reinicia recupera el mismo hueco.
+- Coherencia: cada worker tiene su propia `MemoryCache`; las entradas se validan con
+  `ModelStore.stamp`, así un /fit_ok o /calibrate_ng atendido por otro worker se ve en el siguiente /infer.
+
+Con preload el dispositivo se fuerza a CPU (CUDA no sobrevive al fork). Para GPU usa
+`--no-preload` (un modelo por worker) o directamente `python backend/app.py`.
+En Windows (sin gunicorn) se arranca uvicorn con un único proceso.
+"""
+from __future__ import annotations
+
+import argparse
+import logging
+import os
+import sys
+from pathlib import Path
+from typing import Any, Dict, List, Sequence
+
+if __package__ in (None, ""):
+    sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+    from backend.config import load_settings  # type: ignore[no-redef]
+else:
+    from .config import load_settings
+
+log = logging.getLogger("backend.serve")
+
+APP_URI = "backend.app:app"
+
+
+def available_cores() -> List[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def core_slices(cores: Sequence[int], workers: int, threads_per_worker: int) -> List[List[int]]:
+    """Reparte `cores` en `workers` bloques contiguos de `threads_per_worker` (cíclico si no llegan)."""
+    cores = list(cores)
+    k = max(1, min(int(threads_per_worker), len(cores)))
+    slices = []
+    for i in range(max(1, int(workers))):
+        start = (i * k) % len(cores)
+        block = cores[start:start + k]
+        if len(block) < k:
+            block += cores[: k - len(block)]
+        slices.append(block)
+    return slices
+
+
+def _pin_current_process(cores: Sequence[int]) -> None:
+    if hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(0, set(cores))
+        except OSError as exc:
+            log.warning("No se pudo fijar la afinidad %s: %s", list(cores), exc)
+    try:
+        import torch  # type: ignore
+
+        torch.set_num_threads(len(cores))
+    except Exception:
+        pass
+    try:
+        import faiss  # type: ignore
+
+        faiss.omp_set_num_threads(len(cores))
+    except Exception:
+        pass
+
+
+def _gunicorn_hooks(slices: List[List[int]]) -> Dict[str, Any]:
+    def pre_fork(server, worker):
+        # Hueco libre más bajo (el de un worker caído se reutiliza)
+        used = {getattr(w, "bdi_slot", None) for w in server.WORKERS.values()}
+        worker.bdi_slot = next((i for i in range(len(slices)) if i not in used), 0)
+
+    def post_fork(server, worker):
+        cores = slices[worker.bdi_slot]
+        _pin_current_process(cores)
+        server.log.info("worker %s (slot %d) -> cores %s", worker.pid, worker.bdi_slot, cores)
+
+    return {"pre_fork": pre_fork, "post_fork": post_fork}
+
+
+def run_pool(host: str, port: int, workers: int, threads_per_worker: int, preload: bool = True, timeout: int = 120) -> None:
+    from gunicorn.app.base import BaseApplication  # type: ignore
+
+    cores = available_cores()
+    slices = core_slices(cores, workers, threads_per_worker)
+    if preload:
+        # Antes de importar el app: el extractor se crea en CPU en el maestro
+        os.environ["BDI_DEVICE"] = "cpu"
+    # Los hilos de torch se fijan por worker en post_fork
+    os.environ.setdefault("OMP_NUM_THREADS", str(len(slices[0])))
+
+    options = {
+        "bind": f"{host}:{port}",
+        "workers": int(workers),
+        "worker_class": "uvicorn.workers.UvicornWorker",
+        "preload_app": bool(preload),
+        "timeout": int(timeout),
+        **_gunicorn_hooks(slices),
+    }
+
+    class _PoolApplication(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            from backend import app as app_mod
+
+            if preload:
+                app_mod.prepare_for_fork()
+            return app_mod.app
+
+    log.info("Pool: %d workers x %d cores en %s:%d (preload=%s)", workers, len(slices[0]), host, port, preload)
+    _PoolApplication().run()
+
+
+def main(argv: Sequence[str] | None = None) -> None:
+    settings = load_settings()
+    server_cfg = settings.get("server", {})
+    serve_cfg = settings.get("serve", {})
+
+    ap = argparse.ArgumentParser(description="Backend BrakeDiscInspector con pool de workers")
+    ap.add_argument("--host", default=server_cfg.get("host", "127.0.0.1"))
+    ap.add_argument("--port", type=int, default=int(server_cfg.get("port", 8000)))
+    ap.add_argument("--workers", type=int, default=int(serve_cfg.get("workers", 0)),
+                    help="0 = cores disponibles / threads-per-worker")
+    ap.add_argument("--threads-per-worker", type=int, default=int(serve_cfg.get("threads_per_worker", 8)))
+    ap.add_argument("--timeout", type=int, default=int(serve_cfg.get("timeout_s", 120)))
+    ap.add_argument("--no-preload", action="store_true", help="cada worker carga su propio modelo (GPU)")
+    args = ap.parse_args(argv)
+
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO)
+
+    threads = max(1, args.threads_per_worker)
+    workers = args.workers if args.workers > 0 else max(1, len(available_cores()) // threads)
+
+    try:
+        import gunicorn  # type: ignore  # noqa: F401
+    except ImportError:
+        log.warning("gunicorn no disponible (¿Windows?): se arranca uvicorn con un único proceso")
+        import uvicorn
+
+        uvicorn.run(APP_URI, host=args.host, port=args.port, reload=False)
+        return
+
+    run_pool(args.host, args.port, workers, threads, preload=not args.no_preload, timeout=args.timeout)
+
+
+if __name__ == "__main__":
+    main()
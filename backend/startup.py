@@ -0,0 +1,194 @@
+"""
+Arranque en frío del backend: carga del modelo en segundo plano, warm-up y precarga de memorias.
+
+`backend/app.py` ya no construye el extractor al importarse: `Startup.start()` ejecuta las fases
+en un hilo (o en el llamante con background=False) y `/health` informa del estado:
+
+    idle -> loading -> warming -> ready      (-> error -> loading ... tras `retry_after_s`)
+
+La precarga de memorias "calientes" corre tras `ready` en el mismo hilo (sus fallos sólo se
+registran). Exportar los pesos una vez (con acceso al hub) para arrancar sin red:
+
+    python -m backend.startup --export-weights models/weights/dinov2_vits14.safetensors
+"""
+from __future__ import annotations
+
+import argparse
+import logging
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+log = logging.getLogger("backend.startup")
+
+Step = Tuple[str, Callable[[], Any]]
+
+READY = "ready"
+ERROR = "error"
+
+
+def parse_roi_list(value: Any) -> List[Tuple[str, str]]:
+    """'Master/Pattern,Master/Inner' o [["Master", "Pattern"], "Master/Inner"] -> [(role, roi), ...]."""
+    if not value:
+        return []
+    items = value.split(",") if isinstance(value, str) else list(value)
+    out = []
+    for item in items:
+        if isinstance(item, str):
+            item = item.strip()
+            if not item:
+                continue
+            if "/" not in item:
+                raise ValueError(f"Entrada de precarga inválida (se espera role/roi): {item!r}")
+            role, roi = item.split("/", 1)
+        else:
+            role, roi = item
+        out.append((str(role), str(roi)))
+    return out
+
+
+class Startup:
+    """Fases de arranque con estado consultable (thread-safe). `start` es idempotente."""
+
+    def __init__(self) -> None:
+        self.state = "idle"
+        self.error: Optional[str] = None
+        self.timings: Dict[str, float] = {}
+        self.preloaded = 0
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._settled = threading.Event()  # listo o error
+        self._thread: Optional[threading.Thread] = None
+        self._started = False
+        self._failed_at: Optional[float] = None
+        self.failures = 0
+
+    # ---------------- estado ----------------
+    @property
+    def started(self) -> bool:
+        return self._started
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    @property
+    def busy(self) -> bool:
+        """Cargando o calentando (el modelo aún no debe atender tráfico)."""
+        return self._started and not self._ready.is_set() and self.state != ERROR
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Espera a `ready` (o a un error); devuelve si está listo."""
+        if self._started:
+            self._settled.wait(timeout)
+        return self._ready.is_set()
+
+    def retry_in(self, retry_after_s: float) -> Optional[float]:
+        """Segundos hasta que `start` pueda reintentar tras un error (0 si ya puede); None si no hay error."""
+        failed_at = self._failed_at
+        if self.state != ERROR or failed_at is None:
+            return None
+        return max(0.0, float(retry_after_s) - (time.monotonic() - failed_at))
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "ready": self.ready,
+            "error": self.error,
+            "timings_s": dict(self.timings),
+            "preloaded": int(self.preloaded),
+            "failures": int(self.failures),
+        }
+
+    # ---------------- ejecución ----------------
+    def start(
+        self,
+        steps: Sequence[Step],
+        after_ready: Sequence[Step] = (),
+        background: bool = True,
+        retry_after_s: Optional[float] = None,
+    ) -> None:
+        """
+        Ejecuta `steps` en orden (estado = nombre de la fase), marca `ready` y luego `after_ready`
+        (p.ej. precarga). Con background=False todo corre en el hilo llamante. Las llamadas
+        siguientes no hacen nada salvo tras un error: con `retry_after_s`, pasados esos segundos
+        desde el fallo se vuelve a empezar (p.ej. pesos que no se podían leer).
+        """
+        with self._lock:
+            if self._started:
+                wait = self.retry_in(retry_after_s) if retry_after_s is not None else None
+                if wait is None or wait > 0:
+                    return
+                log.info("Reintentando el arranque tras el error: %s", self.error)
+                self.error = None
+                self.timings = {}
+                self._failed_at = None
+                self._settled.clear()
+                self.state = "idle"
+            self._started = True
+        if background:
+            self._thread = threading.Thread(
+                target=self._run, args=(list(steps), list(after_ready)), name="bdi-startup", daemon=True
+            )
+            self._thread.start()
+        else:
+            self._run(list(steps), list(after_ready))
+
+    def _run(self, steps: List[Step], after_ready: List[Step]) -> None:
+        t_start = time.perf_counter()
+        for name, fn in steps:
+            self.state = name
+            t0 = time.perf_counter()
+            try:
+                fn()
+            except Exception as exc:
+                log.exception("Fallo en el arranque (fase %s)", name)
+                self.error = f"{type(exc).__name__}: {exc}"
+                self.failures += 1
+                self._failed_at = time.monotonic()
+                self.state = ERROR
+                self._settled.set()
+                return
+            self.timings[name] = time.perf_counter() - t0
+        self.timings["total"] = time.perf_counter() - t_start
+        self.state = READY
+        self._ready.set()
+        self._settled.set()
+        log.info("Backend listo en %.2f s (%s)", self.timings["total"],
+                 ", ".join(f"{k}={v:.2f}s" for k, v in self.timings.items() if k != "total"))
+
+        for name, fn in after_ready:
+            t0 = time.perf_counter()
+            try:
+                fn()
+            except Exception:
+                log.exception("Fallo en %s (se ignora)", name)
+            self.timings[name] = time.perf_counter() - t0
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    if __package__ in (None, ""):
+        sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+        from backend.features import DinoV2Features  # type: ignore[no-redef]
+    else:
+        from .features import DinoV2Features
+
+    ap = argparse.ArgumentParser(description="Utilidades de arranque del backend")
+    ap.add_argument("--export-weights", type=Path, required=True,
+                    help="guarda los pesos preentrenados en un fichero local (.safetensors recomendado)")
+    ap.add_argument("--model-name", default="vit_small_patch14_dinov2.lvd142m")
+    args = ap.parse_args(argv)
+
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO)
+    ext = DinoV2Features(model_name=args.model_name, device="cpu", input_size=448, patch_size=14)
+    args.export_weights.parent.mkdir(parents=True, exist_ok=True)
+    ext.save_weights(str(args.export_weights))
+    log.info("Pesos de %s guardados en %s", args.model_name, args.export_weights)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
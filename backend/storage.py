@@ -2,16 +2,78 @@ from __future__ import annotations
 
 import base64
 import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Any, Dict, Optional, Tuple
+from typing import Any, Dict, Iterator, Optional, Tuple
 
 import numpy as np
 
 from .utils import ensure_dir, load_json, save_json
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None  # type: ignore[assignment]
+    import msvcrt
+
+BUNDLE_FORMAT_VERSION = 1
+_BUNDLE_FILES = ("emb_file", "index_file", "projection_file")
+_SNAPSHOT_ATTEMPTS = 3  # el último, con el lock del bundle
+
+_thread_locks: Dict[str, threading.Lock] = {}
+_thread_locks_guard = threading.Lock()
+
+
+@contextmanager
+def _file_lock(path: Path) -> Iterator[None]:
+    """Lock exclusivo entre procesos (workers de gunicorn) sobre `path`, bloqueante."""
+    with open(path, "a+b") as fh:
+        if fcntl is not None:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+            return
+        while True:
+            try:
+                fh.seek(0)
+                msvcrt.locking(fh.fileno(), msvcrt.LK_NBLCK, 1)
+                break
+            except OSError:
+                time.sleep(0.01)
+        try:
+            yield
+        finally:
+            fh.seek(0)
+            msvcrt.locking(fh.fileno(), msvcrt.LK_UNLCK, 1)
+
+
 class ModelStore:
-    def __init__(self, root: Path):
+    """
+    Persistencia por (role_id, roi_id).
+
+    Formato actual ("bundle"): directorio `<base>.bundle/` con
+      - `header.json`: token grid, dtype, metadata, calibración y metadatos del extractor
+      - `emb.<ver>.npy`: embeddings del coreset sin comprimir (float32/float16), cargables con mmap
+      - `index.<ver>.faiss`: índice FAISS (opcional), legible con IO_FLAG_MMAP
+      - `proj.<ver>.npz`: proyección de los embeddings (opcional; matriz D×k y media)
+    Cada guardado escribe ficheros con versión nueva y reemplaza `header.json` de forma atómica,
+    así los procesos que tengan mapeada la versión anterior no se ven afectados (también en Windows).
+    Las modificaciones de la cabecera (leer, cambiar, escribir y borrar la versión anterior) se
+    serializan por bundle entre hilos y procesos (`<base>.bundle.lock`).
+    Los formatos antiguos (`.npz` + `_index.faiss` + `_calib.json`) se siguen leyendo.
+    """
+
+    def __init__(self, root: Path, emb_dtype: str = "float32"):
         self.root = Path(root)
+        self.emb_dtype = np.dtype(emb_dtype)
+        if self.emb_dtype not in (np.dtype(np.float32), np.dtype(np.float16)):
+            raise ValueError("emb_dtype debe ser 'float32' o 'float16'")
         ensure_dir(self.root)
 
     def _sanitize(self, value: str) -> str:
@@ -44,6 +106,251 @@ class ModelStore:
     def _calib_path(self, role_id: str, roi_id: str) -> Path:
         return self.root / f"{self._base_name(role_id, roi_id)}_calib.json"
 
+    def _bundle_dir(self, role_id: str, roi_id: str) -> Path:
+        return self.root / f"{self._base_name(role_id, roi_id)}.bundle"
+
+    def stamp(self, role_id: str, roi_id: str) -> Tuple[Any, ...]:
+        """
+        Marca barata (sólo stat) de los artefactos de (role_id, roi_id): cambia en cada guardado
+        (header.json se reemplaza con un inodo nuevo). Sirve para invalidar cachés de otros procesos.
+        """
+        paths = (
+            self._bundle_dir(role_id, roi_id) / "header.json",
+            self._memory_path(role_id, roi_id),
+            self._calib_path(role_id, roi_id),
+        )
+        out = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+                out.append((st.st_ino, st.st_mtime_ns, st.st_size))
+            except OSError:
+                out.append(None)
+        return tuple(out)
+
+    # ---------------- bundle ----------------
+    def _read_header(self, role_id: str, roi_id: str) -> Optional[Dict[str, Any]]:
+        path = self._bundle_dir(role_id, roi_id) / "header.json"
+        if not path.exists():
+            return None
+        try:
+            return json.loads(path.read_text(encoding="utf-8"))
+        except Exception:
+            return None
+
+    @contextmanager
+    def _bundle_lock(self, role_id: str, roi_id: str) -> Iterator[None]:
+        """Serializa el read-modify-write de la cabecera del bundle (hilos y procesos)."""
+        lock_path = self.root / f"{self._base_name(role_id, roi_id)}.bundle.lock"
+        with _thread_locks_guard:
+            lock = _thread_locks.setdefault(str(lock_path.resolve()), threading.Lock())
+        with lock, _file_lock(lock_path):
+            yield
+
+    def _write_header(self, bundle: Path, header: Dict[str, Any]) -> None:
+        tmp = bundle / f"header.{uuid.uuid4().hex}.tmp"
+        tmp.write_text(json.dumps(header, indent=2), encoding="utf-8")
+        os.replace(tmp, bundle / "header.json")  # atómico: los lectores ven la versión vieja o la nueva
+
+    def _replace_header(self, bundle: Path, previous: Dict[str, Any], header: Dict[str, Any]) -> None:
+        """
+        Escribe `header` y borra sólo los ficheros de la cabecera anterior que ya no usa (nunca los
+        de otro escritor). Llamar con `_bundle_lock`. Los que siguen mapeados (Windows) quedan en
+        `stale_files` y se reintentan en el próximo guardado.
+        """
+        keep = {header.get(k) for k in _BUNDLE_FILES}
+        old = [previous.get(k) for k in _BUNDLE_FILES] + list(previous.get("stale_files") or [])
+        header["stale_files"] = []
+        self._write_header(bundle, header)
+        stale = []
+        # con el lock tomado ningún otro escritor tiene un header.*.tmp en curso: son restos de caídas
+        old += [f.name for f in bundle.glob("header.*.tmp")]
+        for name in dict.fromkeys(old):
+            if not name or name in keep or Path(name).name != name:
+                continue
+            try:
+                (bundle / name).unlink()
+            except FileNotFoundError:
+                pass
+            except OSError:
+                stale.append(name)
+        if stale:
+            header["stale_files"] = stale
+            self._write_header(bundle, header)
+
+    def save_bundle(
+        self,
+        role_id: str,
+        roi_id: str,
+        embeddings: np.ndarray,
+        token_hw: Tuple[int, int],
+        metadata: Optional[Dict[str, Any]] = None,
+        index_blob: Optional[bytes] = None,
+        extractor: Optional[Dict[str, Any]] = None,
+        projection: Optional[Dict[str, np.ndarray]] = None,
+    ) -> Path:
+        """
+        Guarda memoria + índice (bytes de `faiss.serialize_index`) + metadatos en un bundle.
+        `projection`: arrays de la proyección (`Projection.arrays()`) si los embeddings están
+        proyectados. Conserva la calibración existente del ROI.
+        """
+        bundle = self._bundle_dir(role_id, roi_id)
+        ensure_dir(bundle)
+
+        # Ficheros con versión única (fuera del lock: nadie más los referencia ni los borra)
+        ver = uuid.uuid4().hex[:12]
+        emb_file = f"emb.{ver}.npy"
+        np.save(bundle / emb_file, np.ascontiguousarray(embeddings, dtype=self.emb_dtype))
+        index_file = None
+        if index_blob is not None:
+            index_file = f"index.{ver}.faiss"
+            (bundle / index_file).write_bytes(bytes(index_blob))
+        projection_file = None
+        if projection is not None:
+            projection_file = f"proj.{ver}.npz"
+            np.savez(bundle / projection_file, **{k: np.asarray(v, dtype=np.float32) for k, v in projection.items()})
+
+        with self._bundle_lock(role_id, roi_id):
+            previous = self._read_header(role_id, roi_id) or {}
+            header = {
+                "format_version": BUNDLE_FORMAT_VERSION,
+                "token_hw": [int(token_hw[0]), int(token_hw[1])],
+                "dtype": self.emb_dtype.name,
+                "n_embeddings": int(embeddings.shape[0]),
+                "dim": int(embeddings.shape[1]) if embeddings.ndim == 2 else 0,
+                "emb_file": emb_file,
+                "index_file": index_file,
+                "projection_file": projection_file,
+                "metadata": metadata or {},
+                "extractor": extractor or previous.get("extractor") or {},
+                "calib": previous.get("calib"),
+            }
+            self._replace_header(bundle, previous, header)
+        return bundle
+
+    @staticmethod
+    def _header_memory(bundle: Path, header: Dict[str, Any], mmap: bool):
+        emb = np.load(bundle / header["emb_file"], mmap_mode="r" if mmap else None, allow_pickle=False)
+        if emb.dtype != np.float32:
+            emb = emb.astype(np.float32)  # float16 en disco -> copia float32 en RAM
+        H, W = (int(v) for v in header["token_hw"])
+        return emb, (H, W), dict(header.get("metadata") or {})
+
+    @staticmethod
+    def _header_projection(bundle: Path, header: Dict[str, Any]) -> Optional[Dict[str, np.ndarray]]:
+        if not header.get("projection_file"):
+            return None
+        with np.load(bundle / header["projection_file"], allow_pickle=False) as z:
+            return {k: z[k].astype(np.float32) for k in z.files}
+
+    @staticmethod
+    def _read_faiss(path: Path, mmap: bool):
+        import faiss  # type: ignore
+
+        if not path.exists():
+            raise FileNotFoundError(path)  # faiss lo reporta como RuntimeError genérico
+        if mmap:
+            try:
+                return faiss.read_index(str(path), faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+            except Exception:
+                pass  # tipo de índice sin soporte de mmap -> lectura normal
+        return faiss.read_index(str(path))
+
+    def _load_bundle_memory(self, role_id: str, roi_id: str, mmap: bool = True):
+        header = self._read_header(role_id, roi_id)
+        if not header or not header.get("emb_file"):
+            return None
+        bundle = self._bundle_dir(role_id, roi_id)
+        if not (bundle / header["emb_file"]).exists():
+            return None
+        return self._header_memory(bundle, header, mmap)
+
+    def load_projection(self, role_id: str, roi_id: str) -> Optional[Dict[str, np.ndarray]]:
+        """Arrays de la proyección del bundle ({"matrix", ["mean"]}) o None si la memoria no está proyectada."""
+        header = self._read_header(role_id, roi_id)
+        if not header or not header.get("projection_file"):
+            return None
+        bundle = self._bundle_dir(role_id, roi_id)
+        if not (bundle / header["projection_file"]).exists():
+            return None
+        return self._header_projection(bundle, header)
+
+    def index_path(self, role_id: str, roi_id: str) -> Optional[Path]:
+        """Ruta del índice FAISS del bundle (None si no hay bundle o índice)."""
+        header = self._read_header(role_id, roi_id)
+        if not header or not header.get("index_file"):
+            return None
+        path = self._bundle_dir(role_id, roi_id) / header["index_file"]
+        return path if path.exists() else None
+
+    def load_index(self, role_id: str, roi_id: str, mmap: bool = True):
+        """
+        Índice FAISS listo para buscar: desde el bundle (con IO_FLAG_MMAP si `mmap`) o,
+        si no existe, deserializando el blob legacy. None si no hay índice o FAISS.
+        """
+        try:
+            import faiss  # type: ignore
+        except Exception:
+            return None
+        path = self.index_path(role_id, roi_id)
+        if path is not None:
+            return self._read_faiss(path, mmap)
+        if self._read_header(role_id, roi_id) is not None:
+            return None  # bundle sin índice (guardado sin FAISS): no mezclar con blobs antiguos
+        blob = self.load_index_blob(role_id, roi_id)
+        if blob is None:
+            return None
+        return faiss.deserialize_index(np.frombuffer(blob, dtype=np.uint8))
+
+    def load_bundle(self, role_id: str, roi_id: str, mmap: bool = True) -> Optional[Dict[str, Any]]:
+        """
+        Todo lo necesario para consultar la memoria, de una única lectura de la cabecera:
+        {"embeddings", "token_hw", "metadata", "index", "projection", "extractor"}, siempre de la
+        misma versión aunque otro proceso guarde a la vez (cargar pieza a pieza con `load_memory`,
+        `load_index`... puede mezclar versiones). Si un guardado concurrente borra un fichero de la
+        cabecera leída antes de abrirlo se vuelve a leer; el último intento se hace con el lock del
+        bundle. Sin bundle usa los formatos legacy. None si no hay memoria.
+        """
+        for attempt in range(_SNAPSHOT_ATTEMPTS):
+            try:
+                if attempt < _SNAPSHOT_ATTEMPTS - 1:
+                    return self._load_snapshot(role_id, roi_id, mmap)
+                with self._bundle_lock(role_id, roi_id):
+                    return self._load_snapshot(role_id, roi_id, mmap)
+            except FileNotFoundError:
+                if attempt == _SNAPSHOT_ATTEMPTS - 1:
+                    raise
+        return None
+
+    def _load_snapshot(self, role_id: str, roi_id: str, mmap: bool) -> Optional[Dict[str, Any]]:
+        header = self._read_header(role_id, roi_id)
+        if header is None:
+            loaded = self.load_memory(role_id, roi_id, mmap=mmap)
+            if loaded is None:
+                return None
+            emb, token_hw, metadata = loaded
+            return {
+                "embeddings": emb, "token_hw": token_hw, "metadata": metadata,
+                "index": self.load_index(role_id, roi_id, mmap=mmap), "projection": None, "extractor": None,
+            }
+        if not header.get("emb_file"):
+            return None
+        bundle = self._bundle_dir(role_id, roi_id)
+        emb, token_hw, metadata = self._header_memory(bundle, header, mmap)
+        index = None
+        if header.get("index_file"):
+            try:
+                import faiss  # type: ignore  # noqa: F401
+            except Exception:
+                pass  # sin FAISS -> búsqueda exacta con los embeddings
+            else:
+                index = self._read_faiss(bundle / header["index_file"], mmap)
+        return {
+            "embeddings": emb, "token_hw": token_hw, "metadata": metadata, "index": index,
+            "projection": self._header_projection(bundle, header),
+            "extractor": dict(header.get("extractor") or {}),
+        }
+
     def _load_memory_from_path(self, path: Path):
         with np.load(path, allow_pickle=False) as z:
             emb = z["emb"].astype(np.float32)
@@ -71,22 +378,20 @@ class ModelStore:
         metadata: Optional[Dict[str, Any]] = None,
     ):
         """
-        Guarda la memoria (embeddings coreset L2-normalizados) y la forma del grid de tokens.
+        Guarda la memoria (embeddings coreset L2-normalizados) y la forma del grid de tokens
+        en el bundle del ROI (sin índice; usa `save_bundle` para guardarlo todo a la vez).
         """
-        ensure_dir(self.root)
-        payload = {
-            "emb": embeddings.astype(np.float32),
-            "token_h": int(token_hw[0]),
-            "token_w": int(token_hw[1]),
-        }
-        if metadata:
-            payload["metadata"] = json.dumps(metadata)
-        np.savez_compressed(self._memory_path(role_id, roi_id), **payload)
+        self.save_bundle(role_id, roi_id, embeddings, token_hw, metadata=metadata)
 
-    def load_memory(self, role_id: str, roi_id: str):
+    def load_memory(self, role_id: str, roi_id: str, mmap: bool = True):
         """
-        Carga (embeddings, (Ht, Wt)) o None si no existe.
+        Carga (embeddings, (Ht, Wt), metadata) o None si no existe.
+        Del bundle con mmap (O(1), páginas compartidas entre procesos); si no, formatos legacy.
         """
+        bundle = self._load_bundle_memory(role_id, roi_id, mmap=mmap)
+        if bundle is not None:
+            return bundle
+
         new_path = self._memory_path(role_id, roi_id)
         if new_path.exists():
             return self._load_memory_from_path(new_path)
@@ -102,8 +407,17 @@ class ModelStore:
         return None
 
     def save_index_blob(self, role_id: str, roi_id: str, blob: bytes):
-        ensure_dir(self.root)
-        self._index_path(role_id, roi_id).write_bytes(blob)
+        """Añade/reemplaza el índice del bundle existente (o escribe el fichero legacy si no hay bundle)."""
+        with self._bundle_lock(role_id, roi_id):
+            previous = self._read_header(role_id, roi_id)
+            if previous is None:
+                ensure_dir(self.root)
+                self._index_path(role_id, roi_id).write_bytes(blob)
+                return
+            bundle = self._bundle_dir(role_id, roi_id)
+            index_file = f"index.{uuid.uuid4().hex[:12]}.faiss"
+            (bundle / index_file).write_bytes(bytes(blob))
+            self._replace_header(bundle, previous, {**previous, "index_file": index_file})
 
     def load_index_blob(self, role_id: str, roi_id: str) -> Optional[bytes]:
         new_path = self._index_path(role_id, roi_id)
@@ -120,9 +434,25 @@ class ModelStore:
         return None
 
     def save_calib(self, role_id: str, roi_id: str, data: dict):
-        save_json(self._calib_path(role_id, roi_id), data)
+        """Guarda la calibración en la cabecera del bundle; sin bundle (aún sin /fit_ok), en JSON suelto."""
+        with self._bundle_lock(role_id, roi_id):
+            header = self._read_header(role_id, roi_id)
+            if header is None:
+                save_json(self._calib_path(role_id, roi_id), data)
+                return
+            header["calib"] = data
+            self._write_header(self._bundle_dir(role_id, roi_id), header)
+
+    def load_extractor_meta(self, role_id: str, roi_id: str) -> Optional[Dict[str, Any]]:
+        """Metadatos del extractor con el que se construyó la memoria (bloque `extractor` del bundle) o None."""
+        header = self._read_header(role_id, roi_id)
+        return dict(header.get("extractor") or {}) if header is not None else None
 
     def load_calib(self, role_id: str, roi_id: str, default=None):
+        header = self._read_header(role_id, roi_id)
+        if header is not None and header.get("calib") is not None:
+            return header["calib"]
+
         new_path = self._calib_path(role_id, roi_id)
         if new_path.exists():
             return load_json(new_path, default=default)
@@ -1,14 +1,19 @@
+import base64
 import io
+import json
 import sys
 import types
 from types import SimpleNamespace
 
 import numpy as np
+import pytest
 from fastapi.testclient import TestClient
 from PIL import Image
 
 
-if "cv2" not in sys.modules:  # pragma: no cover - stub to avoid libGL dependency in CI
+try:  # OpenCV real si está instalado: el stub no debe ocultarlo al resto de módulos de test
+    import cv2  # noqa: F401
+except ImportError:  # pragma: no cover - stub to avoid libGL dependency in CI
     cv2_stub = types.ModuleType("cv2")
 
     def _imdecode(buf: np.ndarray, flags: int):  # type: ignore[override]
@@ -37,6 +42,9 @@ if "backend.features" not in sys.modules:  # pragma: no cover - lightweight stub
             emb = np.ones((3, 4), dtype=np.float32)
             return emb, (2, 2)
 
+        def extract_batch(self, images, batch_size=8):  # type: ignore[no-untyped-def]
+            return [self.extract(img) for img in images]
+
     features_stub.DinoV2Features = _StubFeatures
     sys.modules["backend.features"] = features_stub
 
@@ -67,9 +75,12 @@ def test_fit_ok_persists_memory(tmp_path, monkeypatch):
             emb = np.ones((3, 4), dtype=np.float32)
             return emb, (2, 2)
 
+        def extract_batch(self, images, batch_size=8):
+            return [self.extract(img) for img in images]
+
     monkeypatch.setattr(app_mod, "_extractor", DummyExtractor())
 
-    def fake_build(embeddings, coreset_rate=0.02, seed=0):
+    def fake_build(embeddings, coreset_rate=0.02, seed=0, **_):
         return SimpleNamespace(emb=np.ones((2, embeddings.shape[1]), dtype=np.float32), index=None)
 
     monkeypatch.setattr(app_mod.PatchCoreMemory, "build", staticmethod(fake_build))
@@ -86,8 +97,46 @@ def test_fit_ok_persists_memory(tmp_path, monkeypatch):
     assert payload["coreset_size"] == 2
     assert payload["token_shape"] == [2, 2]
 
-    npz_files = list(tmp_path.glob("*.npz"))
-    assert npz_files, "memory file should be saved"
+    bundles = list(tmp_path.glob("*.bundle/header.json"))
+    assert bundles, "memory bundle should be saved"
+    metadata = json.loads(bundles[0].read_text())["metadata"]
+    assert "mask_tokens" in metadata and metadata["heatmap_mapping"] == "content"
+    assert list(tmp_path.glob("*.bundle/emb.*.npy")), "embeddings should be stored as .npy"
+
+
+
+def test_infer_uses_the_token_mask_and_heatmap_modes_the_memory_was_built_with(tmp_path, monkeypatch):
+    client = TestClient(app_mod.app)
+    seen = []
+
+    class Extractor:
+        def extract_batch(self, images, batch_size=8):
+            return [(np.ones((4, 4), dtype=np.float32), (2, 2)) for _ in images]
+
+    class RecordingEngine:
+        def __init__(self, extractor, memory, token_hw, mm_per_px=0.2):
+            pass
+
+        def run(self, img, **kwargs):
+            seen.append((kwargs["mask_tokens"], kwargs["heatmap_mapping"]))
+            return {"score": 0.0, "regions": [], "token_shape": [2, 2]}
+
+    store = app_mod.ModelStore(tmp_path)
+    monkeypatch.setattr(app_mod, "_extractor", Extractor())
+    monkeypatch.setattr(app_mod, "InferenceEngine", RecordingEngine)
+    monkeypatch.setattr(app_mod, "store", store)
+    monkeypatch.setitem(app_mod.SETTINGS.setdefault("inference", {}), "mask_tokens", True)
+
+    files = {"image": ("roi.png", _png_bytes(), "image/png")}
+    data = {"role_id": "Master", "roi_id": "Pattern", "mm_per_px": "0.25", "heatmap": "none"}
+    # memoria anterior a inference.mask_tokens (sin las claves): sin máscara y grid completo al ROI
+    store.save_memory("Master", "Pattern", np.ones((2, 4), dtype=np.float32), (2, 2), metadata={})
+    app_mod.memory_cache.clear()
+    assert client.post("/infer", data=data, files=files).status_code == 200
+    store.save_memory("Master", "Pattern", np.ones((2, 4), dtype=np.float32), (2, 2), metadata={"mask_tokens": True, "heatmap_mapping": "content"})
+    app_mod.memory_cache.clear()
+    assert client.post("/infer", data=data, files=files).status_code == 200
+    assert seen == [(False, "grid"), (True, "content")]
 
 
 def test_calibrate_ng_saves_threshold(tmp_path, monkeypatch):
@@ -112,3 +161,512 @@ def test_calibrate_ng_saves_threshold(tmp_path, monkeypatch):
 
     saved = list(tmp_path.glob("*.json"))
     assert saved, "calibration file should be created"
+
+
+def test_infer_runs_feature_extraction_once(tmp_path, monkeypatch):
+    client = TestClient(app_mod.app)
+    calls = []
+
+    class CountingExtractor:
+        def extract_batch(self, images, batch_size=8):
+            calls.extend(image.shape for image in images)
+            return [(np.ones((4, 4), dtype=np.float32), (2, 2)) for _ in images]
+
+    class RecordingEngine:
+        seen = {}
+
+        def __init__(self, extractor, memory, token_hw, mm_per_px=0.2):
+            pass
+
+        def run(self, img, **kwargs):
+            RecordingEngine.seen = kwargs
+            return {"score": 0.5, "regions": [], "token_shape": [2, 2], "heatmap_u8": None}
+
+    store = app_mod.ModelStore(tmp_path)
+    store.save_memory("Master", "Pattern", np.ones((2, 4), dtype=np.float32), (2, 2))
+    monkeypatch.setattr(app_mod, "_extractor", CountingExtractor())
+    monkeypatch.setattr(app_mod, "InferenceEngine", RecordingEngine)
+    monkeypatch.setattr(app_mod, "store", store)
+    app_mod.memory_cache.clear()
+
+    files = {"image": ("roi.png", _png_bytes(), "image/png")}
+    data = {"role_id": "Master", "roi_id": "Pattern", "mm_per_px": "0.25"}
+    resp = client.post("/infer", data=data, files=files)
+    assert resp.status_code == 200, resp.text
+    assert len(calls) == 1
+    assert RecordingEngine.seen["token_hw"] == (2, 2)
+    assert RecordingEngine.seen["embeddings"].shape == (4, 4)
+
+
+def test_fit_ok_append_extends_existing_memory(tmp_path, monkeypatch):
+    client = TestClient(app_mod.app)
+    rng = np.random.default_rng(0)
+
+    class RandomExtractor:
+        def extract_batch(self, images, batch_size=8):
+            return [(rng.standard_normal((4, 8)).astype(np.float32), (2, 2)) for _ in images]
+
+    monkeypatch.setattr(app_mod, "_extractor", RandomExtractor())
+    monkeypatch.setattr(app_mod, "store", app_mod.ModelStore(tmp_path))
+    data = {"role_id": "Master", "roi_id": "Pattern", "mm_per_px": "0.25", "memory_fit": "true"}
+
+    files = [("images", (f"ok{i}.png", _png_bytes(), "image/png")) for i in range(2)]
+    first = client.post("/fit_ok", data=data, files=files)
+    assert first.status_code == 200, first.text
+    assert first.json()["coreset_size"] == 8
+
+    files = [("images", ("ok2.png", _png_bytes(), "image/png"))]
+    second = client.post("/fit_ok", data={**data, "append": "true"}, files=files)
+    assert second.status_code == 200, second.text
+    body = second.json()
+    assert body["appended"] is True
+    assert body["n_embeddings"] == 4
+    assert body["n_embeddings_total"] == 12
+    assert body["coreset_size"] == 12
+
+    emb, token_hw, meta = app_mod.store.load_memory("Master", "Pattern")
+    assert emb.shape == (12, 8) and token_hw == (2, 2)
+    assert meta["n_embeddings"] == 12
+
+    # append amplía con el método de coreset de la memoria aunque la config cambie
+    monkeypatch.setitem(app_mod.SETTINGS.setdefault("inference", {}), "coreset_method", "approx")
+    third = client.post("/fit_ok", data={**data, "append": "true"}, files=files)
+    assert third.status_code == 200, third.text
+    assert app_mod.store.load_memory("Master", "Pattern")[2]["coreset_method"] == meta["coreset_method"] == "exact"
+
+
+def test_fit_ok_projection_is_persisted_and_reused_on_append(tmp_path, monkeypatch):
+    client = TestClient(app_mod.app)
+    rng = np.random.default_rng(1)
+
+    class RandomExtractor:
+        def extract_batch(self, images, batch_size=8):
+            return [(rng.standard_normal((16, 8)).astype(np.float32), (4, 4)) for _ in images]
+
+    monkeypatch.setattr(app_mod, "_extractor", RandomExtractor())
+    monkeypatch.setattr(app_mod, "store", app_mod.ModelStore(tmp_path))
+    data = {"role_id": "Master", "roi_id": "Pattern", "mm_per_px": "0.25", "projection": "pca", "projection_dim": "4"}
+
+    files = [("images", (f"ok{i}.png", _png_bytes(), "image/png")) for i in range(3)]
+    first = client.post("/fit_ok", data=data, files=files)
+    assert first.status_code == 200, first.text
+    body = first.json()
+    assert body["projection"] == "pca" and body["projection_dim"] == 4
+    assert 0.0 < body["projection_retained_variance"] <= 1.0
+
+    files = [("images", ("ok3.png", _png_bytes(), "image/png"))]
+    second = client.post("/fit_ok", data={**data, "append": "true", "projection": "random"}, files=files)
+    assert second.status_code == 200, second.text
+    assert second.json()["projection"] == "pca"
+
+    mem, token_hw, _ = app_mod._build_patchcore("Master", "Pattern")
+    assert mem.emb.shape[1] == 4 and mem.input_dim == 8
+    assert mem.knn_min_dist(rng.standard_normal((16, 8)).astype(np.float32)).shape == (16,)
+
+    bad = client.post("/fit_ok", data={**data, "projection": "svd"}, files=files)
+    assert bad.status_code == 400
+    bad = client.post("/fit_ok", data={**data, "shape": "{kind: annulus"}, files=files)
+    assert bad.status_code == 400
+
+
+def test_infer_batch_single_forward_and_grouped_knn(monkeypatch):
+    client = TestClient(app_mod.app)
+    batches = []
+    knn_calls = []
+
+    class BatchExtractor:
+        def extract_batch(self, images, batch_size=8):
+            batches.append(len(images))
+            return [(np.full((4, 3), i, dtype=np.float32), (2, 2)) for i in range(len(images))]
+
+    class FakeMemory:
+        coreset_rate = 0.1
+
+        def knn_min_dist(self, query):
+            knn_calls.append(query.shape[0])
+            return query[:, 0].copy()
+
+    class EchoEngine:
+        def __init__(self, extractor, memory, token_hw, mm_per_px=0.2):
+            pass
+
+        def run(self, img, **kwargs):
+            return {"score": float(kwargs["distances"].max()), "regions": [], "token_shape": [2, 2]}
+
+    memories = {("Master", "A"): (FakeMemory(), (2, 2), {}), ("Master", "B"): (FakeMemory(), (2, 2), {})}
+    monkeypatch.setattr(app_mod, "_extractor", BatchExtractor())
+    monkeypatch.setattr(app_mod, "InferenceEngine", EchoEngine)
+    monkeypatch.setattr(app_mod, "_load_patchcore", lambda role, roi: memories.get((role, roi)))
+    monkeypatch.setattr(app_mod, "_load_calib", lambda role, roi: {"threshold": 1.5})
+
+    items = [
+        {"role_id": "Master", "roi_id": "A", "mm_per_px": 0.2},
+        {"role_id": "Master", "roi_id": "B", "mm_per_px": 0.2},
+        {"role_id": "Master", "roi_id": "A", "mm_per_px": 0.2},
+        {"role_id": "Master", "roi_id": "Missing", "mm_per_px": 0.2},
+    ]
+    files = [("images", (f"roi{i}.png", _png_bytes(), "image/png")) for i in range(len(items))]
+    resp = client.post("/infer_batch", data={"items": json.dumps(items)}, files=files)
+    assert resp.status_code == 200, resp.text
+    results = resp.json()["results"]
+
+    assert batches == [4]
+    assert sorted(knn_calls) == [4, 8]  # una consulta por memoria (A agrupa dos ROIs)
+    assert [r["score"] for r in results[:3]] == [0.0, 1.0, 2.0]
+    assert results[0]["threshold"] == 1.5
+    assert "error" in results[3]
+
+
+def test_infer_batch_rejects_non_object_items(monkeypatch):
+    client = TestClient(app_mod.app)
+    monkeypatch.setattr(app_mod, "_extractor", SimpleNamespace())
+    files = [("images", (f"roi{i}.png", _png_bytes(), "image/png")) for i in range(2)]
+    for items in ([1, 2], [{"role_id": "Master", "roi_id": "A"}, "B"]):
+        resp = client.post("/infer_batch", data={"items": json.dumps(items)}, files=files)
+        assert resp.status_code == 400
+        assert "debe ser un objeto" in resp.json()["error"]
+
+
+def test_infer_frame_crops_rois_on_server(monkeypatch):
+    client = TestClient(app_mod.app)
+    seen = []
+
+    def fake_run_items(imgs, items, **_):
+        seen.extend(zip([img.shape for img in imgs], items))
+        return [{"index": i, "score": 0.0} for i in range(len(items))]
+
+    monkeypatch.setattr(app_mod, "_run_infer_items", fake_run_items)
+    rois = [
+        {"role_id": "Master", "roi_id": "A", "kind": "square", "cx": 16, "cy": 12, "w": 10, "h": 8},
+        {"role_id": "Master", "roi_id": "B", "kind": "circle", "cx": 12, "cy": 12, "r": 6, "mm_per_px": 0.1},
+    ]
+    files = {"image": ("frame.png", _png_bytes(), "image/png")}
+    resp = client.post("/infer_frame", data={"rois": json.dumps(rois), "mm_per_px": "0.25"}, files=files)
+    assert resp.status_code == 200, resp.text
+
+    (shape_a, item_a), (shape_b, item_b) = seen
+    assert shape_a == (8, 10, 3) and item_a["shape"] is None and item_a["mm_per_px"] == 0.25
+    assert shape_b == (12, 12, 3) and item_b["shape"]["kind"] == "circle" and item_b["mm_per_px"] == 0.1
+    assert resp.json()["results"][1]["roi_size"] == [12, 12]
+
+    resp = client.post("/infer_frame", data={"rois": json.dumps([rois[0], 3]), "mm_per_px": "0.25"}, files=files)
+    assert resp.status_code == 400 and "rois[1]" in resp.json()["error"]
+
+
+def _setup_heatmap_infer(tmp_path, monkeypatch, score):
+    seen = []
+
+    class Extractor:
+        def extract_batch(self, images, batch_size=8):
+            return [(np.ones((4, 4), dtype=np.float32), (2, 2)) for _ in images]
+
+    class HeatmapEngine:
+        def __init__(self, extractor, memory, token_hw, mm_per_px=0.2):
+            pass
+
+        def run(self, img, **kwargs):
+            seen.append(kwargs["heatmap"])
+            return {
+                "score": score,
+                "regions": [],
+                "token_shape": [2, 2],
+                "heatmap_u8": np.full((24, 32), 7, dtype=np.uint8) if kwargs["heatmap"] != "tokens" else None,
+                "heatmap_tokens_u8": np.arange(4, dtype=np.uint8).reshape(2, 2),
+            }
+
+    store = app_mod.ModelStore(tmp_path)
+    store.save_memory("Master", "Pattern", np.ones((2, 4), dtype=np.float32), (2, 2))
+    store.save_calib("Master", "Pattern", {"threshold": 1.0})
+    monkeypatch.setattr(app_mod, "_extractor", Extractor())
+    monkeypatch.setattr(app_mod, "InferenceEngine", HeatmapEngine)
+    monkeypatch.setattr(app_mod, "store", store)
+    app_mod.memory_cache.clear()
+    return seen
+
+
+def _post_infer(client, **extra):
+    files = {"image": ("roi.png", _png_bytes(), "image/png")}
+    data = {"role_id": "Master", "roi_id": "Pattern", "mm_per_px": "0.25", **extra}
+    return client.post("/infer", data=data, files=files)
+
+
+def test_infer_heatmap_modes(tmp_path, monkeypatch):
+    client = TestClient(app_mod.app)
+    seen = _setup_heatmap_infer(tmp_path, monkeypatch, score=0.5)
+
+    legacy = _post_infer(client).json()
+    assert legacy["heatmap_png_base64"]
+
+    tokens = _post_infer(client, heatmap="tokens").json()
+    assert tokens["heatmap_png_base64"] is None
+    assert tokens["heatmap_tokens"]["shape"] == [2, 2]
+    raw = base64.b64decode(tokens["heatmap_tokens"]["data_base64"])
+    assert list(raw) == [0, 1, 2, 3]
+
+    assert _post_infer(client, heatmap="none").json()["heatmap_png_base64"] is None
+    # score 0.5 < threshold 1.0 → pieza OK, sin heatmap
+    assert _post_infer(client, heatmap="on_fail").json()["heatmap_png_base64"] is None
+    assert seen == ["full", "tokens", "none", "on_fail"]
+
+    assert _post_infer(client, heatmap="jpeg").status_code == 400
+    assert _post_infer(client, response_format="xml").status_code == 400
+
+
+def test_infer_rejects_malformed_shape(tmp_path, monkeypatch):
+    client = TestClient(app_mod.app)
+    _setup_heatmap_infer(tmp_path, monkeypatch, score=0.5)
+
+    resp = _post_infer(client, shape='{"kind": "circle",')
+    assert resp.status_code == 400
+    assert "shape" in resp.json()["error"]
+
+
+def test_infer_msgpack_response_has_raw_bytes(tmp_path, monkeypatch):
+    msgpack = pytest.importorskip("msgpack")
+    client = TestClient(app_mod.app)
+    _setup_heatmap_infer(tmp_path, monkeypatch, score=2.0)
+
+    resp = _post_infer(client, heatmap="on_fail", response_format="msgpack")
+    assert resp.status_code == 200, resp.text
+    assert resp.headers["content-type"] == "application/x-msgpack"
+    body = msgpack.unpackb(resp.content)
+    assert body["score"] == 2.0 and "heatmap_png_base64" not in body
+    assert body["heatmap_png"].startswith(b"\x89PNG")
+
+    monkeypatch.setattr(app_mod, "msgpack", None)
+    assert _post_infer(client, response_format="msgpack").status_code == 400
+
+
+def test_infer_batch_uses_scheduler_when_extractor_supports_it(monkeypatch):
+    client = TestClient(app_mod.app)
+
+    class SchedExtractor:
+        def __init__(self):
+            self.forwards = []
+
+        def preprocess(self, image):
+            return np.zeros((1, 3, 28, 28), dtype=np.float32)
+
+        def forward_preprocessed(self, xs):
+            self.forwards.append(len(xs))
+            return [(np.zeros((4, 3), dtype=np.float32), (2, 2)) for _ in xs]
+
+    class FakeMemory:
+        coreset_rate = 0.1
+
+        def knn_min_dist(self, query):
+            return np.zeros(query.shape[0], dtype=np.float32)
+
+    class EchoEngine:
+        def __init__(self, extractor, memory, token_hw, mm_per_px=0.2):
+            pass
+
+        def run(self, img, **kwargs):
+            return {"score": 0.0, "regions": [], "token_shape": [2, 2]}
+
+    ext = SchedExtractor()
+    monkeypatch.setattr(app_mod, "_extractor", ext)
+    monkeypatch.setattr(app_mod, "InferenceEngine", EchoEngine)
+    monkeypatch.setattr(app_mod, "_load_patchcore", lambda role, roi: (FakeMemory(), (2, 2), {}))
+    monkeypatch.setattr(app_mod, "_load_calib", lambda role, roi: None)
+
+    items = [{"role_id": "Master", "roi_id": "A"}] * 3
+    files = [("images", (f"roi{i}.png", _png_bytes(), "image/png")) for i in range(3)]
+    resp = client.post("/infer_batch", data={"items": json.dumps(items)}, files=files)
+    assert resp.status_code == 200, resp.text
+    assert [r["score"] for r in resp.json()["results"]] == [0.0, 0.0, 0.0]
+    assert sum(ext.forwards) == 3
+
+    sched = client.get("/health").json()["scheduler"]
+    assert sched["items"] >= 3
+
+
+
+def test_calibrate_ng_fits_cascade_accept_from_paired_scores(tmp_path, monkeypatch):
+    client = TestClient(app_mod.app)
+    monkeypatch.setattr(app_mod, "MODELS_DIR", tmp_path)
+    monkeypatch.setattr(app_mod, "store", app_mod.ModelStore(tmp_path))
+
+    ok_cascade = [1.0, 1.2, 1.4, 1.6, 1.8, 2.0]
+    payload = {
+        "role_id": "Master",
+        "roi_id": "Pattern",
+        "ok_scores": [2.0 * c + 0.5 for c in ok_cascade],   # score completo ≈ 2·cascade + 0.5
+        "ng_scores": [8.5],
+        "ok_cascade_scores": ok_cascade,
+        "ng_cascade_scores": [4.0],
+    }
+    body = client.post("/calibrate_ng", json=payload).json()
+    assert body["cascade_slope"] == pytest.approx(2.0, rel=1e-3)
+    assert body["cascade_accept"] < 4.0 * 0.95                    # ningún NG de calibración aceptado
+    assert 2.0 * body["cascade_accept"] + 0.5 < body["threshold"]  # aceptados siempre bajo el umbral
+
+    payload["ok_cascade_scores"] = ok_cascade[:-1]
+    assert client.post("/calibrate_ng", json=payload).status_code == 400
+
+    # NG sin sus cascade scores: no se ajusta el margen sólo con OKs
+    payload["ok_cascade_scores"] = ok_cascade
+    del payload["ng_cascade_scores"]
+    resp = client.post("/calibrate_ng", json=payload)
+    assert resp.status_code == 400 and "ng_cascade_scores" in resp.json()["error"]
+
+
+def test_infer_batch_cascade_accepts_clear_ok_without_full_forward(monkeypatch):
+    client = TestClient(app_mod.app)
+    full_batches, low_batches = [], []
+
+    class LowExtractor:
+        input_size = 112
+
+        def extract_batch(self, images, batch_size=8):
+            low_batches.append(len(images))
+            return [(np.full((1, 3), i, dtype=np.float32), (1, 1)) for i in range(len(images))]
+
+    class FullExtractor:
+        def extract_batch(self, images, batch_size=8):
+            full_batches.append(len(images))
+            return [(np.full((4, 3), 10.0, dtype=np.float32), (2, 2)) for _ in images]
+
+        def with_input_size(self, size):
+            return LowExtractor()
+
+    class FakeMemory:
+        coreset_rate = 0.1
+
+        def knn_min_dist(self, query):
+            return query[:, 0].copy()
+
+    class EchoEngine:
+        def __init__(self, extractor, memory, token_hw, mm_per_px=0.2):
+            pass
+
+        def run(self, img, **kwargs):
+            return {"score": float(kwargs["distances"].max()), "regions": [], "token_shape": [2, 2]}
+
+        def screen(self, img, **kwargs):
+            return float(kwargs["embeddings"][0, 0])
+
+    memories = {
+        ("Master", "A"): (FakeMemory(), (2, 2), {}),
+        ("Master", "A::cascade"): (FakeMemory(), (1, 1), {}),
+    }
+    calib = {"threshold": 5.0, "cascade_accept": 0.5, "cascade_slope": 2.0, "cascade_intercept": 1.0}
+    monkeypatch.setattr(app_mod, "_extractor", FullExtractor())
+    monkeypatch.setattr(app_mod, "_cascade", None)
+    monkeypatch.setitem(app_mod.SETTINGS.setdefault("inference", {}), "cascade", True)
+    monkeypatch.setattr(app_mod, "InferenceEngine", EchoEngine)
+    monkeypatch.setattr(app_mod, "_load_patchcore", lambda role, roi: memories.get((role, roi)))
+    monkeypatch.setattr(app_mod, "_load_calib", lambda role, roi: calib)
+
+    items = [{"role_id": "Master", "roi_id": "A"}] * 2
+    files = [("images", (f"roi{i}.png", _png_bytes(), "image/png")) for i in range(2)]
+    resp = client.post("/infer_batch", data={"items": json.dumps(items)}, files=files)
+    assert resp.status_code == 200, resp.text
+    first, second = resp.json()["results"]
+
+    assert low_batches == [2] and full_batches == [1]   # sólo la pieza dudosa pasa por la pasada completa
+    assert first["stage"] == "cascade" and first["cascade_score"] == 0.0
+    assert first["score"] == 1.0 and first["regions"] == []  # score estimado (slope·c + intercept)
+    assert second["stage"] == "full" and second["cascade_score"] == 1.0 and second["score"] == 10.0
+
+
+def test_metrics_endpoint_exposes_stage_histograms(tmp_path, monkeypatch):
+    client = TestClient(app_mod.app)
+    _setup_heatmap_infer(tmp_path, monkeypatch, score=0.5)
+    app_mod.metrics_registry.clear()
+
+    assert _post_infer(client).status_code == 200
+    resp = client.get("/metrics")
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/plain")
+    text = resp.text
+    assert 'bdi_request_seconds_count{endpoint="/infer"} 1' in text
+    assert 'bdi_requests_total{endpoint="/infer",code="200"} 1' in text
+    assert 'bdi_stage_seconds_count{endpoint="/infer",stage="decode"} 1' in text
+    # el PNG del heatmap se codifica dentro del ámbito del ROI
+    assert 'bdi_roi_stage_seconds_count{role_id="Master",roi_id="Pattern",stage="encode"} 1' in text
+    assert "# TYPE bdi_cache_entries gauge" in text
+    assert "# TYPE bdi_cache_hits_total counter" in text and "# TYPE bdi_cache_stale_total counter" in text
+    assert "bdi_cache_evictions_total" in text
+
+
+def test_requests_wait_for_startup_and_return_503_while_loading(monkeypatch):
+    client = TestClient(app_mod.app)
+    gate = app_mod.threading.Event()
+    st = app_mod.Startup()
+    monkeypatch.setattr(app_mod, "startup", st)
+    monkeypatch.setattr(app_mod, "_extractor", None)
+    monkeypatch.setitem(app_mod.SETTINGS, "startup", {"request_wait_s": 0.05})
+    st.start([("loading", lambda: gate.wait(5))])
+
+    health = client.get("/health").json()
+    assert health["status"] == "ok" and health["ready"] is False
+    assert health["startup"]["state"] == "loading"
+
+    resp = _post_infer(client)
+    assert resp.status_code == 503
+    assert resp.json()["startup"]["state"] == "loading"
+    gate.set()
+    assert st.wait(5)
+
+
+def test_failed_startup_reports_unhealthy_and_retries_after_backoff(monkeypatch):
+    client = TestClient(app_mod.app)
+    st = app_mod.Startup()
+    attempts = []
+
+    def load():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise OSError("weights.safetensors ilegible")
+        app_mod._extractor = SimpleNamespace()
+
+    monkeypatch.setattr(app_mod, "startup", st)
+    monkeypatch.setattr(app_mod, "_extractor", None)
+    monkeypatch.setattr(app_mod, "_load_extractor", load)
+    monkeypatch.setattr(app_mod, "_warmup", lambda: None)
+    monkeypatch.setattr(app_mod, "_preload", lambda: None)
+    monkeypatch.setitem(app_mod.SETTINGS, "startup", {"background": False, "request_wait_s": 0.05, "retry_s": 60.0})
+    app_mod.start_background()
+
+    health = client.get("/health")
+    assert health.status_code == 503 and health.json()["status"] == "error"
+    resp = _post_infer(client)
+    assert resp.status_code == 503 and 55 <= int(resp.headers["Retry-After"]) <= 60
+    assert len(attempts) == 1
+
+    # pasado el backoff la siguiente petición vuelve a cargar el modelo
+    app_mod.SETTINGS["startup"]["retry_s"] = 0.0
+    assert _post_infer(client).status_code != 503
+    assert len(attempts) == 2
+    health = client.get("/health")
+    assert health.status_code == 200 and health.json()["ready"] is True
+
+
+def test_prepare_for_fork_loads_weights_without_warmup(monkeypatch):
+    calls = []
+    monkeypatch.setitem(app_mod.SETTINGS, "extractor", {"backend": "torch"})
+    monkeypatch.setattr(app_mod, "_extractor", None)
+    monkeypatch.setattr(app_mod, "_scheduler", None)
+    monkeypatch.setattr(app_mod, "_build_extractor", lambda: calls.append("load") or SimpleNamespace(model=None))
+    monkeypatch.setattr(app_mod, "_warmup", lambda: calls.append("warmup"))
+
+    app_mod.prepare_for_fork()
+    # el warm-up (primer forward, pool de hilos) queda para cada worker
+    assert calls == ["load"] and app_mod._extractor is not None
+
+
+def test_loading_memory_warns_when_preprocess_mode_differs(tmp_path, monkeypatch, caplog):
+    store = app_mod.ModelStore(tmp_path)
+    emb = np.ones((2, 4), dtype=np.float32)
+    # bundle anterior a extractor.preprocess (sin la clave): se construyó con la ruta PIL
+    store.save_bundle("Master", "Old", emb, (1, 2), extractor={"model_name": "vit"})
+    store.save_bundle("Master", "New", emb, (1, 2), extractor={"model_name": "vit", "preprocess": "cv2"})
+    monkeypatch.setattr(app_mod, "store", store)
+    monkeypatch.setattr(app_mod, "_extractor", SimpleNamespace(preprocess_mode="cv2"))
+
+    with caplog.at_level("WARNING", logger=app_mod.log.name):
+        assert app_mod._build_patchcore("Master", "New") is not None
+        assert not caplog.records
+        assert app_mod._build_patchcore("Master", "Old") is not None
+    assert "preprocess=pil" in caplog.text and "Master/Old" in caplog.text
@@ -0,0 +1,41 @@
+import json
+
+from backend.bench import CASES, SCHEMA_VERSION, BenchConfig, run_suite
+from backend.bench.suite import compare
+
+# Sin el extractor (test_app_fastapi sustituye backend.features por un stub)
+_TINY = BenchConfig(
+    input_size=56, roi_size=(40, 48), dim=16, coreset_n=256, bank_sizes=(128,), repeat=2, warmup=0,
+    skip=("preprocess", "extract", "extract_batch"),
+)
+
+
+def test_report_schema_is_stable():
+    report = run_suite(_TINY)
+    assert report["schema_version"] == SCHEMA_VERSION
+    assert set(report) == {"schema_version", "created_at", "git_commit", "env", "config", "results"}
+    json.dumps(report)  # serializable tal cual
+
+    results = report["results"]
+    # cada caso aparece, en orden, aunque se omita o falle
+    names = [r["name"] for r in results]
+    assert sorted(set(names), key=CASES.index) == list(CASES)
+    assert names == sorted(names, key=CASES.index)
+    keys = set(results[0])
+    assert all(set(r) == keys for r in results)
+
+    by_name = {r["name"]: r for r in results}
+    assert by_name["extract"]["ok"] is False and by_name["extract"]["error"] == "skipped"
+    for name in ("kcenter_greedy", "approx_kcenter_greedy", "knn_min_dist_sklearn", "store_save", "store_load"):
+        assert by_name[name]["ok"], by_name[name]
+        assert by_name[name]["repeat"] == 2 and by_name[name]["median_ms"] >= 0.0
+
+
+def test_compare_flags_only_slower_matching_cases():
+    def report(ms, bank=128):
+        return {"results": [{"name": "knn_min_dist_sklearn", "params": {"bank": bank}, "ok": True, "median_ms": ms}]}
+
+    assert compare(report(10.0), report(11.0), tolerance=0.15) == []
+    slow = compare(report(10.0), report(13.0), tolerance=0.15)
+    assert len(slow) == 1 and abs(slow[0]["ratio"] - 1.3) < 1e-9
+    assert compare(report(10.0), report(50.0, bank=256)) == []
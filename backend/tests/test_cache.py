@@ -0,0 +1,96 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+from backend.cache import MemoryCache
+from backend.storage import ModelStore
+
+
+def _entry(n_rows: int):
+    mem = SimpleNamespace(emb=np.zeros((n_rows, 4), dtype=np.float32), index=None)
+    return mem, (2, 2), {}
+
+
+def test_memory_cache_hits_and_lru_eviction():
+    cache = MemoryCache(max_bytes=2 * 10 * 4 * 4)  # cabe justo para dos memorias de 10x4
+    loads = []
+
+    def loader(name):
+        def _load():
+            loads.append(name)
+            return _entry(10)
+        return _load
+
+    cache.get_memory("r", "a", loader("a"))
+    cache.get_memory("r", "b", loader("b"))
+    cache.get_memory("r", "a", loader("a"))  # hit, "a" pasa a ser la más reciente
+    cache.get_memory("r", "c", loader("c"))  # expulsa "b"
+    cache.get_memory("r", "a", loader("a"))  # hit
+
+    stats = cache.stats()
+    assert loads == ["a", "b", "c"]
+    assert stats["hits"] == 2
+    assert stats["misses"] == 3
+    assert stats["evictions"] == 1
+    assert stats["entries"] == 2
+    assert stats["bytes"] <= stats["max_bytes"]
+
+
+def test_memory_cache_invalidate_and_missing_entries():
+    cache = MemoryCache(max_bytes=1 << 20)
+    calls = []
+
+    def load_calib():
+        calls.append(1)
+        return {"threshold": 1.5}
+
+    assert cache.get_calib("r", "a", load_calib)["threshold"] == 1.5
+    assert cache.get_calib("r", "a", load_calib)["threshold"] == 1.5
+    cache.invalidate("r", "a", kind="calib")
+    cache.get_calib("r", "a", load_calib)
+    assert len(calls) == 2
+
+    # Sin stamp las ausencias no se cachean: tras /fit_ok la memoria debe aparecer
+    assert cache.get_memory("r", "missing", lambda: None) is None
+    assert cache.get_memory("r", "missing", lambda: _entry(1)) is not None
+
+
+def test_memory_cache_reloads_when_store_stamp_changes(tmp_path):
+    # Worker A del pool con su propia caché; otro proceso escribe en el mismo directorio
+    store = ModelStore(tmp_path)
+    store.save_memory("r", "a", np.zeros((2, 4), dtype=np.float32), (1, 2))
+    worker_a = MemoryCache(max_bytes=1 << 20)
+
+    def load():
+        return store.load_memory("r", "a")
+
+    first = worker_a.get_memory("r", "a", load, stamp=store.stamp("r", "a"))
+    assert worker_a.get_memory("r", "a", load, stamp=store.stamp("r", "a")) is first
+
+    # Otro worker reentrena el ROI: A lo ve en su siguiente consulta
+    store.save_memory("r", "a", np.ones((3, 4), dtype=np.float32), (1, 3))
+    emb, token_hw, _ = worker_a.get_memory("r", "a", load, stamp=store.stamp("r", "a"))
+    assert emb.shape == (3, 4) and token_hw == (1, 3)
+    assert worker_a.stats()["stale"] == 1
+
+    store.save_calib("r", "a", {"threshold": 2.0})
+    assert worker_a.get_calib("r", "a", lambda: store.load_calib("r", "a"), stamp=store.stamp("r", "a"))["threshold"] == 2.0
+
+
+def test_memory_cache_keeps_absences_until_the_stamp_changes(tmp_path):
+    store = ModelStore(tmp_path)
+    cache = MemoryCache(max_bytes=1 << 20)
+    calls = []
+
+    def load_calib():
+        calls.append(1)
+        return store.load_calib("r", "a", default=None)
+
+    # ROI aún sin calibrar: un único acceso a disco mientras no cambie nada
+    assert cache.get_calib("r", "a", load_calib, stamp=store.stamp("r", "a")) is None
+    assert cache.get_calib("r", "a", load_calib, stamp=store.stamp("r", "a")) is None
+    assert len(calls) == 1 and cache.stats()["hits"] == 1
+
+    store.save_calib("r", "a", {"threshold": 3.0})
+    assert cache.get_calib("r", "a", load_calib, stamp=store.stamp("r", "a"))["threshold"] == 3.0
+    assert len(calls) == 2
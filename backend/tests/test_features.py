@@ -0,0 +1,255 @@
+import importlib.util
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+timm = pytest.importorskip("timm")
+
+
+def _load_features_module():
+    # test_app_fastapi sustituye backend.features por un stub: cargamos el módulo real por ruta
+    path = Path(__file__).resolve().parents[1] / "features.py"
+    spec = importlib.util.spec_from_file_location("_bdi_features_real", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope="module")
+def extractor():
+    features = _load_features_module()
+    create_model = timm.create_model
+
+    def _offline_create_model(name, pretrained=False, **kwargs):
+        torch.manual_seed(0)
+        return create_model(name, pretrained=False, **kwargs)
+
+    features.timm.create_model = _offline_create_model
+    try:
+        yield features.DinoV2Features(device="cpu", input_size=112, patch_size=14, preprocess="cv2")
+    finally:
+        features.timm.create_model = create_model
+
+
+def _images():
+    rng = np.random.default_rng(0)
+    return [
+        rng.integers(0, 256, size=(60, 80, 3), dtype=np.uint8),
+        rng.integers(0, 256, size=(90, 90, 3), dtype=np.uint8),
+        rng.integers(0, 256, size=(50, 40, 3), dtype=np.uint8),
+    ]
+
+
+def test_extract_batch_matches_single_extract(extractor):
+    imgs = _images()
+    batched = extractor.extract_batch(imgs, batch_size=2)
+    assert len(batched) == len(imgs)
+    for img, (emb_b, hw_b) in zip(imgs, batched):
+        emb, hw = extractor.extract(img)
+        assert hw_b == hw == (8, 8)
+        assert emb_b.shape == emb.shape == (64, 3 * 384)
+        np.testing.assert_allclose(emb_b, emb, rtol=1e-4, atol=1e-4)
+
+
+def test_cached_pos_embed_forward_matches_timm_and_keeps_model_intact(extractor):
+    img = _images()[0]
+    pos_before = extractor.model.pos_embed.detach().clone()
+
+    emb, hw = extractor.extract(img)
+    extractor.extract(img)
+    assert list(extractor._pos_cache) == [hw]
+    assert torch.equal(extractor.model.pos_embed, pos_before)
+
+    # Referencia: ruta legacy de timm (reset del pos_embed en el modelo + get_intermediate_layers)
+    with torch.inference_mode():
+        x = extractor._preprocess(img)
+        x, _ = extractor._prepare_input_size(extractor.model, x)
+        layers = extractor.model.get_intermediate_layers(x, extractor.out_indices)
+        ref = torch.cat(list(layers), dim=-1)[0].float().numpy()
+    np.testing.assert_allclose(emb, ref, rtol=1e-4, atol=1e-4)
+
+
+def _natural_images():
+    # Imágenes suaves (no ruido puro): así la diferencia cv2/PIL refleja la interpolación
+    rng = np.random.default_rng(1)
+    out = []
+    for h, w in [(60, 80), (300, 200), (112, 112)]:
+        yy, xx = np.mgrid[0:h, 0:w]
+        base = np.stack([xx * 255.0 / w, yy * 255.0 / h, (xx + yy) * 127.0 / (h + w)], axis=-1)
+        out.append(np.clip(base + rng.normal(0, 4, size=base.shape), 0, 255).astype(np.uint8))
+    return out
+
+
+def test_cv2_preprocess_matches_pil_path(extractor):
+    if extractor.preprocess_mode != "cv2":
+        pytest.skip("OpenCV real no disponible")
+    with torch.inference_mode():
+        # wide -> tall -> cuadrada: el lienzo reutilizado debe limpiar el padding al cambiar la caja
+        for img in _natural_images():
+            x_cv2 = extractor._preprocess_cv2(img)
+            x_pil = extractor._preprocess_pil(img)
+            assert x_cv2.shape == x_pil.shape == (1, 3, 112, 112)
+            # en unidades de nivel de gris (0..255)
+            diff = ((x_cv2 - x_pil) * extractor.std * 255.0).abs()
+            assert float(diff.mean()) < 1.5
+            assert float(diff.max()) < 40.0
+
+            emb_cv2 = extractor.forward_preprocessed(x_cv2)[0][0]
+            emb_pil = extractor.forward_preprocessed(x_pil)[0][0]
+            cos = (emb_cv2 * emb_pil).sum(1) / (np.linalg.norm(emb_cv2, axis=1) * np.linalg.norm(emb_pil, axis=1))
+            assert float(cos.mean()) > 0.99
+
+
+def test_local_weights_file_roundtrip(extractor, tmp_path):
+    features = _load_features_module()
+    path = tmp_path / "vits14.safetensors"
+    extractor.save_weights(str(path))
+
+    loaded = features.DinoV2Features(device="cpu", input_size=112, patch_size=14, weights=str(path), preprocess="cv2")
+    img = _images()[0]
+    np.testing.assert_allclose(loaded.extract(img)[0], extractor.extract(img)[0], rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("precision,min_cos", [("bf16", 0.99), ("int8", 0.99)])
+def test_reduced_precision_modes_track_fp32(extractor, tmp_path, precision, min_cos):
+    features = _load_features_module()
+    path = tmp_path / "vits14.safetensors"
+    extractor.save_weights(str(path))
+    reduced = features.DinoV2Features(
+        device="cpu", input_size=112, patch_size=14, weights=str(path), precision=precision, preprocess="cv2"
+    )
+    assert reduced.get_metadata()["precision"] == precision
+
+    img = _images()[1]
+    emb_ref, hw_ref = extractor.extract(img)
+    emb, hw = reduced.extract(img)
+    assert hw == hw_ref and emb.dtype == np.float32
+    cos = (emb * emb_ref).sum(1) / (np.linalg.norm(emb, axis=1) * np.linalg.norm(emb_ref, axis=1))
+    assert float(cos.min()) > min_cos
+
+
+def test_invalid_precision_is_rejected():
+    features = _load_features_module()
+    with pytest.raises(ValueError):
+        features.DinoV2Features(device="cpu", input_size=112, patch_size=14, pretrained=False, precision="fp8")
+
+
+def test_precision_parity_report(extractor):
+    pytest.importorskip("cv2")
+    from backend.bench.parity import precision_parity
+
+    imgs = _natural_images() + _images()
+    report = precision_parity(imgs, ("bf16",), reference=extractor, threshold=1e9, repeat=1)
+    assert report["memory"] == "split" and report["n_eval"] == 3
+    r = report["modes"]["bf16"]
+    assert r["decision_flips"] == 0 and r["distance"]["pearson"] > 0.99
+    assert r["ok"] and len(r["scores"]) == 3
+
+
+def test_precision_parity_rejects_grid_mismatch(extractor):
+    pytest.importorskip("cv2")
+    from backend.bench.parity import precision_parity
+    from backend.patchcore import PatchCoreMemory
+
+    mem = PatchCoreMemory.build(np.random.default_rng(0).normal(size=(64, 8)).astype(np.float32), coreset_rate=1.0)
+    with pytest.raises(ValueError, match="Grid de tokens"):
+        precision_parity(_images(), ("bf16",), reference=extractor, memory=(mem, (16, 16)), repeat=1)
+
+
+def test_onnx_export_matches_eager(extractor, tmp_path, monkeypatch):
+    pytest.importorskip("onnx")
+    pytest.importorskip("onnxruntime")
+    # onnx_features hereda de DinoV2Features: se carga contra el módulo real, no el stub
+    monkeypatch.setitem(__import__("sys").modules, "backend.features", _load_features_module())
+    path = Path(__file__).resolve().parents[1] / "onnx_features.py"
+    spec = importlib.util.spec_from_file_location("backend._bdi_onnx_features_real", path)
+    onnx_features = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(onnx_features)
+
+    out = tmp_path / "dinov2_112.onnx"
+    meta = onnx_features.export_onnx(extractor, out)
+    assert out.exists() and onnx_features.metadata_path(out).exists()
+    assert meta["input_size"] == 112 and meta["token_hw"] == [8, 8]
+
+    ort_ext = onnx_features.OnnxDinoV2Features(str(out), input_size=112, intra_op_threads=1, preprocess="cv2")
+    assert ort_ext.get_metadata()["backend"] == "onnx"
+    report = onnx_features.check_parity(extractor, ort_ext, _images())
+    assert report["max_abs"] < 1e-3 and report["cos_min"] > 0.9999
+
+    batch = ort_ext.extract_batch(_images())
+    assert [hw for _, hw in batch] == [(8, 8)] * len(_images())
+
+    with pytest.raises(ValueError):
+        onnx_features.OnnxDinoV2Features(str(out), input_size=224)
+
+
+def test_token_pruning_keeps_only_patches_inside_the_roi_shape(extractor, tmp_path):
+    pytest.importorskip("cv2")
+    features = _load_features_module()
+    path = tmp_path / "vits14.safetensors"
+    extractor.save_weights(str(path))
+    pruned = features.DinoV2Features(
+        device="cpu", input_size=112, patch_size=14, weights=str(path), token_pruning=True, preprocess="cv2"
+    )
+    assert pruned.get_metadata()["token_pruning"] is True
+
+    img = _images()[1]  # 90x90: el ROI llena el lienzo
+    ring = {"kind": "annulus", "cx": 45, "cy": 45, "r": 45, "r_inner": 25}
+    keep = pruned.patch_keep_list(img.shape[:2], ring)
+    assert keep is not None and 0.3 < keep.mean() < 0.9
+    assert pruned.patch_keep_list(img.shape[:2], None) is None  # nada que podar
+
+    emb, hw = pruned.extract(img, shape=ring)
+    assert hw == (8, 8) and emb.shape[0] == 64
+    assert np.all(emb[~keep] == 0.0) and np.all(np.linalg.norm(emb[keep], axis=1) > 0)
+    # sin poda efectiva coincide con el extractor normal
+    np.testing.assert_allclose(pruned.extract(img)[0], extractor.extract(img)[0], rtol=1e-5, atol=1e-5)
+
+    # extract_batch agrupa por keep-list y da lo mismo que imagen a imagen
+    imgs = [img, img, _images()[0]]
+    shapes = [ring, None, None]
+    batch = pruned.extract_batch(imgs, shapes=shapes)
+    for (b, bhw), im, sh in zip(batch, imgs, shapes):
+        single, shw = pruned.extract(im, shape=sh)
+        assert bhw == shw
+        np.testing.assert_allclose(b, single, rtol=1e-4, atol=1e-4)
+
+
+def test_polar_unwrap_feeds_annulus_as_strip_with_its_own_grid(extractor, tmp_path):
+    pytest.importorskip("cv2")
+    features = _load_features_module()
+    path = tmp_path / "vits14.safetensors"
+    extractor.save_weights(str(path))
+    with pytest.raises(ValueError):
+        features.DinoV2Features(device="cpu", input_size=112, patch_size=14, weights=str(path), polar_unwrap=True)
+    polar = features.DinoV2Features(
+        device="cpu", input_size=112, patch_size=14, weights=str(path), dynamic_input=True, polar_unwrap=True,
+        preprocess="cv2",
+    )
+    assert polar.get_metadata()["polar_unwrap"] is True and polar.uses_shape
+
+    img = _images()[1]
+    ring = {"kind": "annulus", "cx": 45, "cy": 45, "r": 45, "r_inner": 25}
+    geom = polar.polar_geometry(img.shape[:2], ring)
+    emb, hw = polar.extract(img, shape=ring)
+    assert hw == geom.token_hw and hw != (8, 8) and emb.shape[0] == hw[0] * hw[1]
+    # otras formas (o sin forma) siguen por el letterbox
+    np.testing.assert_allclose(polar.extract(img)[0], extractor.extract(img)[0], rtol=1e-5, atol=1e-5)
+
+    batch = polar.extract_batch([img, img], shapes=[ring, None])
+    assert batch[0][1] == hw and batch[1][1] == (8, 8)
+    np.testing.assert_allclose(batch[0][0], emb, rtol=1e-4, atol=1e-4)
+
+
+def test_with_input_size_shares_the_model_at_a_smaller_grid(extractor):
+    low = extractor.with_input_size(56)
+    assert low.model is extractor.model and low.input_size == 56 and extractor.input_size == 112
+    img = _images()[0]
+    emb, hw = low.extract(img)
+    assert hw == (4, 4) and emb.shape == (16, 3 * 384)
+    assert extractor.extract(img)[1] == (8, 8)   # el extractor completo no cambia de grid
+
+    with pytest.raises(ValueError):
+        extractor.with_input_size(50)
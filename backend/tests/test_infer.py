@@ -0,0 +1,183 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip("cv2")
+
+from backend.infer import InferenceEngine, cascade_decision, roi_token_mask
+
+
+def _engine():
+    extractor = SimpleNamespace(model_name="stub", input_size=56, patch=14)
+    memory = SimpleNamespace(coreset_rate=0.1)
+    return InferenceEngine(extractor, memory, (4, 4), mm_per_px=1.0)
+
+
+def _run(engine, heatmap, threshold):
+    d = np.zeros(16, dtype=np.float32)
+    d[5] = 10.0
+    return engine.run(
+        np.zeros((40, 40, 3), dtype=np.uint8),
+        embeddings=np.zeros((16, 2), dtype=np.float32),
+        token_hw=(4, 4),
+        distances=d,
+        threshold=threshold,
+        area_mm2_thr=0.0,
+        heatmap=heatmap,
+    )
+
+
+def test_heatmap_modes_skip_unneeded_visualization():
+    engine = _engine()
+    full = _run(engine, "full", threshold=1.0)
+    assert full["heatmap_u8"].shape == (40, 40) and full["heatmap_tokens_u8"] is None
+
+    tokens = _run(engine, "tokens", threshold=1.0)
+    assert tokens["heatmap_u8"] is None
+    assert tokens["heatmap_tokens_u8"].shape == (4, 4) and tokens["heatmap_tokens_u8"].dtype == np.uint8
+    assert np.unravel_index(tokens["heatmap_tokens_u8"].argmax(), (4, 4)) == (1, 1)
+
+    none = _run(engine, "none", threshold=1.0)
+    assert none["heatmap_u8"] is None and none["heatmap_tokens_u8"] is None
+    # score y regiones no dependen del modo de heatmap
+    assert none["score"] == full["score"]
+    assert [r["bbox"] for r in none["regions"]] == [r["bbox"] for r in full["regions"]]
+    assert all(isinstance(p[0], int) for p in full["regions"][0]["contour"])
+
+    assert _run(engine, "on_fail", threshold=1.0)["heatmap_u8"] is not None
+    assert _run(engine, "on_fail", threshold=1e6)["heatmap_u8"] is None
+    assert _run(engine, "on_fail", threshold=None)["heatmap_u8"] is None
+
+    with pytest.raises(ValueError):
+        _run(engine, "jpeg", threshold=None)
+
+
+class _LetterboxExtractor(SimpleNamespace):
+    # misma geometría que DinoV2Features.letterbox_box
+    def letterbox_box(self, h, w):
+        scale = min(self.input_size / w, self.input_size / h)
+        nw, nh = int(round(w * scale)), int(round(h * scale))
+        return (self.input_size - nw) // 2, (self.input_size - nh) // 2, nw, nh
+
+
+class _RecordingMemory(SimpleNamespace):
+    def knn_min_dist(self, query):
+        self.queried = query.shape[0]
+        return np.ones(query.shape[0], dtype=np.float32)
+
+
+def test_token_mask_skips_letterbox_padding_and_annulus_hub():
+    extractor = _LetterboxExtractor(model_name="stub", input_size=112, patch=14)
+    # 40x80 -> lienzo 112: contenido en las filas de tokens 2..5, padding en 0-1 y 6-7
+    keep = roi_token_mask(extractor, (40, 80), None, (8, 8)).reshape(8, 8)
+    assert not keep[:2].any() and not keep[6:].any() and keep[2:6].all()
+
+    ring = {"kind": "annulus", "cx": 56, "cy": 56, "r": 56, "r_inner": 30}
+    keep = roi_token_mask(extractor, (112, 112), ring, (8, 8)).reshape(8, 8)
+    assert not keep[3:5, 3:5].any()            # cubo
+    assert keep[0, 3:5].all() and keep[3:5, 0].all()
+    assert 0.3 < keep.mean() < 0.9
+
+
+def test_engine_queries_only_masked_tokens_and_ignores_padding():
+    extractor = _LetterboxExtractor(model_name="stub", input_size=112, patch=14)
+    memory = _RecordingMemory(coreset_rate=0.1)
+    engine = InferenceEngine(extractor, memory, (8, 8), mm_per_px=1.0)
+    img = np.zeros((40, 80, 3), dtype=np.uint8)
+    res = engine.run(img, embeddings=np.zeros((64, 2), np.float32), token_hw=(8, 8), blur_sigma=0, heatmap="none")
+    assert memory.queried == 32 and res["params"]["tokens_queried"] == 32
+
+    # Distancias precalculadas: el padding (muy alto) no se filtra al ROI al reescalar
+    d = np.full((8, 8), 100.0, dtype=np.float32)
+    d[2:6] = 1.0
+    res = engine.run(img, embeddings=np.zeros((64, 2), np.float32), token_hw=(8, 8), distances=d.reshape(-1),
+                     blur_sigma=0, heatmap="none")
+    assert res["score"] == pytest.approx(1.0) and res["params"]["heatmap_mapping"] == "content"
+
+    # Memorias anteriores (calibradas estirando el grid completo): el padding sí entra en el ROI
+    res = engine.run(img, embeddings=np.zeros((64, 2), np.float32), token_hw=(8, 8), distances=d.reshape(-1),
+                     blur_sigma=0, heatmap="none", mask_tokens=False, heatmap_mapping="grid")
+    assert res["score"] == pytest.approx(100.0) and res["params"]["heatmap_mapping"] == "grid"
+
+
+class _PolarExtractor(_LetterboxExtractor):
+    def polar_geometry(self, img_hw, shape):
+        from backend.polar import polar_geometry
+
+        return polar_geometry(img_hw, shape, self.patch, self.input_size)
+
+
+def test_engine_maps_polar_strip_heatmap_back_to_cartesian_regions():
+    extractor = _PolarExtractor(model_name="stub", input_size=448, patch=14)
+    memory = _RecordingMemory(coreset_rate=0.1)
+    engine = InferenceEngine(extractor, memory, (6, 82), mm_per_px=1.0)
+    ring = {"kind": "annulus", "cx": 100, "cy": 100, "r": 100, "r_inner": 60}
+    geom = extractor.polar_geometry((200, 200), ring)
+    assert geom.token_hw == (6, 82)
+    assert roi_token_mask(extractor, (200, 200), ring, geom.token_hw) is None  # la tira es todo anillo
+
+    d = np.zeros(geom.token_hw, np.float32)
+    d[2:4, 1 + 20:1 + 23] = 10.0   # sector ~90° del anillo (abajo en la imagen)
+    res = engine.run(np.zeros((200, 200, 3), np.uint8), shape=ring, embeddings=np.zeros((d.size, 2), np.float32),
+                     token_hw=geom.token_hw, distances=d.reshape(-1), threshold=5.0, area_mm2_thr=0.0)
+    assert res["params"]["polar"] is True and res["heatmap_u8"].shape == (200, 200)
+    assert res["heatmap_u8"][100, 100] == 0   # cubo fuera de la máscara
+    (region,) = res["regions"]
+    x, y, w, h = region["bbox"]
+    assert 60 < x + w / 2 < 140 and 160 < y + h / 2 < 200
+
+
+def test_post_resolution_scores_at_token_scale_and_scales_only_geometry():
+    from backend.utils import percentiles
+
+    values = np.random.default_rng(0).random(1001).astype(np.float32)
+    np.testing.assert_allclose(percentiles(values, (99, 1, 50)), np.percentile(values, [99, 1, 50]), rtol=1e-6)
+
+    extractor = _LetterboxExtractor(model_name="stub", input_size=448, patch=14)
+    engine = InferenceEngine(extractor, SimpleNamespace(coreset_rate=0.1), (32, 32), mm_per_px=0.1)
+    yy, xx = np.mgrid[0:32, 0:32]
+    d = (0.2 + 0.05 * np.sin(xx / 3.0) * np.cos(yy / 4.0)).astype(np.float32)
+    d[10:14, 18:24] = 2.0
+    kw = dict(embeddings=np.zeros((1024, 1), np.float32), token_hw=(32, 32), distances=d.reshape(-1),
+              threshold=1.0, area_mm2_thr=1.0, heatmap="full")
+    img = np.zeros((1200, 1600, 3), np.uint8)
+    ref = engine.run(img, post_resolution="roi", **kw)
+    fast = engine.run(img, post_resolution="x4", **kw)
+
+    assert ref["params"]["work_hw"] == [1200, 1600] and fast["params"]["work_hw"] == [96, 128]
+    assert fast["score"] == pytest.approx(ref["score"], rel=0.02)
+    assert fast["heatmap_u8"].shape == (1200, 1600)
+    (r_ref,), (r_fast,) = ref["regions"], fast["regions"]
+    # la región vuelve a píxeles del ROI: misma zona, área en px² del ROI
+    np.testing.assert_allclose(r_fast["bbox"], r_ref["bbox"], atol=16)
+    assert r_fast["area_px"] == pytest.approx(r_ref["area_px"], rel=0.15)
+    # área del contorno (como siempre) y nº de píxeles de la isla por separado
+    x, y, bw, bh = r_ref["bbox"]
+    contour = np.asarray(r_ref["contour"], np.int32).reshape(-1, 1, 2)
+    assert r_ref["area_px"] == pytest.approx(cv2.contourArea(contour))
+    assert r_ref["area_px"] < r_ref["pixel_count"] <= bw * bh
+    xs, ys = zip(*r_fast["contour"])
+    assert r_ref["bbox"][0] - 16 <= min(xs) and max(xs) < 1600 and max(ys) < 1200
+
+    # islas por debajo del área mínima (en mm² del ROI) se descartan también a resolución de tokens
+    assert engine.run(img, post_resolution="tokens", **{**kw, "area_mm2_thr": 1e4})["regions"] == []
+    with pytest.raises(ValueError):
+        engine.run(img, post_resolution="x3", **kw)
+
+
+def test_cascade_screen_scores_only_and_decision_uses_calibrated_margin():
+    memory = SimpleNamespace(coreset_rate=0.1, knn_min_dist=lambda q: q[:, 0].copy())
+    engine = InferenceEngine(SimpleNamespace(model_name="stub", input_size=56, patch=14), memory, (4, 4), mm_per_px=1.0)
+    emb = np.zeros((16, 2), dtype=np.float32)
+    emb[5, 0] = 10.0
+    score = engine.screen(np.zeros((40, 40, 3), dtype=np.uint8), embeddings=emb, token_hw=(4, 4))
+    full = engine.run(np.zeros((40, 40, 3), dtype=np.uint8), embeddings=emb, token_hw=(4, 4), heatmap="none",
+                      post_resolution="tokens")
+    assert isinstance(score, float) and score == pytest.approx(full["score"])
+
+    calib = {"threshold": 5.0, "cascade_accept": 1.0, "cascade_slope": 2.0, "cascade_intercept": 0.5}
+    assert cascade_decision(0.5, calib) == pytest.approx(1.5)   # estimado en la escala completa
+    assert cascade_decision(1.0, calib) is None                  # en el margen: pasada completa
+    assert cascade_decision(0.1, {"threshold": 5.0}) is None     # sin calibrar la cascada
+    assert cascade_decision(0.1, None) is None
@@ -0,0 +1,68 @@
+import asyncio
+
+from backend.metrics import Laps, MetricsMiddleware, MetricsRegistry, StageTimer, _current_timer, roi_scope, stage
+
+
+def test_stage_is_noop_outside_request():
+    with stage("knn"):
+        pass
+    assert Laps().timer is None
+
+
+def test_stages_accumulate_per_roi_and_render():
+    timer = StageTimer()
+    token = _current_timer.set(timer)
+    try:
+        with stage("decode"):
+            pass
+        with roi_scope("Master", "Pattern"):
+            with stage("knn"):
+                pass
+            with stage("knn"):
+                pass
+            laps = Laps()
+            laps.lap("score")
+    finally:
+        _current_timer.reset(token)
+
+    assert set(timer.by_stage()) == {"decode", "knn", "score"}
+    assert ("knn", ("Master", "Pattern")) in timer.entries
+    assert timer.server_timing(0.01).endswith("total;dur=10.00")
+
+    registry = MetricsRegistry(buckets=(0.5, 1.0))
+    registry.observe_request("/infer", timer, 0.75, 200)
+    text = registry.render([("bdi_test_gauge", "Prueba.", 3)], [("bdi_test_total", "Contador.", 5)])
+    assert 'bdi_request_seconds_bucket{endpoint="/infer",le="0.5"} 0' in text
+    assert 'bdi_request_seconds_bucket{endpoint="/infer",le="1"} 1' in text
+    assert 'bdi_request_seconds_bucket{endpoint="/infer",le="+Inf"} 1' in text
+    # dos "knn" del mismo ROI cuentan como una observación (suma por petición)
+    assert 'bdi_roi_stage_seconds_count{role_id="Master",roi_id="Pattern",stage="knn"} 1' in text
+    assert 'bdi_stage_seconds_count{endpoint="/infer",stage="decode"} 1' in text
+    assert "bdi_test_gauge 3" in text and "# TYPE bdi_test_gauge gauge" in text
+    assert "bdi_test_total 5" in text and "# TYPE bdi_test_total counter" in text
+
+
+def test_middleware_adds_server_timing_only_for_instrumented_paths():
+    async def inner(scope, receive, send):
+        with stage("forward"):
+            pass
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"ok"})
+
+    registry = MetricsRegistry()
+    mw = MetricsMiddleware(inner, registry, paths=("/infer",), server_timing=True)
+
+    def call(path):
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(mw({"type": "http", "path": path}, None, send))
+        return dict(sent[0]["headers"])
+
+    headers = call("/infer")
+    assert headers[b"server-timing"].startswith(b"forward;dur=")
+    assert b"server-timing" not in call("/health")
+    assert 'bdi_requests_total{endpoint="/infer",code="200"} 1' in registry.render()
+    assert "/health" not in registry.render()
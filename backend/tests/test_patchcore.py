@@ -0,0 +1,114 @@
+import numpy as np
+import pytest
+
+from backend.patchcore import (
+    PatchCoreMemory,
+    approx_kcenter_greedy,
+    kcenter_greedy,
+    l2_normalize,
+)
+
+
+def _reference_kcenter(E, m, seed=0):
+    rng = np.random.default_rng(seed)
+    c0 = int(rng.integers(0, E.shape[0]))
+    centers = [c0]
+    d = np.linalg.norm(E - E[c0], axis=1)
+    for _ in range(1, m):
+        i = int(np.argmax(d))
+        centers.append(i)
+        d = np.minimum(d, np.linalg.norm(E - E[i], axis=1))
+    return np.array(centers), float(d.max())
+
+
+def test_kcenter_greedy_matches_reference_implementation():
+    E = l2_normalize(np.random.default_rng(1).standard_normal((500, 32)).astype(np.float32))
+    ref, _ = _reference_kcenter(E, 25)
+    idx = kcenter_greedy(E, 25)
+    np.testing.assert_array_equal(idx, ref)
+
+
+def test_approx_coreset_reports_coverage_and_stats():
+    E = np.random.default_rng(2).standard_normal((2000, 256)).astype(np.float32)
+    idx, radius = approx_kcenter_greedy(l2_normalize(E), 100, proj_dim=32)
+    assert len(np.unique(idx)) == 100
+    assert radius > 0.0
+
+    mem = PatchCoreMemory.build(E, coreset_rate=0.05, coreset_method="approx", proj_dim=32)
+    assert mem.emb.shape == (100, 256)
+    assert mem.build_stats["coreset_method"] == "approx"
+    assert mem.build_stats["coverage_radius"] > 0.0
+    assert mem.build_stats["coreset_selection_ms"] >= 0.0
+
+    # Las muestras del coreset están a distancia ~0 de la memoria
+    d = mem.knn_min_dist(mem.emb[:5])
+    assert np.all(d < 1e-3)
+
+
+def test_extend_only_adds_new_centers_and_keeps_existing():
+    rng = np.random.default_rng(3)
+    base = rng.standard_normal((400, 64)).astype(np.float32)
+    mem = PatchCoreMemory.build(base, coreset_rate=0.1, coreset_method="exact")
+    before = mem.emb.copy()
+
+    new = rng.standard_normal((100, 64)).astype(np.float32) + 3.0  # zona no cubierta
+    stats = mem.extend(new, coreset_rate=0.1, coreset_method="exact")
+
+    assert stats["coreset_added"] == 10
+    assert mem.emb.shape == (50, 64)
+    np.testing.assert_array_equal(mem.emb[:40], before)
+    assert np.all(mem.knn_min_dist(mem.emb[40:]) < 1e-3)
+
+
+def test_approximate_index_types_report_recall():
+    pytest.importorskip("faiss")
+    rng = np.random.default_rng(4)
+    E = rng.standard_normal((3000, 32)).astype(np.float32)
+    params = {}
+    for index_type in ("flat", "ivf_flat", "hnsw", "ivf_pq", "sq8"):
+        mem = PatchCoreMemory.build(E, coreset_rate=0.2, index_type=index_type, recall_queries=200)
+        stats = mem.build_stats
+        assert stats["index_type"] == index_type
+        assert mem.index.ntotal == mem.emb.shape[0]
+        assert mem.knn_min_dist(E[:10]).shape == (10,)
+        if index_type != "flat":
+            assert 0.0 <= stats["index_recall_at_1"] <= 1.0
+            assert stats["index_dist_rel_err"] >= 0.0
+        params[index_type] = stats["index_params"]
+    # ivf/hnsw guardan sus parámetros de búsqueda para reaplicarlos al recargar
+    assert params["ivf_flat"]["nprobe"] >= 1
+    assert params["hnsw"]["ef_search"] == 64
+
+
+@pytest.mark.parametrize("method", ["pca", "random"])
+def test_projection_shrinks_memory_and_accepts_full_dim_queries(method):
+    rng = np.random.default_rng(5)
+    # Datos de rango bajo + ruido: la PCA retiene casi toda la varianza con pocas dimensiones
+    basis = rng.standard_normal((16, 256)).astype(np.float32)
+    E = rng.standard_normal((1500, 16)).astype(np.float32) @ basis
+    E += 0.05 * rng.standard_normal(E.shape).astype(np.float32)
+    groups = np.repeat(np.arange(15), 100)
+
+    mem = PatchCoreMemory.build(E, coreset_rate=0.1, projection=method, projection_dim=64, groups=groups)
+    stats = mem.build_stats
+    assert mem.emb.shape == (150, 64) and mem.input_dim == 256
+    assert stats["projection"] == method and stats["projection_dim"] == 64
+    assert 0.0 < stats["projection_retained_variance"] <= 1.5
+    assert "projection_score_pearson" in stats
+    if method == "pca":
+        assert stats["projection_retained_variance"] > 0.95
+        assert stats["projection_dist_pearson"] > 0.9
+    else:  # la proyección aleatoria sólo conserva las distancias en promedio
+        assert stats["projection_dist_pearson"] > 0.5
+
+    assert mem.knn_min_dist(E[:10]).shape == (10,)
+    added = mem.extend(E[:50] + 1.0, coreset_rate=0.1, coreset_method="exact")
+    assert added["coreset_added"] == 5 and mem.emb.shape == (155, 64)
+
+
+def test_invalid_projection_is_rejected():
+    E = np.random.default_rng(6).standard_normal((100, 8)).astype(np.float32)
+    with pytest.raises(ValueError):
+        PatchCoreMemory.build(E, projection="svd")
+    with pytest.raises(ValueError):
+        PatchCoreMemory.build(E, projection="pca", projection_dim=8)
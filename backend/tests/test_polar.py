@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip("cv2")
+
+from backend.polar import polar_geometry, strip_to_roi, unwrap
+
+RING = {"kind": "annulus", "cx": 100, "cy": 100, "r": 100, "r_inner": 60}
+
+
+def _polar_coords(h, w, geom):
+    ys, xs = np.mgrid[0:h, 0:w].astype(np.float64)
+    rho = np.hypot(xs - geom.cx, ys - geom.cy)
+    theta = np.mod(np.arctan2(ys - geom.cy, xs - geom.cx), 2 * np.pi)
+    return rho, theta
+
+
+def test_geometry_only_for_annulus_and_keeps_letterbox_density():
+    assert polar_geometry((200, 200), None, 14, 448) is None
+    assert polar_geometry((200, 200), {"kind": "circle", "r": 90}, 14, 448) is None
+    assert polar_geometry((200, 200), {**RING, "r_inner": 100}, 14, 448) is None
+
+    geom = polar_geometry((200, 200), RING, 14, 448)
+    # 448/200 px por px: 40 px de anillo -> 6 tokens; 2π·80 px -> 80 tokens (+1 por lado de la costura)
+    assert (geom.strip_h, geom.strip_w) == (84, 1120)
+    assert geom.token_hw == (6, 82)
+    assert geom.r_inner == pytest.approx(60, abs=2)
+    # mismos tokens que el anillo en el lienzo de 32x32, sin cubo ni esquinas
+    ring_tokens = np.pi * (100 ** 2 - 60 ** 2) * (448 / 200 / 14) ** 2
+    assert 6 * 80 == pytest.approx(ring_tokens, rel=0.1)  # redondeo a tokens enteros
+
+    bigger = polar_geometry((200, 200), RING, 14, 448, scale=2.0)
+    assert bigger.token_hw[0] >= 2 * geom.token_hw[0] and bigger.token_hw[1] >= 2 * geom.token_hw[1] - 2
+
+
+def test_unwrap_maps_radius_to_rows_and_angle_to_columns():
+    geom = polar_geometry((200, 200), RING, 14, 224)
+    rho, theta = _polar_coords(200, 200, geom)
+    img = np.dstack([rho, theta / (2 * np.pi) * 255, np.zeros_like(rho)]).astype(np.float32)
+    strip = unwrap(img, geom)
+    assert strip.shape[:2] == geom.size and strip.shape[0] % 14 == 0 and strip.shape[1] % 14 == 0
+
+    core = strip[:, geom.pad:geom.pad + geom.strip_w]
+    radii = core[:, core.shape[1] // 2, 0]
+    assert np.all(np.diff(radii) > 0) and radii[0] == pytest.approx(geom.r_inner, abs=1.5)
+    assert radii[-1] == pytest.approx(100, abs=2)
+    angles = core[core.shape[0] // 2, 5:-5, 1]
+    assert np.all(np.diff(angles) > 0)
+    # costura: las columnas añadidas repiten el otro extremo de la tira
+    np.testing.assert_array_equal(strip[:, :geom.pad], core[:, -geom.pad:])
+    np.testing.assert_array_equal(strip[:, -geom.pad:], core[:, :geom.pad])
+
+
+def test_strip_to_roi_returns_token_values_to_cartesian_pixels():
+    geom = polar_geometry((200, 200), RING, 14, 448)
+    Ht, Wt = geom.token_hw
+    wc = geom.strip_w // geom.patch
+    cols = (np.arange(Wt) - geom.pad // geom.patch + 0.5) / wc * 2 * np.pi   # ángulo del centro del token
+    heat = np.tile(np.cos(cols).astype(np.float32), (Ht, 1))
+
+    out = strip_to_roi(heat, geom, (200, 200))
+    rho, theta = _polar_coords(200, 200, geom)
+    ring = (rho > 65) & (rho < 95)
+    assert np.abs(out[ring] - np.cos(theta[ring])).max() < 0.05   # también junto a la costura
+
+    # un token "defectuoso" vuelve al sector correcto del anillo
+    spot = np.zeros((Ht, Wt), np.float32)
+    spot[3, geom.pad // geom.patch + wc // 4] = 1.0   # ~90° (abajo en la imagen)
+    out = strip_to_roi(spot, geom, (200, 200))
+    y, x = np.unravel_index(out.argmax(), out.shape)
+    assert x == pytest.approx(100, abs=6) and 160 < y < 200
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip("cv2")
+
+from backend.roi_crop import crop_roi
+
+
+def _frame():
+    return np.arange(200 * 300 * 3, dtype=np.uint32).reshape(200, 300, 3).astype(np.uint8)
+
+
+def test_unrotated_crop_is_a_view_and_circle_mask_is_local():
+    frame = _frame()
+    crop, shape = crop_roi(frame, {"kind": "annulus", "cx": 150, "cy": 100, "r": 40, "r_inner": 20})
+    assert crop.shape == (80, 80, 3)
+    assert np.shares_memory(crop, frame)
+    np.testing.assert_array_equal(crop, frame[60:140, 110:190])
+    assert shape == {"kind": "annulus", "cx": 40.0, "cy": 40.0, "r": 40.0, "r_inner": 20.0}
+
+
+def test_rotated_crop_matches_gui_rotate_then_crop():
+    frame = _frame()
+    roi = {"kind": "square", "cx": 120.0, "cy": 90.0, "w": 60, "h": 40, "rotation_deg": 30}
+    crop, shape = crop_roi(frame, roi)
+    assert shape is None and crop.shape == (40, 60, 3)
+
+    # Referencia: como RoiCropUtils.TryGetRotatedCrop (girar el frame entero y recortar)
+    M = cv2.getRotationMatrix2D((120.0, 90.0), 30, 1.0)
+    rotated = cv2.warpAffine(frame, M, (300, 200), flags=cv2.INTER_LINEAR)
+    x, y = int(round(120.0 - 30)), int(round(90.0 - 20))
+    np.testing.assert_allclose(crop.astype(int), rotated[y:y + 40, x:x + 60].astype(int), atol=1)
+
+
+def test_out_of_frame_roi_is_clamped_like_the_gui():
+    yy, xx = np.mgrid[0:200, 0:300]
+    frame = np.dstack([xx * 255 // 300, yy * 255 // 200, (xx + yy) * 255 // 500]).astype(np.uint8)
+    roi = {"kind": "circle", "cx": 280.0, "cy": 30.0, "r": 40, "rotation_deg": 10}
+    crop, shape = crop_roi(frame, roi)
+
+    # TryGetRotatedCrop: girar, recortar centrado y ajustar el rectángulo a la imagen (sin relleno)
+    M = cv2.getRotationMatrix2D((280.0, 30.0), 10, 1.0)
+    rotated = cv2.warpAffine(frame, M, (300, 200), flags=cv2.INTER_LINEAR)
+    cc = M @ np.array([280.0, 30.0, 1.0])
+    x, y = int(round(cc[0] - 40)), max(0, int(round(cc[1] - 40)))   # y < 0 -> se desplaza a 0
+    w, h = min(80, 300 - x), min(80, 200 - y)
+    assert crop.shape == (h, w, 3) and w < 80
+    np.testing.assert_allclose(crop.astype(int), rotated[y:y + h, x:x + w].astype(int), atol=1)
+    # máscara centrada en el crop con el radio escalado (BuildRoiMask)
+    assert shape == {"kind": "circle", "cx": w / 2.0, "cy": h / 2.0, "r": pytest.approx(40 * w / 80)}
+
+
+def test_roi_geometry_ignores_mask_shape_dict_and_top_left_xy():
+    from backend.roi_crop import roi_geometry
+
+    g = roi_geometry({"cx": 50, "cy": 40, "w": 20, "h": 10, "shape": {"kind": "circle", "r": 5}})
+    assert g["kind"] == "rect"
+    with pytest.raises(ValueError):
+        roi_geometry({"kind": "square", "x": 10, "y": 10, "w": 20, "h": 10})   # x/y de la GUI = esquina
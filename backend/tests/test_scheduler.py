@@ -0,0 +1,109 @@
+import threading
+
+import numpy as np
+import pytest
+
+from backend.scheduler import InferenceScheduler
+
+
+class FakeExtractor:
+    """preprocess -> (1,3,H,W) con el id de la imagen; forward -> (id, grid)."""
+
+    def __init__(self, fail=False):
+        self.calls = []
+        self.fail = fail
+
+    def preprocess(self, img):
+        value, size = img
+        return np.full((1, 3, size, size), value, dtype=np.float32)
+
+    def forward_preprocessed(self, xs):
+        self.calls.append(len(xs))
+        if self.fail:
+            raise RuntimeError("boom")
+        return [(np.array([x[0, 0, 0, 0]]), (x.shape[-2] // 14, x.shape[-1] // 14)) for x in xs]
+
+
+def test_scheduler_groups_requests_into_micro_batches():
+    ext = FakeExtractor()
+    sched = InferenceScheduler(ext, max_batch=4, max_wait_ms=200)
+    try:
+        futures = sched.submit_many([(i, 28) for i in range(6)])
+        results = [f.result(timeout=5) for f in futures]
+    finally:
+        sched.stop()
+    assert [int(emb[0]) for emb, _ in results] == list(range(6))
+    assert all(hw == (2, 2) for _, hw in results)
+    assert ext.calls == [4, 2]
+    assert sched.stats()["items"] == 6
+
+
+def test_scheduler_shares_forward_between_threads_and_splits_by_size():
+    ext = FakeExtractor()
+    sched = InferenceScheduler(ext, max_batch=16, max_wait_ms=200)
+    barrier = threading.Barrier(6)
+    out = {}
+
+    def worker(i):
+        barrier.wait()
+        out[i] = sched.extract((i, 28 if i % 2 else 42))
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(6)]
+    try:
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(timeout=5)
+    finally:
+        sched.stop()
+    assert sorted(out) == list(range(6))
+    assert all(int(out[i][0][0]) == i for i in out)
+    assert out[1][1] == (2, 2) and out[0][1] == (3, 3)
+    assert len(ext.calls) < 6  # al menos un forward compartido
+
+
+def test_scheduler_propagates_forward_errors():
+    sched = InferenceScheduler(FakeExtractor(fail=True), max_batch=2, max_wait_ms=1)
+    try:
+        fut = sched.submit((0, 28))
+        with pytest.raises(RuntimeError, match="boom"):
+            fut.result(timeout=5)
+        # el worker sigue vivo tras el error
+        sched.extractor.fail = False
+        assert int(sched.extract((7, 28))[0][0]) == 7
+    finally:
+        sched.stop()
+
+
+class PruningExtractor(FakeExtractor):
+    """token_pruning: la keep-list depende de la forma; forward registra la que recibe."""
+
+    token_pruning = True
+
+    def __init__(self):
+        super().__init__()
+        self.keeps = []
+
+    def patch_keep_list(self, img_hw, shape):
+        return None if shape is None else np.array([True, shape["k"] == 1, True, False])
+
+    def preprocess(self, img):
+        return super().preprocess((int(img[0, 0, 0]), img.shape[0]))
+
+    def forward_preprocessed(self, xs, keep=None):
+        self.keeps.append(None if keep is None else keep.tolist())
+        return super().forward_preprocessed(xs)
+
+
+def test_scheduler_batches_by_patch_keep_list():
+    ext = PruningExtractor()
+    sched = InferenceScheduler(ext, max_batch=8, max_wait_ms=200)
+    imgs = [np.full((28, 28, 3), i, dtype=np.uint8) for i in range(4)]
+    try:
+        futures = sched.submit_many(imgs, [{"k": 1}, {"k": 2}, {"k": 1}, None])
+        results = [f.result(timeout=5) for f in futures]
+    finally:
+        sched.stop()
+    assert [int(emb[0]) for emb, _ in results] == [0, 1, 2, 3]
+    assert sorted(ext.calls) == [1, 1, 2]
+    assert sorted(map(str, ext.keeps)) == sorted(map(str, [[True, True, True, False], [True, False, True, False], None]))
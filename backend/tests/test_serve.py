@@ -0,0 +1,10 @@
+from backend.serve import core_slices
+
+
+def test_core_slices_are_disjoint_blocks_per_worker():
+    assert core_slices(range(32), 4, 8) == [list(range(i * 8, i * 8 + 8)) for i in range(4)]
+
+
+def test_core_slices_wrap_when_cores_are_short():
+    assert core_slices([0, 1, 2], 2, 2) == [[0, 1], [2, 0]]
+    assert core_slices([0, 1], 1, 8) == [[0, 1]]
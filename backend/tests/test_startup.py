@@ -0,0 +1,71 @@
+import threading
+
+import pytest
+
+from backend.startup import Startup, parse_roi_list
+
+
+def test_phases_run_in_order_and_preload_after_ready():
+    seen = []
+    st = Startup()
+    st.start(
+        [("loading", lambda: seen.append(("loading", st.ready))), ("warming", lambda: seen.append(("warming", st.ready)))],
+        after_ready=[("preload", lambda: seen.append(("preload", st.ready)))],
+        background=False,
+    )
+    assert seen == [("loading", False), ("warming", False), ("preload", True)]
+    snap = st.snapshot()
+    assert snap["state"] == "ready" and snap["ready"] and snap["error"] is None
+    assert {"loading", "warming", "total", "preload"} <= set(snap["timings_s"])
+
+
+def test_background_start_is_idempotent_and_reports_busy():
+    gate = threading.Event()
+    calls = []
+    st = Startup()
+    st.start([("loading", lambda: (calls.append(1), gate.wait(5)))])
+    st.start([("loading", lambda: calls.append(2))])
+    assert st.busy and not st.wait(0.05)
+    assert st.snapshot()["state"] == "loading"
+    gate.set()
+    assert st.wait(5) and not st.busy
+    assert calls == [1]
+
+
+def test_failed_phase_sets_error_state():
+    st = Startup()
+
+    def boom():
+        raise FileNotFoundError("weights.safetensors")
+
+    st.start([("loading", boom)], background=False)
+    assert not st.ready and not st.busy and not st.wait(0)
+    assert st.state == "error" and "weights.safetensors" in st.error
+
+
+def test_failed_start_is_retried_only_after_the_backoff():
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise OSError("weights.safetensors temporalmente ilegible")
+
+    st = Startup()
+    st.start([("loading", flaky)], background=False, retry_after_s=60.0)
+    assert st.state == "error" and 59.0 < st.retry_in(60.0) <= 60.0
+    st.start([("loading", flaky)], background=False, retry_after_s=60.0)  # aún en backoff
+    st.start([("loading", flaky)], background=False)                      # sin reintento
+    assert len(attempts) == 1 and st.state == "error"
+
+    st.start([("loading", flaky)], background=False, retry_after_s=0.0)
+    assert len(attempts) == 2 and st.ready and st.error is None
+    assert st.snapshot()["failures"] == 1 and st.retry_in(60.0) is None
+
+
+def test_parse_roi_list_accepts_env_and_yaml_forms():
+    assert parse_roi_list("Master/Pattern, Master/Inner,") == [("Master", "Pattern"), ("Master", "Inner")]
+    assert parse_roi_list([["Master", "Pattern"], "Slave/A/B"]) == [("Master", "Pattern"), ("Slave", "A/B")]
+    assert parse_roi_list(None) == []
+    with pytest.raises(ValueError):
+        parse_roi_list("Pattern")
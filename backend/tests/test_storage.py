@@ -0,0 +1,157 @@
+import json
+
+import numpy as np
+import pytest
+
+from backend.storage import ModelStore
+
+
+def test_bundle_roundtrip_is_memory_mapped_and_keeps_calibration(tmp_path):
+    store = ModelStore(tmp_path)
+    emb = np.random.default_rng(0).standard_normal((10, 6)).astype(np.float32)
+
+    store.save_bundle("Master", "Pattern", emb, (2, 5), metadata={"coreset_rate": 0.1})
+    store.save_calib("Master", "Pattern", {"threshold": 3.5})
+
+    loaded, token_hw, meta = store.load_memory("Master", "Pattern")
+    assert isinstance(loaded, np.memmap)
+    np.testing.assert_array_equal(loaded, emb)
+    assert token_hw == (2, 5)
+    assert meta == {"coreset_rate": 0.1}
+    assert store.load_calib("Master", "Pattern")["threshold"] == 3.5
+
+    # Un re-fit reemplaza los embeddings, conserva la calibración y limpia versiones viejas
+    del loaded
+    store.save_bundle("Master", "Pattern", emb[:4], (2, 2))
+    assert store.load_memory("Master", "Pattern")[0].shape == (4, 6)
+    assert store.load_calib("Master", "Pattern")["threshold"] == 3.5
+    assert len(list(tmp_path.glob("*.bundle/emb.*.npy"))) == 1
+
+
+def test_legacy_npz_is_still_readable(tmp_path):
+    store = ModelStore(tmp_path)
+    emb = np.ones((3, 4), dtype=np.float32)
+    np.savez_compressed(
+        tmp_path / "Master_Pattern.npz",
+        emb=emb,
+        token_h=1,
+        token_w=3,
+        metadata=json.dumps({"coreset_rate": 0.5}),
+    )
+    (tmp_path / "Master_Pattern_calib.json").write_text(json.dumps({"threshold": 1.0}))
+
+    loaded, token_hw, meta = store.load_memory("Master", "Pattern")
+    np.testing.assert_array_equal(loaded, emb)
+    assert token_hw == (1, 3) and meta["coreset_rate"] == 0.5
+    assert store.load_calib("Master", "Pattern")["threshold"] == 1.0
+
+
+def test_bundle_index_is_loaded_from_disk(tmp_path):
+    faiss = pytest.importorskip("faiss")
+    store = ModelStore(tmp_path, emb_dtype="float16")
+    emb = np.random.default_rng(1).standard_normal((20, 8)).astype(np.float32)
+    index = faiss.IndexFlatL2(8)
+    index.add(emb)
+
+    store.save_bundle("Master", "Pattern", emb, (4, 5), index_blob=bytes(faiss.serialize_index(index)))
+    loaded, _, _ = store.load_memory("Master", "Pattern")
+    assert loaded.dtype == np.float32
+    np.testing.assert_allclose(loaded, emb, atol=1e-2)
+
+    idx = store.load_index("Master", "Pattern")
+    assert idx.ntotal == 20
+    D, I = idx.search(emb[:3], 1)
+    np.testing.assert_array_equal(I[:, 0], [0, 1, 2])
+
+
+def test_bundle_stores_projection_alongside_memory(tmp_path):
+    store = ModelStore(tmp_path)
+    emb = np.random.default_rng(2).standard_normal((10, 3)).astype(np.float32)
+    matrix = np.random.default_rng(3).standard_normal((6, 3)).astype(np.float32)
+    mean = np.arange(6, dtype=np.float32)
+
+    store.save_bundle("Master", "Pattern", emb, (2, 5), projection={"matrix": matrix, "mean": mean})
+    proj = store.load_projection("Master", "Pattern")
+    np.testing.assert_array_equal(proj["matrix"], matrix)
+    np.testing.assert_array_equal(proj["mean"], mean)
+
+    # Un re-fit sin proyección no arrastra la anterior
+    store.save_bundle("Master", "Pattern", emb, (2, 5))
+    assert store.load_projection("Master", "Pattern") is None
+    assert not list(tmp_path.glob("*.bundle/proj.*.npz"))
+
+
+def test_concurrent_fit_and_calibration_keep_a_consistent_bundle(tmp_path):
+    import threading
+
+    store = ModelStore(tmp_path)
+    emb = np.ones((8, 4), dtype=np.float32)
+    store.save_bundle("Master", "Pattern", emb, (2, 4))
+    # fichero de otro escritor aún sin cabecera: la limpieza no debe tocarlo
+    foreign = next(tmp_path.glob("*.bundle")) / "emb.otherwriter.npy"
+    np.save(foreign, emb)
+
+    errors = []
+
+    def fit(i):
+        try:
+            for _ in range(10):
+                store.save_bundle("Master", "Pattern", emb[: 2 + i], (1, 2 + i))
+        except Exception as exc:  # pragma: no cover - se informa abajo
+            errors.append(exc)
+
+    def calibrate():
+        for t in range(20):
+            store.save_calib("Master", "Pattern", {"threshold": float(t)})
+
+    threads = [threading.Thread(target=fit, args=(i,)) for i in range(3)] + [threading.Thread(target=calibrate)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+
+    assert not errors
+    loaded = store.load_memory("Master", "Pattern")
+    assert loaded is not None and loaded[0].shape[0] == loaded[1][1]
+    assert store.load_calib("Master", "Pattern")["threshold"] == 19.0
+    names = {p.name for p in foreign.parent.iterdir()}
+    assert foreign.name in names
+    assert len([n for n in names if n.startswith("emb.")]) == 2   # la vigente + la ajena
+    assert not [n for n in names if n.endswith(".tmp")]
+
+
+def test_load_bundle_rereads_header_when_a_save_replaces_it_midway(tmp_path, monkeypatch):
+    store = ModelStore(tmp_path)
+    old = np.zeros((4, 3), dtype=np.float32)
+    new = np.ones((6, 3), dtype=np.float32)
+    store.save_bundle("Master", "Pattern", old, (2, 2), extractor={"preprocess": "pil"},
+                      projection={"matrix": np.zeros((5, 3), np.float32)})
+
+    header_memory = ModelStore._header_memory
+    calls = []
+
+    def racing(bundle, header, mmap):
+        if not calls:
+            # otro worker guarda entre la lectura de la cabecera y la carga de sus ficheros
+            store.save_bundle("Master", "Pattern", new, (2, 3), extractor={"preprocess": "cv2"})
+        calls.append(header["emb_file"])
+        return header_memory(bundle, header, mmap)
+
+    monkeypatch.setattr(ModelStore, "_header_memory", staticmethod(racing))
+    loaded = store.load_bundle("Master", "Pattern")
+    assert len(calls) == 2 and calls[0] != calls[1]
+    np.testing.assert_array_equal(loaded["embeddings"], new)
+    # todo de la misma versión: sin la proyección ni el extractor de la anterior
+    assert loaded["token_hw"] == (2, 3) and loaded["projection"] is None
+    assert loaded["extractor"] == {"preprocess": "cv2"}
+
+
+def test_load_bundle_reads_legacy_memory(tmp_path):
+    store = ModelStore(tmp_path)
+    assert store.load_bundle("Master", "Pattern") is None
+    emb = np.ones((3, 2), dtype=np.float32)
+    np.savez(tmp_path / "Master_Pattern.npz", emb=emb, token_h=1, token_w=3)
+
+    loaded = store.load_bundle("Master", "Pattern")
+    np.testing.assert_array_equal(loaded["embeddings"], emb)
+    assert loaded["token_hw"] == (1, 3) and loaded["extractor"] is None and loaded["projection"] is None
@@ -26,7 +26,26 @@ def px2_to_mm2(area_px: float, mm_per_px: float) -> float:
     return float(area_px * (mm_per_px ** 2))
 
 def percentile(arr: np.ndarray, p: float) -> float:
-    return float(np.percentile(arr, p))
+    return percentiles(arr, (p,))[0]
+
+def percentiles(arr: np.ndarray, ps, overwrite: bool = False) -> list:
+    """
+    Igual que np.percentile(arr, ps) (interpolación lineal) con un único np.partition sobre los
+    índices que hacen falta: O(n) y sin pasar a float64. overwrite=True reordena `arr` en sitio.
+    """
+    a = np.asarray(arr).reshape(-1)
+    n = a.size
+    if n == 0:
+        raise ValueError("percentiles de un array vacío")
+    pos = [(n - 1) * float(p) / 100.0 for p in ps]
+    lo = [int(np.floor(x)) for x in pos]
+    hi = [min(i + 1, n - 1) for i in lo]
+    kth = sorted(set(lo + hi))
+    if overwrite:
+        a.partition(kth)
+    else:
+        a = np.partition(a, kth)
+    return [float(a[i]) + (float(a[j]) - float(a[i])) * (x - i) for x, i, j in zip(pos, lo, hi)]
 
 def as_b64_png(img_bgr: np.ndarray) -> str:
     import cv2
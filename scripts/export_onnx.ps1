@@ -1,23 +1,28 @@
-
 # export_onnx.ps1
-Write-Host "🔄 Exporting TensorFlow model to ONNX..."
+# Exporta el extractor DINOv2 (input_size fijo) a ONNX y valida la paridad con PyTorch.
+# Uso: .\scripts\export_onnx.ps1 [-InputSize 448] [-Weights models\weights\dinov2_vits14.safetensors]
+param(
+    [int]$InputSize = 448,
+    [string]$Weights = ""
+)
 
-Set-Location $PSScriptRoot\..\backend
+Write-Host "🔄 Exporting DINOv2 extractor to ONNX..."
 
-.venv\Scripts\Activate.ps1
+Set-Location $PSScriptRoot\..
 
-$model = "model/current_model.h5"
-$output = "model/current_model.onnx"
+backend\.venv\Scripts\Activate.ps1
 
-if (-Not (Test-Path $model)) {
-    Write-Host "❌ Model not found: $model"
-    exit 1
+$output = "models/onnx/dinov2_vits14_$InputSize.onnx"
+$argsList = @("-m", "backend.onnx_features", "--out", $output, "--input-size", $InputSize)
+if ($Weights -ne "") {
+    $argsList += @("--weights", $Weights)
 }
 
-python -m tf2onnx.convert --keras $model --output $output --opset 13
+python @argsList
 
-if (Test-Path $output) {
-    Write-Host "✅ Model exported to $output"
+if ($LASTEXITCODE -eq 0) {
+    Write-Host "✅ Model exported to $output (set extractor.backend: onnx in configs/app.yaml)"
 } else {
-    Write-Host "❌ Export failed."
+    Write-Host "❌ Export or parity check failed."
+    exit 1
 }